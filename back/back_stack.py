@@ -1,11 +1,15 @@
 """ Back End Stack """
 
+import json
+
+import aws_cdk as cdk
 from aws_cdk import (
     aws_lambda as lambda_,
     aws_ec2 as ec2,
     aws_dynamodb as ddb,
     aws_iam as iam,
     aws_apigateway as apigw,
+    aws_lambda_event_sources as lambda_event_sources,
 )
 from constructs import Construct
 from utils_files import utils_cdk
@@ -47,6 +51,26 @@ class BackStack(utils_cdk.CommonStacksVars):
             description="Layer containing the requests package.",
         )
 
+        layer_shared = lambda_.LayerVersion(
+            self,
+            id=f"LAYER-shared-{self.suffix}",
+            code=lambda_.AssetCode("back/lambdas_shared"),
+            description="Layer containing the code shared between lambdas.",
+        )
+
+        # JWT verification in lambda_auth, static token check when no JWKS is set
+        auth_jwt = self.node.try_get_context("AUTH_JWT") or {}
+        layer_jwt = (
+            lambda_.LayerVersion(
+                self,
+                id=f"LAYER-jwt-{self.suffix}",
+                code=lambda_.AssetCode("back/lambdas_layers/jwt"),
+                description="Layer containing the PyJWT package.",
+            )
+            if auth_jwt.get("JWKS_URL")
+            else None
+        )
+
         # ### SECURITY GROUPS ### #
         self.lambda_security_group = ec2.SecurityGroup(
             self,
@@ -54,6 +78,13 @@ class BackStack(utils_cdk.CommonStacksVars):
             vpc=self.vpc,
         )
 
+        # ### VPC ENDPOINTS ### #
+        # Lambdas in the VPC reach DynamoDB without going through the NAT, for free
+        self.vpc.add_gateway_endpoint(
+            f"VPCE-dynamodb-{self.suffix}",
+            service=ec2.GatewayVpcEndpointAwsService.DYNAMODB,
+        )
+
         # ### DYNAMODB ### #
         ddb_url_request_count = utils_cdk.create_dynamodb(
             self,
@@ -64,38 +95,206 @@ class BackStack(utils_cdk.CommonStacksVars):
             # you delete the stack.
             # table_name="url-request-count",
             sort_key=ddb.Attribute(name="status_code", type=ddb.AttributeType.NUMBER),
+            # Feeds lambda_aggregate_url_counters
+            stream=ddb.StreamViewType.NEW_AND_OLD_IMAGES,
         )
 
+        # Summaries maintained from the url-request-count stream, see
+        # lambda_aggregate_url_counters for the items layout
+        ddb_url_counter_aggregates = utils_cdk.create_dynamodb(
+            self,
+            table_id=f"url-counter-aggregates-{self.suffix}",
+            partition_key=ddb.Attribute(name="pk", type=ddb.AttributeType.STRING),
+            sort_key=ddb.Attribute(name="sk", type=ddb.AttributeType.STRING),
+            # Hourly buckets items expire, summaries have no expires_at
+            ttl_attribute="expires_at",
+        )
+        # Sparse, only hourly buckets items have a status_shard, see
+        # lambdas_shared.counter_buckets
+        ddb_url_counter_aggregates.add_global_secondary_index(
+            index_name="status-bucket",
+            partition_key=ddb.Attribute(
+                name="status_shard", type=ddb.AttributeType.STRING
+            ),
+            sort_key=ddb.Attribute(name="bucket", type=ddb.AttributeType.STRING),
+            projection_type=ddb.ProjectionType.INCLUDE,
+            non_key_attributes=["url", "status_code", "counter"],
+        )
+        # Same for the lambda writing buckets and the one reading them
+        counter_buckets = self.node.try_get_context("COUNTER_BUCKETS") or {}
+        counter_buckets_environment = {
+            "BUCKET_RETENTION_DAYS": str(counter_buckets.get("RETENTION_DAYS", 30)),
+            "STATUS_INDEX_SHARDS": str(counter_buckets.get("STATUS_INDEX_SHARDS", 4)),
+        }
+
         # ### LAMBDAS ### #
-        lambda_auth = utils_cdk.create_lambda(self, name="auth")
+        # Hot urls counters sharding, ex: {"https://google.com": 10}
+        url_counter_shards = json.dumps(
+            self.node.try_get_context("URL_COUNTER_SHARDS") or {}
+        )
+
+        # EDGE or REGIONAL REST API, or HTTP for an API Gateway v2 HTTP API
+        api_endpoint_type = self.node.try_get_context("API_ENDPOINT_TYPE") or "EDGE"
+        # Rejects malformed tokens before the authorizer is even invoked
+        token_pattern = (
+            r"^(Bearer )?[\w-]+\.[\w-]+\.[\w-]+$" if layer_jwt else "MyAccessToken"
+        )
+
+        lambda_auth_environment = {}
+        if layer_jwt:
+            lambda_auth_environment.update(
+                {
+                    "JWKS_URL": auth_jwt["JWKS_URL"],
+                    "JWT_ISSUER": auth_jwt.get("ISSUER", ""),
+                    "JWT_AUDIENCE": auth_jwt.get("AUDIENCE", ""),
+                }
+            )
+        if api_endpoint_type == "HTTP":
+            # HTTP APIs authorizers have no validation regex, lambda_auth checks it
+            lambda_auth_environment["AUTH_TOKEN_PATTERN"] = token_pattern
+
+        lambda_auth = utils_cdk.create_lambda(
+            self,
+            name="auth",
+            layers=[layer_shared, layer_jwt] if layer_jwt else [layer_shared],
+            environment=lambda_auth_environment or None,
+        )
+
+        # Async mode: the route only enqueues urls, probes are run by batches
+        url_counter_async = bool(self.node.try_get_context("URL_COUNTER_ASYNC"))
+        probes_queue = (
+            utils_cdk.create_sqs_queue(
+                self, queue_id=f"url-probes-{self.suffix}", visibility_timeout=6 * 60
+            )
+            if url_counter_async
+            else None
+        )
+
+        # Interface endpoints are billed hourly, only create the SQS one when used
+        # Probes lambdas need internet access, they are usually out of the VPC
+        if probes_queue and utils_cdk.get_lambda_profile(
+            self, "request_and_increment_url_counter"
+        ).get("IN_VPC", True):
+            self.vpc.add_interface_endpoint(
+                f"VPCE-sqs-{self.suffix}",
+                service=ec2.InterfaceVpcEndpointAwsService.SQS,
+            )
 
         lb_request_and_increment_url_counter = utils_cdk.create_lambda(
             self,
             name="request_and_increment_url_counter",
-            layers=[layer_requests],
+            layers=[layer_requests, layer_shared],
             environment={
-                "TABLE_URL_REQUEST_COUNT_NAME": ddb_url_request_count.table_name
+                "TABLE_URL_REQUEST_COUNT_NAME": ddb_url_request_count.table_name,
+                "URL_COUNTER_SHARDS": url_counter_shards,
+                **({"PROBE_QUEUE_URL": probes_queue.queue_url} if probes_queue else {}),
             },
             role=role_lambda_access_ddb,
         )
 
+        if probes_queue:
+            self.add_url_probes_pipeline(
+                probes_queue,
+                lb_request_and_increment_url_counter,
+                layers=[layer_requests, layer_shared],
+                environment={
+                    "TABLE_URL_REQUEST_COUNT_NAME": ddb_url_request_count.table_name,
+                    "URL_COUNTER_SHARDS": url_counter_shards,
+                },
+                role=role_lambda_access_ddb,
+            )
+
         lb_get_url_counter = utils_cdk.create_lambda(
             self,
             name="get_url_counter",
-            layers=[layer_requests],
+            layers=[layer_requests, layer_shared],
             environment={
-                "TABLE_URL_REQUEST_COUNT_NAME": ddb_url_request_count.table_name
+                "TABLE_URL_REQUEST_COUNT_NAME": ddb_url_request_count.table_name,
+                "TABLE_URL_AGGREGATES_NAME": ddb_url_counter_aggregates.table_name,
+                "URL_COUNTER_SHARDS": url_counter_shards,
+                **counter_buckets_environment,
+                "CACHE_TTL_SECONDS": str(
+                    self.node.try_get_context("GET_URL_COUNTER_CACHE_TTL") or 0
+                ),
             },
             role=role_lambda_access_ddb,
         )
 
+        lb_aggregate_url_counters = utils_cdk.create_lambda(
+            self,
+            name="aggregate_url_counters",
+            layers=[layer_shared],
+            environment={
+                "TABLE_URL_AGGREGATES_NAME": ddb_url_counter_aggregates.table_name,
+                **counter_buckets_environment,
+            },
+            role=role_lambda_access_ddb,
+            timeout=60,
+        )
+        lb_aggregate_url_counters.add_event_source(
+            lambda_event_sources.DynamoEventSource(
+                ddb_url_request_count,
+                starting_position=lambda_.StartingPosition.TRIM_HORIZON,
+                batch_size=500,
+                max_batching_window=cdk.Duration.seconds(5),
+                retry_attempts=10,
+                # Retried batches are applied once, see lambda_aggregate_url_counters
+                # Failing batches are split in two until the failing records are
+                # isolated, the shard & sequences of those out of retries go to a DLQ
+                bisect_batch_on_error=True,
+                on_failure=lambda_event_sources.SqsDlq(
+                    utils_cdk.create_dead_letter_queue(
+                        self, queue_id=f"url-counters-stream-{self.suffix}"
+                    )
+                ),
+            )
+        )
+
+        # ### API GATEWAY ### #
+        # (path, method, lambda, status code, cache key parameters)
+        routes = [
+            (
+                "/increment-url-counter",
+                "POST",
+                lb_request_and_increment_url_counter,
+                202 if url_counter_async else 201,
+                None,
+            ),
+            (
+                "/get-url-counter",
+                "GET",
+                lb_get_url_counter,
+                200,
+                [
+                    "url",
+                    "summary",
+                    "status",
+                    "from",
+                    "to",
+                    "hours",
+                    "limit",
+                    "cursor",
+                    "fields",
+                    "consistent",
+                ],
+            ),
+        ]
+
+        if api_endpoint_type == "HTTP":
+            self.add_http_api(lambda_auth, routes)
+        else:
+            self.add_rest_api(lambda_auth, routes, token_pattern, api_endpoint_type)
+
+    def add_rest_api(self, lambda_auth, routes, token_pattern, endpoint_type):
+        """Create the REST API, its token authorizer and its lambda routes"""
         # ### AUTHORIZERS ### #
         authorizer = utils_cdk.create_authorizer(
             self,
             auth_id="token_auth",
             header_token="AuthToken",
-            validation_regex="MyAccessToken",
+            validation_regex=token_pattern,
             authorizer=lambda_auth,
+            results_cache_ttl=self.node.try_get_context("AUTHORIZER_CACHE_TTL") or 0,
         )
 
         # ### API GATEWAY ### #
@@ -112,6 +311,13 @@ class BackStack(utils_cdk.CommonStacksVars):
                 allow_headers=apigw.Cors.DEFAULT_HEADERS + ["AuthToken"],
                 allow_methods=["GET", "POST", "OPTIONS"],
             ),
+            # Stage caching, disabled unless a cache cluster size is set in conf
+            cache_cluster_size=self.node.try_get_context("API_CACHE_CLUSTER_SIZE"),
+            method_cache_ttls=self.node.try_get_context("API_CACHE_TTLS"),
+            endpoint_type=endpoint_type,
+            minimum_compression_size=self.node.try_get_context(
+                "API_MINIMUM_COMPRESSION_SIZE"
+            ),
         )
 
         # ### API GATEWAY ROUTES ### #
@@ -124,28 +330,74 @@ class BackStack(utils_cdk.CommonStacksVars):
             "method.response.header.Access-Control-Allow-Origin": "'*'"
         }
 
-        # /increment-url-counter
-        increment_url_counter_route = api_gateway.root.add_resource(
-            "increment-url-counter"
-        )
-        utils_cdk.add_apigw_lambda_route(
-            route=increment_url_counter_route,
-            method="POST",
-            handler_lambda=lb_request_and_increment_url_counter,
-            status_code=201,
-            authorizer=authorizer,
-            method_response_parameters=method_response_parameters,
-            integration_response_parameters=integration_response_parameters,
-        )
-
-        # /get-url-counter
-        get_url_counter_route = api_gateway.root.add_resource("get-url-counter")
-        utils_cdk.add_apigw_lambda_route(
-            route=get_url_counter_route,
-            method="GET",
-            handler_lambda=lb_get_url_counter,
-            status_code=200,
-            authorizer=authorizer,
-            method_response_parameters=method_response_parameters,
-            integration_response_parameters=integration_response_parameters,
+        # Routes integrated with lambda proxy instead of the request template
+        proxy_routes = self.node.try_get_context("APIGW_PROXY_ROUTES") or []
+
+        for path, method, handler_lambda, status_code, cache_key_parameters in routes:
+            utils_cdk.add_apigw_lambda_route(
+                route=api_gateway.root.add_resource(path.strip("/")),
+                method=method,
+                handler_lambda=handler_lambda,
+                status_code=status_code,
+                authorizer=authorizer,
+                method_response_parameters=method_response_parameters,
+                integration_response_parameters=integration_response_parameters,
+                cache_key_parameters=cache_key_parameters,
+                proxy=path in proxy_routes,
+            )
+
+        return api_gateway
+
+    def add_http_api(self, lambda_auth, routes):
+        """Create the HTTP API, its lambda authorizer and its lambda proxy routes"""
+        http_api = utils_cdk.create_http_api(
+            self,
+            apigw_id=self.suffix,
+            cors_allow_headers=["Content-Type", "AuthToken"],
+            cors_allow_methods=["GET", "POST", "OPTIONS"],
+        )
+
+        authorizer = utils_cdk.create_http_api_authorizer(
+            self,
+            http_api,
+            auth_id="token_auth",
+            header_token="AuthToken",
+            authorizer=lambda_auth,
+            results_cache_ttl=self.node.try_get_context("AUTHORIZER_CACHE_TTL") or 0,
+        )
+
+        for path, method, handler_lambda, _, _ in routes:
+            utils_cdk.add_http_api_lambda_route(
+                self, http_api, path, method, handler_lambda, authorizer=authorizer
+            )
+
+        return http_api
+
+    # pylint: disable=too-many-arguments
+    def add_url_probes_pipeline(
+        self, probes_queue, lb_enqueue, layers, environment, role
+    ):
+        """Let lb_enqueue feed the probes queue and create its batch consumer lambda
+        lb_enqueue may be an alias, its environment must already hold PROBE_QUEUE_URL"""
+        probes_queue.grant_send_messages(lb_enqueue)
+
+        lb_consume_url_probes = utils_cdk.create_lambda(
+            self,
+            name="consume_url_probes",
+            code_name="request_and_increment_url_counter",
+            handler="batch_handler",
+            layers=layers,
+            environment={**environment, "PROBE_CONCURRENCY": "16"},
+            role=role,
+            timeout=60,
+        )
+        lb_consume_url_probes.add_event_source(
+            lambda_event_sources.SqsEventSource(
+                probes_queue,
+                batch_size=100,
+                max_batching_window=cdk.Duration.seconds(5),
+                report_batch_item_failures=True,
+            )
         )
+
+        return probes_queue
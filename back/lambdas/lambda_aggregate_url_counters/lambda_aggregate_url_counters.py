@@ -0,0 +1,279 @@
+"""
+    Lambda plugged on the url-request-count table stream which maintains the
+    url-counter-aggregates table, so summaries are read without scanning counters.
+
+    Aggregates items (pk, sk):
+    - ("URL", <url>): counters of an url, one Query on "URL" lists every url
+    - ("CLASS#<n>xx", <url>): counters of an url for a status class, ex: "CLASS#5xx"
+    Each item holds a "counter" total and one "counter_<n>xx" attribute per status class.
+    - ("GLOBAL#<shard>", "TOTAL"): totals of the urls of a shard, same counters, see
+    lambdas_shared.counter_buckets
+    - ("BUCKET#<url>", "<hour>#<status_code>"): counter of an url & status code during
+    an hour, expired by the table TTL, see lambdas_shared.counter_buckets
+
+    Stream batches are delivered at least once: a failed batch is retried, or split in
+    two and retried, after some of its aggregates were written. Each aggregate item keeps
+    the last stream SequenceNumber applied per counter item it sums, in "seq#" attributes,
+    and is only updated with the records past them. Records of a counter item are
+    ordered in the stream, so each change is counted exactly once.
+    Global totals have no "seq#" attributes, they would grow with the number of urls:
+    they are updated in the same transaction as the ("URL", <url>) item, with the changes
+    it accepts only.
+
+    Every batch writes to the "URL" and "CLASS#<n>xx" partitions. This lambda is their
+    only writer, one batch at a time per stream shard, with one UpdateItem per url:
+    their write rate stays far below a partition limit.
+"""
+
+import os
+import time
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import ClientError
+
+from lambdas_shared import aws, counter_buckets, instrumentation
+
+
+TABLE_URL_AGGREGATES = aws.dynamodb_table(os.environ.get("TABLE_URL_AGGREGATES_NAME"))
+
+DESERIALIZER = TypeDeserializer()
+SEQUENCE_PREFIX = "seq#"
+# Stream SequenceNumbers have 21 to 40 digits, padded they compare as strings
+SEQUENCE_LENGTH = 40
+
+
+def get_image_counter(image):
+    """Return url, status_code & counter of a stream image, None if there is no image"""
+    if not image:
+        return None
+
+    item = {key: DESERIALIZER.deserialize(value) for key, value in image.items()}
+
+    # Sharded counters are aggregated under their original url
+    return (
+        item.get("shard_of", item["url"]),
+        item["status_code"],
+        item.get("counter", 0),
+    )
+
+
+def get_record_deltas(record):
+    """Return the counter variations carried by a stream record"""
+    new = get_image_counter(record["dynamodb"].get("NewImage"))
+    old = get_image_counter(record["dynamodb"].get("OldImage"))
+
+    deltas = []
+    if new:
+        deltas.append((new[0], new[1], new[2]))
+    if old:
+        deltas.append((old[0], old[1], -old[2]))
+
+    return deltas
+
+
+def get_record_source(record):
+    """Return the counter item a stream record belongs to, as a "seq#" attribute name,
+    and the record SequenceNumber padded to compare as a string"""
+    image = record["dynamodb"].get("NewImage") or record["dynamodb"]["OldImage"]
+    item = {key: DESERIALIZER.deserialize(image[key]) for key in ["url", "status_code"]}
+
+    return (
+        f"{SEQUENCE_PREFIX}{item['status_code']}#{item['url']}",
+        record["dynamodb"]["SequenceNumber"].zfill(SEQUENCE_LENGTH),
+    )
+
+
+def merge_deltas(records):
+    """Group the counter variations of the batch per aggregate item, as a list of
+    (source, sequence, {attribute: delta}) per record"""
+    aggregates = {}
+
+    for record in records:
+        # Counters are bucketed by the time of their change
+        bucket = counter_buckets.get_bucket(
+            record["dynamodb"].get("ApproximateCreationDateTime", time.time())
+        )
+        source, sequence = get_record_source(record)
+        changes = {}
+
+        for url, status_code, delta in get_record_deltas(record):
+            status_class = counter_buckets.get_status_class(status_code)
+
+            for key in [("URL", url), (f"CLASS#{status_class}", url)]:
+                attributes = changes.setdefault(key, {})
+                for attribute in ["counter", f"counter_{status_class}"]:
+                    attributes[attribute] = attributes.get(attribute, 0) + delta
+
+            bucket_key = counter_buckets.get_keys(url, bucket, status_code)
+            attributes = changes.setdefault((bucket_key["pk"], bucket_key["sk"]), {})
+            attributes["counter"] = attributes.get("counter", 0) + delta
+
+        for key, attributes in changes.items():
+            aggregates.setdefault(key, []).append((source, sequence, attributes))
+
+    return aggregates
+
+
+def sum_changes(changes, applied):
+    """Sum the changes not applied yet, return the variations per attribute and the
+    first & last new sequence per source"""
+    attributes, sequences = {}, {}
+
+    for source, sequence, deltas in changes:
+        if sequence <= applied.get(source, ""):
+            continue
+
+        for name, delta in deltas.items():
+            attributes[name] = attributes.get(name, 0) + delta
+        first, last = sequences.get(source, (sequence, sequence))
+        sequences[source] = (min(first, sequence), max(last, sequence))
+
+    return attributes, sequences
+
+
+def get_bucket_fields(partition_key, sort_key):
+    """Attributes SET on a bucket item, indexed by the status-bucket index"""
+    url = partition_key[len("BUCKET#") :]
+    bucket, status_code = sort_key.split("#")
+
+    return {
+        "url": url,
+        "bucket": bucket,
+        "status_code": int(status_code),
+        "status_shard": counter_buckets.get_status_shard(
+            counter_buckets.get_status_class(status_code), url
+        ),
+        "expires_at": counter_buckets.get_expires_at(bucket),
+    }
+
+
+def get_applied_sequences(key, sources):
+    """Last sequence applied to an aggregate item, per source"""
+    names = {f"#source{index}": source for index, source in enumerate(sources)}
+    res = TABLE_URL_AGGREGATES.get_item(
+        Key={"pk": key[0], "sk": key[1]},
+        ProjectionExpression=", ".join(names),
+        ExpressionAttributeNames=names,
+        ConsistentRead=True,
+        ReturnConsumedCapacity=instrumentation.RETURN_CONSUMED_CAPACITY,
+    )
+    instrumentation.record_consumed_capacity(res)
+
+    return res.get("Item", {})
+
+
+def get_global_update(url, attributes):
+    """Transaction Update adding the url variations to its global total shard"""
+    names, values, additions = {}, {}, []
+
+    for index, (name, delta) in enumerate(attributes.items()):
+        names[f"#attr{index}"] = name
+        values[f":delta{index}"] = delta
+        additions.append(f"#attr{index} :delta{index}")
+
+    return {
+        "TableName": TABLE_URL_AGGREGATES.name,
+        "Key": counter_buckets.get_global_keys(url),
+        "UpdateExpression": f"ADD {', '.join(additions)}",
+        "ExpressionAttributeNames": names,
+        "ExpressionAttributeValues": values,
+    }
+
+
+def is_condition_failure(err):
+    """Whether an UpdateItem, or the first Update of a transaction, failed its condition"""
+    error = err.response["Error"]
+    if error["Code"] == "ConditionalCheckFailedException":
+        return True
+    if error["Code"] != "TransactionCanceledException":
+        return False
+
+    reasons = err.response.get("CancellationReasons") or []
+    return bool(reasons) and reasons[0].get("Code") == "ConditionalCheckFailed"
+
+
+def update_aggregate(key, attributes, sequences):
+    """ADD the variations and SET the sources last sequence, on condition that no
+    change of this batch was applied yet. Return False when the condition fails
+    Variations of an url item are added to its global total shard in a transaction"""
+    partition_key, sort_key = key
+    names, values, additions, settings, conditions = {}, {}, [], [], []
+
+    for index, (name, delta) in enumerate(attributes.items()):
+        names[f"#attr{index}"] = name
+        values[f":delta{index}"] = delta
+        additions.append(f"#attr{index} :delta{index}")
+
+    for index, (source, (first, last)) in enumerate(sequences.items()):
+        names[f"#source{index}"] = source
+        values[f":first{index}"] = first
+        values[f":last{index}"] = last
+        settings.append(f"#source{index} = :last{index}")
+        conditions.append(
+            f"(attribute_not_exists(#source{index}) OR #source{index} < :first{index})"
+        )
+
+    if partition_key.startswith("BUCKET#"):
+        fields = get_bucket_fields(partition_key, sort_key)
+        for index, (name, value) in enumerate(fields.items()):
+            names[f"#field{index}"] = name
+            values[f":field{index}"] = value
+            settings.append(f"#field{index} = :field{index}")
+
+    update = {
+        "Key": {"pk": partition_key, "sk": sort_key},
+        "UpdateExpression": f"ADD {', '.join(additions)} SET {', '.join(settings)}",
+        "ConditionExpression": " AND ".join(conditions),
+        "ExpressionAttributeNames": names,
+        "ExpressionAttributeValues": values,
+    }
+
+    try:
+        if partition_key == "URL":
+            res = TABLE_URL_AGGREGATES.meta.client.transact_write_items(
+                TransactItems=[
+                    {"Update": {"TableName": TABLE_URL_AGGREGATES.name, **update}},
+                    {"Update": get_global_update(sort_key, attributes)},
+                ],
+                ReturnConsumedCapacity=instrumentation.RETURN_CONSUMED_CAPACITY,
+            )
+        else:
+            res = TABLE_URL_AGGREGATES.update_item(
+                **update,
+                ReturnConsumedCapacity=instrumentation.RETURN_CONSUMED_CAPACITY,
+            )
+    except ClientError as err:
+        if not is_condition_failure(err):
+            raise
+        return False
+
+    instrumentation.record_consumed_capacity(res)
+    return True
+
+
+def write_aggregates(aggregates):
+    """Apply merged variations, one conditional UpdateItem ADD per aggregate item.
+    Items already holding some changes of a retried batch are read, and updated with
+    the other changes only"""
+    for key, changes in aggregates.items():
+        applied = {}
+
+        while True:
+            attributes, sequences = sum_changes(changes, applied)
+            attributes = {name: delta for name, delta in attributes.items() if delta}
+            if not attributes or update_aggregate(key, attributes, sequences):
+                break
+
+            instrumentation.put_metric("AggregatesRetriedChanges", 1)
+            applied = get_applied_sequences(key, list(sequences))
+
+
+@instrumentation.instrumented
+def lambda_handler(event, _):
+    """DynamoDB Stream Handler"""
+    records = event.get("Records", [])
+    instrumentation.log("INFO", "stream batch", records=len(records))
+
+    aggregates = merge_deltas(records)
+    write_aggregates(aggregates)
+
+    return {"aggregates": len(aggregates)}
@@ -17,13 +17,189 @@
 """
 from __future__ import print_function
 
+import os
 import re
+import json
+import time
+from collections import OrderedDict
+
+from lambdas_shared import instrumentation
+
+# JWT mode, tokens are verified against the signing keys of a JWKS
+# Set JWKS_URL or an inline JWKS, without any of them the static token check is kept
+JWKS_URL = os.environ.get("JWKS_URL")
+JWKS = os.environ.get("JWKS")
+JWT_ENABLED = bool(JWKS_URL or JWKS)
+JWT_ISSUER = os.environ.get("JWT_ISSUER") or None
+JWT_AUDIENCE = os.environ.get("JWT_AUDIENCE") or None
+JWT_ALGORITHMS = os.environ.get("JWT_ALGORITHMS", "RS256").split(",")
+# Key set is reloaded after JWKS_MAX_AGE seconds, and on unknown key ids but at most
+# once every JWKS_MIN_REFRESH seconds
+JWKS_MAX_AGE = float(os.environ.get("JWKS_MAX_AGE", "3600"))
+JWKS_MIN_REFRESH = float(os.environ.get("JWKS_MIN_REFRESH", "60"))
+CLAIMS_CACHE_SIZE = int(os.environ.get("CLAIMS_CACHE_SIZE", "1024"))
+# HTTP APIs authorizers have no validation regex, malformed tokens are rejected here
+AUTH_TOKEN_PATTERN = os.environ.get("AUTH_TOKEN_PATTERN")
+
+if JWT_ENABLED:
+    # Shipped in the jwt layer, only loaded when needed to keep cold starts short
+    import urllib.request
+    import jwt  # pylint: disable=import-error
+
+
+class SigningKeys:
+    """Signing keys of the key set, loaded once per container.
+    An unknown key id reloads the key set so rotated keys are found, but it is
+    remembered as missing until the next allowed reload: forged key ids can't make
+    every request fetch the key set."""
+
+    def __init__(self, load_key_set, max_age, min_refresh):
+        self.load_key_set = load_key_set
+        self.max_age = max_age
+        self.min_refresh = min_refresh
+        self.keys = {}
+        self.missing = {}
+        self.loaded_at = None
+
+    def refresh(self, now):
+        """Reload the key set"""
+        self.keys = self.load_key_set()
+        self.missing = {}
+        self.loaded_at = now
+
+    def get(self, kid):
+        """Return the key of kid, None if the key set doesn't have it"""
+        now = time.monotonic()
+
+        if self.loaded_at is None or now - self.loaded_at > self.max_age:
+            self.refresh(now)
+
+        if kid in self.keys:
+            return self.keys[kid]
+        if self.missing.get(kid, 0) > now:
+            return None
+
+        if now - self.loaded_at >= self.min_refresh:
+            self.refresh(now)
+            if kid in self.keys:
+                return self.keys[kid]
+
+        if len(self.missing) >= 1024:
+            self.missing = {}
+        self.missing[kid] = self.loaded_at + self.min_refresh
+        return None
+
+
+def load_key_set():
+    """Return the signing keys of the configured JWKS by key id"""
+    if JWKS:
+        key_set = json.loads(JWKS)
+    else:
+        with urllib.request.urlopen(JWKS_URL, timeout=3) as res:
+            key_set = json.loads(res.read())
+
+    return {
+        jwk["kid"]: jwt.PyJWK(jwk).key
+        for jwk in key_set["keys"]
+        if jwk.get("use", "sig") == "sig"
+    }
+
+
+SIGNING_KEYS = SigningKeys(load_key_set, JWKS_MAX_AGE, JWKS_MIN_REFRESH)
+
+# Verified claims by token, kept until the token expires
+CLAIMS_CACHE = OrderedDict()
+
+
+def verify_token(token):
+    """Return the claims of a valid signed JWT, raise Exception('Unauthorized') otherwise"""
+    if token.startswith("Bearer "):
+        token = token[len("Bearer ") :]
+
+    cached = CLAIMS_CACHE.get(token)
+    if cached and cached["exp"] > time.time():
+        CLAIMS_CACHE.move_to_end(token)
+        return cached
+
+    try:
+        key = SIGNING_KEYS.get(jwt.get_unverified_header(token).get("kid"))
+        if key is None:
+            raise jwt.InvalidKeyError("Unknown key id")
+
+        claims = jwt.decode(
+            token,
+            key,
+            algorithms=JWT_ALGORITHMS,
+            audience=JWT_AUDIENCE,
+            issuer=JWT_ISSUER,
+            options={"require": ["exp", "sub"], "verify_aud": bool(JWT_AUDIENCE)},
+        )
+
+    except jwt.PyJWTError as err:
+        instrumentation.log("WARNING", "invalid token", error=str(err))
+        # pylint: disable=broad-exception-raised,raise-missing-from
+        raise Exception("Unauthorized")
+
+    CLAIMS_CACHE[token] = claims
+    while len(CLAIMS_CACHE) > CLAIMS_CACHE_SIZE:
+        CLAIMS_CACHE.popitem(last=False)
+
+    return claims
+
+
+# Built policies kept by the container, keyed by principal, account, region, api & stage
+# They only depend on those, so warm invocations skip AuthPolicy entirely
+POLICIES_CACHE = OrderedDict()
+POLICIES_CACHE_SIZE = int(os.environ.get("POLICIES_CACHE_SIZE", "128"))
+
+
+def build_policy(principal_id, aws_account_id, region, rest_api_id, stage):
+    """Build the policy document of a principal for an API stage"""
+    policy = AuthPolicy(principal_id, aws_account_id)
+    policy.rest_api_id = rest_api_id
+    policy.region = region
+    policy.stage = stage
+    # policy.deny_all_methods()
+    policy.allow_method(HttpVerb.GET, "*")
+    policy.allow_method(HttpVerb.POST, "*")
+    # policy.allow_method(HttpVerb.GET, "/pets/*")
+
+    # Finally, build the policy
+    return policy.build()
+
+
+def get_policy(*policy_key):
+    """Return the policy built for policy_key, from cache when possible"""
+    if policy_key in POLICIES_CACHE:
+        POLICIES_CACHE.move_to_end(policy_key)
+        return POLICIES_CACHE[policy_key]
+
+    policy = build_policy(*policy_key)
+
+    if POLICIES_CACHE_SIZE > 0:
+        POLICIES_CACHE[policy_key] = policy
+        while len(POLICIES_CACHE) > POLICIES_CACHE_SIZE:
+            POLICIES_CACHE.popitem(last=False)
+
+    return policy
+
 
+def get_token(event):
+    """Token of a REST API TOKEN authorizer event, or of an HTTP API REQUEST one
+    HTTP APIs send the identity sources, a string in payload 1.0, a list in 2.0"""
+    if "authorizationToken" in event:
+        return event["authorizationToken"]
 
+    identity_source = event.get("identitySource")
+    if isinstance(identity_source, list):
+        return identity_source[0] if identity_source else None
+    return identity_source
+
+
+@instrumentation.instrumented
 def lambda_handler(event, context):
-    """Do not print the auth token unless absolutely necessary"""
-    print("Request event: " + str(event))
-    print("Method ARN: " + event["methodArn"])
+    """Do not print the auth token unless absolutely necessary, sampled events
+    are logged without it"""
     # validate the incoming token
     # and produce the principal user identifier associated with the token
 
@@ -32,6 +208,11 @@ def lambda_handler(event, context):
     # 2. Decode a JWT token inline
     # 3. Lookup in a self-managed DB
     principal_id = "principalId"
+    token = get_token(event)
+    if AUTH_TOKEN_PATTERN and not re.fullmatch(AUTH_TOKEN_PATTERN, token or ""):
+        raise Exception("Unauthorized")  # pylint: disable=broad-exception-raised
+    if JWT_ENABLED:
+        principal_id = verify_token(token)["sub"]
 
     # you can send a 401 Unauthorized response to the client by failing like so:
     # raise Exception('Unauthorized')
@@ -58,17 +239,16 @@ def lambda_handler(event, context):
     api_gateway_arn_tmp = tmp[5].split("/")
     aws_account_id = tmp[4]
 
-    policy = AuthPolicy(principal_id, aws_account_id)
-    policy.rest_api_id = api_gateway_arn_tmp[0]
-    policy.region = tmp[3]
-    policy.stage = api_gateway_arn_tmp[1]
-    # policy.deny_all_methods()
-    policy.allow_method(HttpVerb.GET, "*")
-    policy.allow_method(HttpVerb.POST, "*")
-    # policy.allow_method(HttpVerb.GET, "/pets/*")
-
-    # Finally, build the policy
-    auth_response = policy.build()
+    # Shallow copy, the cached policy itself must not get this request context
+    auth_response = dict(
+        get_policy(
+            principal_id,
+            aws_account_id,
+            tmp[3],
+            api_gateway_arn_tmp[0],
+            api_gateway_arn_tmp[1],
+        )
+    )
 
     # new! -- add additional key-value pairs associated with the authenticated principal
     # these are made available by APIGW like so: $context.authorizer.<key>
@@ -111,6 +291,8 @@ class AuthPolicy:
     # The policy version used for the evaluation. This should always be '2012-10-17'
     path_regex = r"^[/.a-zA-Z0-9-\*]+$"
     # The regular expression used to validate resource paths for the policy
+    path_pattern = re.compile(path_regex)
+    # Compiled once for every policy
 
     # these are the internal lists of allowed and denied methods. These are lists
     # of objects and each object has 2 properties: A resource ARN and a nullable
@@ -155,8 +337,7 @@ class AuthPolicy:
             raise NameError(
                 "Invalid HTTP verb " + verb + ". Allowed verbs in HttpVerb class"
             )
-        resource_pattern = re.compile(self.path_regex)
-        if not resource_pattern.match(resource):
+        if not self.path_pattern.match(resource):
             raise NameError(
                 "Invalid resource path: "
                 + resource
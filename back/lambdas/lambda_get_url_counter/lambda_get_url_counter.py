@@ -1,37 +1,658 @@
 """ Lambda returning URL counter status from DDB """
 import os
-import boto3
-from boto3.dynamodb.conditions import Key
+import json
+import base64
+import time
+import queue
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from boto3.dynamodb.conditions import Attr, Key
 
+from lambdas_shared import aws, counter_buckets, events, instrumentation
 
-DDB = boto3.resource("dynamodb")
-TABLE_URL_REQUEST_COUNT = DDB.Table(os.environ.get("TABLE_URL_REQUEST_COUNT_NAME"))
+
+TABLE_URL_REQUEST_COUNT = aws.dynamodb_table(
+    os.environ.get("TABLE_URL_REQUEST_COUNT_NAME")
+)
+# Maintained from the counters table stream by lambda_aggregate_url_counters
+TABLE_URL_AGGREGATES = (
+    aws.dynamodb_table(os.environ["TABLE_URL_AGGREGATES_NAME"])
+    if os.environ.get("TABLE_URL_AGGREGATES_NAME")
+    else None
+)
+
+# Same sharding conf as lambda_request_and_increment_url_counter, ex: {"https://google.com": 10}
+URL_COUNTER_SHARDS = json.loads(os.environ.get("URL_COUNTER_SHARDS") or "{}")
+
+# Attributes summed when merging shards of a counter
+ADDITIVE_ATTRIBUTES = ("counter", "latency_ms_sum", "latency_samples")
+
+# Parallel segments used to read the whole table when no url is given
+SCAN_SEGMENTS = int(os.environ.get("SCAN_SEGMENTS", "4"))
+
+# Paginated reads, page size when no limit is given and largest one allowed
+DEFAULT_PAGE_SIZE = int(os.environ.get("DEFAULT_PAGE_SIZE", "100"))
+MAX_PAGE_SIZE = int(os.environ.get("MAX_PAGE_SIZE", "1000"))
+# Attributes a client can ask for with the fields parameter
+COUNTER_FIELDS = (
+    "url",
+    "status_code",
+    "counter",
+    "latency_ms_sum",
+    "latency_samples",
+    "last_latency_ms",
+)
+# Attributes of the aggregates items, a total and one per status class
+AGGREGATE_COUNTERS = ("counter",) + tuple(f"counter_{n}xx" for n in range(1, 6))
+
+
+class TTLCache:
+    """Bounded cache, entries expire after ttl seconds and the least recently used
+    entry is evicted when full. Lives as long as the lambda container stays warm."""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load):
+        """Return the cached value of key, calling load() on a miss"""
+        if self.ttl <= 0:
+            return load()
+
+        entry = self.entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            self.hits += 1
+            instrumentation.put_metric("CacheHits", 1)
+            self.entries.move_to_end(key)
+            return entry[1]
+
+        self.misses += 1
+        instrumentation.put_metric("CacheMisses", 1)
+        value = load()
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+        return value
+
+    def stats(self):
+        """Hit & miss counters since the container started"""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+        }
+
+
+# Counters change slowly compared to dashboards polling, CACHE_TTL_SECONDS=0 disables it
+CACHE = TTLCache(
+    max_entries=int(os.environ.get("CACHE_MAX_ENTRIES", "256")),
+    ttl=float(os.environ.get("CACHE_TTL_SECONDS", "30")),
+)
+
+
+def get_counter_keys(url):
+    """Return every partition key the url counters can be stored under"""
+    shards = int(URL_COUNTER_SHARDS.get(url, 1))
+
+    if shards <= 1:
+        return [url]
+
+    # Unsharded key is kept for counters written before the url was sharded
+    return [url] + [f"{url}#{shard}" for shard in range(shards)]
+
+
+def merge_shards(items):
+    """Sum sharded counters back into one item per url & status_code
+    Items of unsharded urls are yielded as they come, others once every item is read"""
+    merged = {}
+
+    for item in items:
+        url = item.get("shard_of", item["url"])
+
+        if url not in URL_COUNTER_SHARDS and "shard_of" not in item:
+            yield item
+            continue
+
+        key = (url, item["status_code"])
+
+        if key in merged:
+            for attribute in ADDITIVE_ATTRIBUTES:
+                if attribute in item:
+                    merged[key][attribute] = (
+                        merged[key].get(attribute, 0) + item[attribute]
+                    )
+        else:
+            merged[key] = {**item, "url": url}
+            merged[key].pop("shard_of", None)
+
+    yield from merged.values()
+
+
+def scan_segment(segment, total_segments, pages, stop, page_size=None):
+    """Read every page of one scan segment and put them in the pages queue"""
+    scan_kwargs = {
+        "Segment": segment,
+        "TotalSegments": total_segments,
+        "ReturnConsumedCapacity": instrumentation.RETURN_CONSUMED_CAPACITY,
+    }
+    if page_size:
+        scan_kwargs["Limit"] = page_size
+
+    try:
+        while not stop.is_set():
+            res = TABLE_URL_REQUEST_COUNT.scan(**scan_kwargs)
+            instrumentation.record_consumed_capacity(res)
+            put_page(pages, res["Items"], stop)
+
+            if "LastEvaluatedKey" not in res:
+                break
+            scan_kwargs["ExclusiveStartKey"] = res["LastEvaluatedKey"]
+    finally:
+        # End of segment marker, sent even on errors so the reader never waits forever
+        put_page(pages, None, stop)
+
+
+def put_page(pages, page, stop):
+    """Put a page in the bounded queue unless the reader went away"""
+    while not stop.is_set():
+        try:
+            pages.put(page, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+
+def scan_table(total_segments=None, page_size=None):
+    """Parallel segmented scan following every LastEvaluatedKey
+    Items are yielded as soon as their page is read, in no particular order"""
+    total_segments = total_segments or SCAN_SEGMENTS
+    # Bounded so segments don't read the whole table in memory ahead of the reader
+    pages = queue.Queue(maxsize=2 * total_segments)
+    stop = threading.Event()
+
+    with ThreadPoolExecutor(max_workers=total_segments) as executor:
+        futures = [
+            executor.submit(
+                scan_segment, segment, total_segments, pages, stop, page_size
+            )
+            for segment in range(total_segments)
+        ]
+
+        try:
+            running = total_segments
+            while running:
+                page = pages.get()
+                if page is None:
+                    running -= 1
+                    continue
+                yield from page
+        finally:
+            stop.set()
+
+        # Raise segments errors, if any
+        for future in futures:
+            future.result()
 
 
 def get_table_data(url):
-    """Query data from DynamoDB"""
+    """Query data from DynamoDB, read the whole table when no url is given
+    The whole table is streamed by scan_table but the response, a single list, still
+    holds every counter: large tables are read by pages with limit & cursor"""
+    if url:
+        items = []
+        for counter_key in get_counter_keys(url):
+            res = TABLE_URL_REQUEST_COUNT.query(
+                KeyConditionExpression=Key("url").eq(counter_key),
+                ReturnConsumedCapacity=instrumentation.RETURN_CONSUMED_CAPACITY,
+            )
+            instrumentation.record_consumed_capacity(res)
+            items.extend(res["Items"])
+        return list(merge_shards(items))
+    return list(merge_shards(scan_table()))
+
+
+def encode_cursor(key):
+    """Opaque cursor of a LastEvaluatedKey, None on the last page"""
+    if key is None:
+        return None
+
+    payload = json.dumps(key, default=events.to_json, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """LastEvaluatedKey of a cursor"""
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError as err:
+        raise ValueError("Invalid cursor") from err
+
+    if not isinstance(key, dict) or "status_code" not in key:
+        raise ValueError("Invalid cursor")
+    return key
+
+
+def get_page_options(querystring):
+    """Page size, start key, fields & read consistency of the query parameters"""
+    limit = int(querystring.get("limit") or DEFAULT_PAGE_SIZE)
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+
+    fields = [field for field in (querystring.get("fields") or "").split(",") if field]
+    unknown = sorted(set(fields) - set(COUNTER_FIELDS))
+    if unknown:
+        raise ValueError(
+            f"Unknown fields {', '.join(unknown)}, use {', '.join(COUNTER_FIELDS)}"
+        )
+
+    return {
+        "limit": limit,
+        "start_key": decode_cursor(querystring["cursor"])
+        if querystring.get("cursor")
+        else None,
+        "fields": fields,
+        "consistent": (querystring.get("consistent") or "").lower() in ("true", "1"),
+    }
+
+
+def get_projection(fields):
+    """ProjectionExpression of fields, with the attributes shards merge needs"""
+    if not fields:
+        return {}
+
+    names = {
+        f"#field{index}": name
+        for index, name in enumerate(
+            sorted({*fields, "url", "status_code", "shard_of"})
+        )
+    }
+    return {
+        "ProjectionExpression": ", ".join(names),
+        "ExpressionAttributeNames": names,
+    }
+
+
+def get_shards_items(url, status_code, consistent=False, fields=None):
+    """Counters of every shard of an url & status code, in get_counter_keys order"""
+    counter_keys = get_counter_keys(url)
+    request = {
+        TABLE_URL_REQUEST_COUNT.name: {
+            "Keys": [
+                {"url": counter_key, "status_code": status_code}
+                for counter_key in counter_keys
+            ],
+            "ConsistentRead": consistent,
+            **get_projection(fields),
+        }
+    }
+
+    items = []
+    while request:
+        res = TABLE_URL_REQUEST_COUNT.meta.client.batch_get_item(
+            RequestItems=request,
+            ReturnConsumedCapacity=instrumentation.RETURN_CONSUMED_CAPACITY,
+        )
+        instrumentation.record_consumed_capacity(res)
+        items.extend(res["Responses"].get(TABLE_URL_REQUEST_COUNT.name, []))
+        request = res.get("UnprocessedKeys")
+
+    return sorted(items, key=lambda item: counter_keys.index(item["url"]))
+
+
+def complete_shards(items, consistent=False, fields=None):
+    """Whole table page items, sharded counters summed over every shard. Shards are
+    spread over the table: a sharded url & status code is read on all its shards and
+    returned once, on the page scanning its first existing shard. Shards of urls not in
+    URL_COUNTER_SHARDS anymore can't be listed, they come per shard with "partial" set"""
+    for item in items:
+        url = item.get("shard_of", item["url"])
+
+        if url not in URL_COUNTER_SHARDS:
+            if "shard_of" in item:
+                item = {**item, "url": url, "partial": True}
+                item.pop("shard_of")
+            yield item
+            continue
+
+        shards = get_shards_items(url, item["status_code"], consistent, fields)
+        if shards and shards[0]["url"] == item["url"]:
+            yield from merge_shards(shards)
+
+
+# pylint: disable=too-many-arguments
+def get_table_page(url, limit, start_key=None, fields=None, consistent=False):
+    """One page of counters and the LastEvaluatedKey to continue from, None on the
+    last page. Pages of an url are ordered by status code, sharded counters being
+    queried on every shard from the same status code and merged. Whole table pages
+    are a single Scan page, see complete_shards for sharded counters: a page can have
+    less items than the limit."""
+    read_kwargs = {
+        "Limit": limit,
+        "ConsistentRead": consistent,
+        "ReturnConsumedCapacity": instrumentation.RETURN_CONSUMED_CAPACITY,
+        **get_projection(fields),
+    }
+
     if url:
-        return TABLE_URL_REQUEST_COUNT.query(
-            KeyConditionExpression=Key("url").eq(url),
-        )["Items"]
-    return TABLE_URL_REQUEST_COUNT.scan()["Items"]
+        items = []
+        more = False
+        for counter_key in get_counter_keys(url):
+            query_kwargs = {
+                **read_kwargs,
+                "KeyConditionExpression": Key("url").eq(counter_key),
+            }
+            if start_key:
+                query_kwargs["ExclusiveStartKey"] = {
+                    "url": counter_key,
+                    "status_code": start_key["status_code"],
+                }
+            res = TABLE_URL_REQUEST_COUNT.query(**query_kwargs)
+            instrumentation.record_consumed_capacity(res)
+            items.extend(res["Items"])
+            more = more or "LastEvaluatedKey" in res
+
+        merged = sorted(merge_shards(items), key=lambda item: item["status_code"])
+        page = merged[:limit]
+        last_key = (
+            {"url": url, "status_code": page[-1]["status_code"]}
+            if page and (more or len(merged) > limit)
+            else None
+        )
+    else:
+        if start_key:
+            read_kwargs["ExclusiveStartKey"] = start_key
+        res = TABLE_URL_REQUEST_COUNT.scan(**read_kwargs)
+        instrumentation.record_consumed_capacity(res)
+        page = list(complete_shards(res["Items"], consistent, fields))
+        last_key = res.get("LastEvaluatedKey")
+
+    # Counters keep their key, pages are read from it
+    if fields:
+        kept = {"url", "status_code", "partial", *fields}
+        page = [
+            {name: value for name, value in item.items() if name in kept}
+            for item in page
+        ]
+    return page, last_key
+
+
+def get_page_data(url, querystring):
+    """Paginated counters, {"items": [...], "next_cursor": "..."}"""
+    options = get_page_options(querystring)
+
+    def load():
+        items, last_key = get_table_page(url, **options)
+        return {"items": items, "next_cursor": encode_cursor(last_key)}
+
+    # Cached pages could be older than a consistent read
+    if options["consistent"]:
+        return load()
+    return CACHE.get(
+        (
+            "page",
+            url,
+            options["limit"],
+            querystring.get("cursor"),
+            tuple(options["fields"]),
+        ),
+        load,
+    )
+
+
+def format_aggregate(item):
+    """Replace aggregates table keys by the url the counters belong to, counters only"""
+    counters = {
+        name: value for name, value in item.items() if name.startswith("counter")
+    }
+    counters["url"] = item["sk"]
+
+    return counters
+
+
+def sum_aggregates(items):
+    """Totals of every url"""
+    totals = {}
+    for item in items:
+        for name, value in item.items():
+            if name.startswith("counter"):
+                totals[name] = totals.get(name, 0) + value
+
+    return totals
+
+
+def query_pages(table, **query_kwargs):
+    """Every item of a Query, following LastEvaluatedKey"""
+    query_kwargs["ReturnConsumedCapacity"] = instrumentation.RETURN_CONSUMED_CAPACITY
+
+    while True:
+        res = table.query(**query_kwargs)
+        instrumentation.record_consumed_capacity(res)
+        yield from res["Items"]
+
+        if "LastEvaluatedKey" not in res:
+            return
+        query_kwargs["ExclusiveStartKey"] = res["LastEvaluatedKey"]
+
+
+def get_global_totals():
+    """Global total shards, read with a BatchGetItem"""
+    request = {
+        TABLE_URL_AGGREGATES.name: {
+            "Keys": counter_buckets.get_global_keys(),
+            "ProjectionExpression": ", ".join(
+                f"#counter{index}" for index in range(len(AGGREGATE_COUNTERS))
+            ),
+            "ExpressionAttributeNames": {
+                f"#counter{index}": name
+                for index, name in enumerate(AGGREGATE_COUNTERS)
+            },
+        }
+    }
+
+    while request:
+        res = TABLE_URL_AGGREGATES.meta.client.batch_get_item(
+            RequestItems=request,
+            ReturnConsumedCapacity=instrumentation.RETURN_CONSUMED_CAPACITY,
+        )
+        instrumentation.record_consumed_capacity(res)
+        yield from res["Responses"].get(TABLE_URL_AGGREGATES.name, [])
+        request = res.get("UnprocessedKeys")
 
 
+def get_summary_data(summary, url):
+    """Read counters summaries from the aggregates table, with a GetItem or a Query
+    - summary=global: totals of every url, summed over the global total shards
+    - summary=urls: totals of each url, or of the given url only
+    - summary=<n>xx: urls having <n>xx status codes, or the given url only"""
+    if summary == "global":
+        totals = sum_aggregates(get_global_totals())
+        return [totals] if totals else []
+    if summary == "urls":
+        partition_key, sort_key = "URL", url
+    elif len(summary) == 3 and summary.endswith("xx"):
+        partition_key, sort_key = f"CLASS#{summary}", url
+    else:
+        raise ValueError(f"Unknown summary {summary}, use global, urls or <n>xx")
+
+    if sort_key:
+        res = TABLE_URL_AGGREGATES.get_item(
+            Key={"pk": partition_key, "sk": sort_key},
+            ReturnConsumedCapacity=instrumentation.RETURN_CONSUMED_CAPACITY,
+        )
+        instrumentation.record_consumed_capacity(res)
+        item = res.get("Item")
+        return [format_aggregate(item)] if item else []
+
+    return [
+        format_aggregate(item)
+        for item in query_pages(
+            TABLE_URL_AGGREGATES, KeyConditionExpression=Key("pk").eq(partition_key)
+        )
+    ]
+
+
+def parse_datetime(value):
+    """ISO 8601 datetime, UTC unless it has an offset"""
+    moment = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+
+def get_bucket_range(querystring):
+    """First & last hourly buckets of the from, to & hours query parameters
+    from & to are ISO 8601 datetimes, hours is counted back from to, or from now"""
+    end = (
+        parse_datetime(querystring["to"])
+        if querystring.get("to")
+        else datetime.now(timezone.utc)
+    )
+    if querystring.get("from"):
+        start = parse_datetime(querystring["from"])
+    else:
+        start = end - timedelta(hours=int(querystring.get("hours") or 24) - 1)
+
+    if start > end:
+        raise ValueError("from must be before to")
+
+    return counter_buckets.get_bucket(start), counter_buckets.get_bucket(end)
+
+
+def parse_status(status):
+    """Status class and status code of a status parameter, ex: 5xx or 503"""
+    if len(status) != 3 or status[0] not in "12345":
+        raise ValueError(f"Unknown status {status}, use <n>xx or a status code")
+    if status.endswith("xx"):
+        return status, None
+    if not status.isdigit():
+        raise ValueError(f"Unknown status {status}, use <n>xx or a status code")
+    return counter_buckets.get_status_class(status), int(status)
+
+
+def get_url_buckets(url, first_bucket, last_bucket, status=None):
+    """Hourly counters of an url between two buckets, one Query on its partition"""
+    status_class, status_code = parse_status(status) if status else (None, None)
+    low, high = counter_buckets.get_sort_key_range(first_bucket, last_bucket)
+
+    items = query_pages(
+        TABLE_URL_AGGREGATES,
+        KeyConditionExpression=Key("pk").eq(f"BUCKET#{url}")
+        & Key("sk").between(low, high),
+    )
+
+    return [
+        {
+            "url": url,
+            "bucket": item["bucket"],
+            "status_code": item["status_code"],
+            "counter": item["counter"],
+        }
+        for item in items
+        if (
+            not status_class
+            or counter_buckets.get_status_class(item["status_code"]) == status_class
+        )
+        and (not status_code or item["status_code"] == status_code)
+    ]
+
+
+def get_status_buckets(status, first_bucket, last_bucket):
+    """Counters of the urls having a status class or code between two buckets, summed
+    per url & status code, biggest first. One Query per status-bucket index shard"""
+    status_class, status_code = parse_status(status)
+    query_kwargs = {"IndexName": counter_buckets.STATUS_INDEX_NAME}
+    if status_code:
+        query_kwargs["FilterExpression"] = Attr("status_code").eq(status_code)
+
+    def query_shard(shard):
+        return list(
+            query_pages(
+                TABLE_URL_AGGREGATES,
+                KeyConditionExpression=Key("status_shard").eq(f"{status_class}#{shard}")
+                & Key("bucket").between(first_bucket, last_bucket),
+                **query_kwargs,
+            )
+        )
+
+    counters = {}
+    with ThreadPoolExecutor(
+        max_workers=counter_buckets.STATUS_INDEX_SHARDS
+    ) as executor:
+        for items in executor.map(
+            query_shard, range(counter_buckets.STATUS_INDEX_SHARDS)
+        ):
+            for item in items:
+                key = (item["url"], item["status_code"])
+                counters[key] = counters.get(key, 0) + item["counter"]
+
+    return [
+        {"url": url, "status_code": status_code, "counter": counter}
+        for (url, status_code), counter in sorted(
+            counters.items(), key=lambda entry: (-entry[1], entry[0])
+        )
+    ]
+
+
+def get_bucket_data(querystring):
+    """Counters over a time range, of an url or of every url having a status"""
+    url = querystring.get("url")
+    status = querystring.get("status")
+    first_bucket, last_bucket = get_bucket_range(querystring)
+
+    if url:
+        return CACHE.get(
+            ("buckets", url, status, first_bucket, last_bucket),
+            lambda: get_url_buckets(url, first_bucket, last_bucket, status),
+        )
+    if status:
+        return CACHE.get(
+            ("buckets", None, status, first_bucket, last_bucket),
+            lambda: get_status_buckets(status, first_bucket, last_bucket),
+        )
+    raise ValueError("Time range queries need an url or a status")
+
+
+@instrumentation.instrumented
 def lambda_handler(event, _):
     """Lambda Handler"""
-    print(f"Lambda handler: {event}")
-
-    url = None
 
-    if "params" in event:
-        if "querystring" in event["params"]:
-            if "url" in event["params"]["querystring"]:
-                url = event["params"]["querystring"]["url"]
+    querystring = events.get_querystring(event)
+    url = querystring.get("url")
+    summary = querystring.get("summary")
 
     try:
-        return get_table_data(url)
+        if TABLE_URL_AGGREGATES and any(
+            querystring.get(name) for name in ["status", "from", "to", "hours"]
+        ):
+            return events.respond(event, get_bucket_data(querystring))
+        if any(
+            querystring.get(name)
+            for name in ["limit", "cursor", "fields", "consistent"]
+        ):
+            return events.respond(event, get_page_data(url, querystring))
+        if summary and TABLE_URL_AGGREGATES:
+            return events.respond(
+                event,
+                CACHE.get(
+                    ("summary", summary, url), lambda: get_summary_data(summary, url)
+                ),
+            )
+        return events.respond(
+            event, CACHE.get(("counters", url), lambda: get_table_data(url))
+        )
 
     # pylint: disable=broad-except
     except Exception as err:
-        print(err)
+        instrumentation.log("ERROR", "read failed", url=url, error=str(err))
+        if events.is_proxy_event(event):
+            return events.respond(event, {"message": str(err)}, 500)
         return err
+
+    finally:
+        instrumentation.put_metric("CacheEntries", len(CACHE.entries))
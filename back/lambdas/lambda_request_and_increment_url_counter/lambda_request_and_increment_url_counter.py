@@ -1,61 +1,447 @@
 """
     Example lambda which is pinging an url and stores the returned status_code in
     a DynamoDB table
+
+    When PROBE_QUEUE_URL is set, lambda_handler only enqueues the url and batch_handler,
+    plugged on the SQS queue, runs the probes and writes the counters.
+
+    A list of urls can be sent in "body-json" as {"urls": [...]} to probe them all at once.
+
+    Probes reuse a pooled session across warm invocations, try HEAD before GET and never
+    download the body. Time to first byte is stored along the counter:
+    latency_ms_sum / latency_samples gives the average, last_latency_ms the latest one.
 """
 
 import os
+import json
+import time
+import random
+import threading
+from decimal import Decimal
+from collections import deque, namedtuple
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
 
-import boto3
+from lambdas_shared import aws, events, instrumentation
 
-from boto3.dynamodb.conditions import Key
 
+TABLE_URL_REQUEST_COUNT = aws.dynamodb_table(
+    os.environ.get("TABLE_URL_REQUEST_COUNT_NAME")
+)
 
-DDB = boto3.resource("dynamodb")
-TABLE_URL_REQUEST_COUNT = DDB.Table(os.environ.get("TABLE_URL_REQUEST_COUNT_NAME"))
+# Hot urls can spread their counters over N partition keys ("<url>#<shard>") to avoid
+# throttling on a single partition, ex: {"https://google.com": 10}
+# Must be the same for lambda_get_url_counter which sums shards back on read
+URL_COUNTER_SHARDS = json.loads(os.environ.get("URL_COUNTER_SHARDS") or "{}")
 
+# Async mode, only set when the stack is deployed with URL_COUNTER_ASYNC
+PROBE_QUEUE_URL = os.environ.get("PROBE_QUEUE_URL")
+SQS = aws.client("sqs") if PROBE_QUEUE_URL else None
 
-def get_table_data(url, status_code):
-    """Query data from DynamoDB"""
-    return TABLE_URL_REQUEST_COUNT.query(
-        KeyConditionExpression=Key("url").eq(url) & Key("status_code").eq(status_code)
-    )["Items"]
+# Max probes running at the same time in a batch, and on the same host
+PROBE_CONCURRENCY = int(os.environ.get("PROBE_CONCURRENCY", "16"))
+PROBE_PER_HOST_CONCURRENCY = int(os.environ.get("PROBE_PER_HOST_CONCURRENCY", "4"))
 
+# Probes timeouts, in seconds
+PROBE_CONNECT_TIMEOUT = float(os.environ.get("PROBE_CONNECT_TIMEOUT", "3.05"))
+PROBE_READ_TIMEOUT = float(os.environ.get("PROBE_READ_TIMEOUT", "10"))
+# HEAD first saves the body transfer, GET is used when HEAD is not allowed
+PROBE_HEAD_FIRST = os.environ.get("PROBE_HEAD_FIRST", "true").lower() == "true"
+HEAD_NOT_ALLOWED_STATUS_CODES = (405, 501)
 
-def write_table_data(item):
-    """Write data in DynamoDB"""
-    TABLE_URL_REQUEST_COUNT.put_item(Item=item)
+# Created once per container, keeps connections alive between warm invocations
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_maxsize=PROBE_CONCURRENCY))
+SESSION.mount("https://", HTTPAdapter(pool_maxsize=PROBE_CONCURRENCY))
 
+ProbeResult = namedtuple("ProbeResult", ["status_code", "latency_ms"])
 
-def increment_status_code_counter(url, status_code):
-    """Get data, increment counter in DynamoDB and return it"""
-    status_table_data = get_table_data(url, status_code)
+# Max urls accepted in a single request
+BATCH_MAX_URLS = int(os.environ.get("BATCH_MAX_URLS", "500"))
+# Time kept before the lambda timeout to write counters and answer
+DEADLINE_MARGIN_SECONDS = float(os.environ.get("DEADLINE_MARGIN_SECONDS", "2"))
 
-    if status_table_data:
-        status_table_data[0]["counter"] += 1
-    else:
-        status_table_data.append({"url": url, "status_code": status_code, "counter": 1})
 
-    write_table_data(status_table_data[0])
+def get_counter_key(url):
+    """Return the partition key to write the url counter to, and its shard if any"""
+    shards = int(URL_COUNTER_SHARDS.get(url, 1))
 
-    return status_table_data[0]
+    if shards <= 1:
+        return url, None
 
+    shard = random.randrange(shards)
+    return f"{url}#{shard}", shard
 
-def lambda_handler(event, _):
-    """Lambda Handler, default lambda executed function"""
-    print(f"Lambda handler: {event}")
 
-    url = "https://google.comz"
+def increment_status_code_counter(url, status_code, increment=1, latencies=None):
+    """Atomically increment counter in DynamoDB with a single UpdateItem and return it
+    latencies are the time to first byte in ms of the probes, if they got an answer"""
+    counter_key, shard = get_counter_key(url)
+
+    additions = ["#counter :increment"]
+    updates = []
+    expression_attribute_names = {"#counter": "counter"}
+    expression_attribute_values = {":increment": increment}
+
+    if latencies:
+        additions.append("#latency_ms_sum :latency_ms_sum")
+        additions.append("#latency_samples :latency_samples")
+        updates.append("#last_latency_ms = :last_latency_ms")
+        expression_attribute_names.update(
+            {
+                "#latency_ms_sum": "latency_ms_sum",
+                "#latency_samples": "latency_samples",
+                "#last_latency_ms": "last_latency_ms",
+            }
+        )
+        expression_attribute_values.update(
+            {
+                ":latency_ms_sum": to_decimal(sum(latencies)),
+                ":latency_samples": len(latencies),
+                ":last_latency_ms": to_decimal(latencies[-1]),
+            }
+        )
+
+    if shard is not None:
+        # Keep track of the original url so scans can merge shards back together
+        updates.append("#shard_of = :url")
+        expression_attribute_names["#shard_of"] = "shard_of"
+        expression_attribute_values[":url"] = url
+
+    update_expression = "ADD " + ", ".join(additions)
+    if updates:
+        update_expression += " SET " + ", ".join(updates)
+
+    res = TABLE_URL_REQUEST_COUNT.update_item(
+        Key={"url": counter_key, "status_code": status_code},
+        UpdateExpression=update_expression,
+        ExpressionAttributeNames=expression_attribute_names,
+        ExpressionAttributeValues=expression_attribute_values,
+        ReturnValues="UPDATED_NEW",
+        ReturnConsumedCapacity=instrumentation.RETURN_CONSUMED_CAPACITY,
+    )
+    instrumentation.record_consumed_capacity(res)
+
+    item = {
+        "url": url,
+        "status_code": status_code,
+        "counter": res["Attributes"]["counter"],
+    }
+    if latencies:
+        item["latency_ms"] = to_decimal(latencies[-1])
+    if shard is not None:
+        # Counter value is the shard's one, not the url total
+        item["shard"] = shard
+
+    return item
+
+
+def to_decimal(value):
+    """DynamoDB refuses floats, round them as Decimal"""
+    return Decimal(str(round(value, 3)))
+
+
+def request_without_body(method, url, timeout):
+    """Send the request and close it as soon as headers are received"""
+    with SESSION.request(method, url, timeout=timeout, stream=True) as res:
+        # elapsed stops once headers are parsed, before any body byte is read
+        elapsed = sum(
+            (hop.elapsed for hop in res.history), start=res.elapsed
+        ).total_seconds()
+        return ProbeResult(res.status_code, elapsed * 1000)
+
 
-    if "body-json" in event:
-        if "url" in event["body-json"]:
-            url = event["body-json"]["url"]
+def get_probe_timeouts(deadline=None):
+    """Connect & read timeouts of a request, within the time left before the deadline"""
+    if deadline is None:
+        return PROBE_CONNECT_TIMEOUT, PROBE_READ_TIMEOUT
 
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise requests.Timeout("deadline exceeded")
+    return min(PROBE_CONNECT_TIMEOUT, remaining), min(PROBE_READ_TIMEOUT, remaining)
+
+
+def probe_url(url, deadline=None):
+    """Request the url and return its status_code and time to first byte,
+    (500, None) if it can't be reached
+    With a deadline (time.monotonic() based), HEAD and GET share the time left, and
+    hitting it raises requests.Timeout instead"""
     try:
-        res = requests.get(url)
-        return increment_status_code_counter(url, res.status_code)
+        if PROBE_HEAD_FIRST:
+            # Follow redirects like GET does, status_code is the final one
+            result = request_without_body(
+                "HEAD", url, timeout=get_probe_timeouts(deadline)
+            )
+            if result.status_code not in HEAD_NOT_ALLOWED_STATUS_CODES:
+                return result
+
+        return request_without_body("GET", url, timeout=get_probe_timeouts(deadline))
 
     # pylint: disable=broad-except
     except Exception as err:
-        print(err)
-        return increment_status_code_counter(url, 500)
+        if deadline is not None and (
+            isinstance(err, requests.Timeout) or time.monotonic() >= deadline
+        ):
+            raise requests.Timeout("deadline exceeded") from err
+        instrumentation.log("WARNING", "probe failed", url=url, error=str(err))
+        return ProbeResult(500, None)
+
+
+def put_probe_metrics(result):
+    """Latency of a probe, or an error when the url couldn't be reached"""
+    if result.latency_ms is None:
+        instrumentation.put_metric("ProbeErrors", 1)
+    else:
+        instrumentation.put_metric("ProbeLatency", result.latency_ms, "Milliseconds")
+
+
+def probe_url_before(url, deadline):
+    """Probe the url, None if the deadline is hit"""
+    try:
+        result = probe_url(url, deadline=deadline)
+
+    except requests.Timeout:
+        return None
+
+    # probe_urls doesn't wait for late probes, their result is dropped
+    return result if time.monotonic() < deadline else None
+
+
+def probe_urls(urls, deadline):
+    """Probe urls concurrently, return their ProbeResult in the same order
+    Probes not done before the deadline (time.monotonic() based) are None
+    A host has at most PROBE_PER_HOST_CONCURRENCY probes submitted at once, its next
+    url is submitted when one of them is done: workers never wait on a busy host
+    while urls of other hosts are queued behind"""
+    executor = ThreadPoolExecutor(max_workers=PROBE_CONCURRENCY)
+    hosts_queues = {}
+    for index, url in enumerate(urls):
+        hosts_queues.setdefault(urlparse(url).netloc, deque()).append(index)
+
+    futures = {}
+    # Reentrant: callbacks of futures already done run in the submitting thread
+    lock = threading.RLock()
+    all_done = threading.Event()
+    state = {"done": 0, "closed": False}
+
+    def submit(index):
+        future = executor.submit(probe_url_before, urls[index], deadline)
+        futures[index] = future
+        future.add_done_callback(lambda _: on_done(urlparse(urls[index]).netloc))
+
+    def on_done(host):
+        with lock:
+            if state["closed"]:
+                return
+            state["done"] += 1
+            if hosts_queues[host]:
+                submit(hosts_queues[host].popleft())
+            if state["done"] == len(urls):
+                all_done.set()
+
+    with lock:
+        for host_queue in hosts_queues.values():
+            for _ in range(min(PROBE_PER_HOST_CONCURRENCY, len(host_queue))):
+                submit(host_queue.popleft())
+
+    if urls:
+        all_done.wait(timeout=max(deadline - time.monotonic(), 0))
+    # Don't wait for late probes, they will give up on their own timeout. Lambda
+    # runs Python 3.8, shutdown has no cancel_futures yet: cancel pending ones here
+    with lock:
+        state["closed"] = True
+        for future in futures.values():
+            future.cancel()
+    executor.shutdown(wait=False)
+
+    results = [
+        futures[index].result()
+        if index in futures and futures[index].done() and not futures[index].cancelled()
+        else None
+        for index in range(len(urls))
+    ]
+    # Put from this thread: late probes never write in the next invocation metrics
+    for result in results:
+        if result is not None:
+            put_probe_metrics(result)
+
+    return results
+
+
+def write_increments(increments):
+    """Write merged increments, {(url, status_code): [latency_ms, ...]}, concurrently
+    Return the written items for each (url, status_code)"""
+    with ThreadPoolExecutor(max_workers=PROBE_CONCURRENCY) as executor:
+        futures = {
+            counter: executor.submit(
+                increment_status_code_counter,
+                *counter,
+                increment=len(latencies),
+                latencies=[latency for latency in latencies if latency is not None],
+            )
+            for counter, latencies in increments.items()
+        }
+        return {counter: future.result() for counter, future in futures.items()}
+
+
+def get_deadline(context):
+    """Return the time.monotonic() probes must be done by to answer before timeout"""
+    if context is None:
+        return time.monotonic() + 60
+
+    return (
+        time.monotonic()
+        + context.get_remaining_time_in_millis() / 1000
+        - DEADLINE_MARGIN_SECONDS
+    )
+
+
+def enqueue_probes(urls):
+    """Send urls to the probes queue, batch_handler will take care of them"""
+    results = []
+
+    # SendMessageBatch accepts 10 messages at most
+    for index in range(0, len(urls), 10):
+        chunk = urls[index : index + 10]
+        res = SQS.send_message_batch(
+            QueueUrl=PROBE_QUEUE_URL,
+            Entries=[
+                {"Id": str(entry_id), "MessageBody": json.dumps({"url": url})}
+                for entry_id, url in enumerate(chunk)
+            ],
+        )
+
+        for success in res.get("Successful", []):
+            results.append(
+                {"url": chunk[int(success["Id"])], "message_id": success["MessageId"]}
+            )
+        for failure in res.get("Failed", []):
+            results.append({"url": chunk[int(failure["Id"])], "error": failure["Code"]})
+
+    return results
+
+
+def probe_and_increment(urls, deadline):
+    """Probe urls, write one increment per (url, status_code) and return per url results"""
+    results = probe_urls(urls, deadline)
+
+    increments = {}
+    for url, result in zip(urls, results):
+        if result is not None:
+            increments.setdefault((url, result.status_code), []).append(
+                result.latency_ms
+            )
+
+    items = write_increments(increments)
+
+    return [
+        items[(url, result.status_code)]
+        if result is not None
+        else {"url": url, "error": "deadline exceeded"}
+        for url, result in zip(urls, results)
+    ]
+
+
+@instrumentation.instrumented
+def lambda_handler(event, context):
+    """Lambda Handler, default lambda executed function"""
+    url = "https://google.comz"
+    urls = None
+
+    body = events.get_body(event)
+    if "url" in body:
+        url = body["url"]
+    if "urls" in body:
+        urls = body["urls"]
+
+    # Only used by proxy integrations, template ones set it on the route
+    status_code = 202 if PROBE_QUEUE_URL else 201
+
+    if urls is not None:
+        if len(urls) > BATCH_MAX_URLS:
+            message = f"Too many urls, {BATCH_MAX_URLS} at most"
+            if events.is_proxy_event(event):
+                return events.respond(event, {"message": message}, 400)
+            raise ValueError(message)
+
+        if PROBE_QUEUE_URL:
+            return events.respond(event, {"results": enqueue_probes(urls)}, status_code)
+        return events.respond(
+            event,
+            {"results": probe_and_increment(urls, get_deadline(context))},
+            status_code,
+        )
+
+    if PROBE_QUEUE_URL:
+        return events.respond(event, enqueue_probes([url])[0], status_code)
+
+    result = probe_url(url)
+    put_probe_metrics(result)
+    return events.respond(
+        event,
+        increment_status_code_counter(
+            url,
+            result.status_code,
+            latencies=[result.latency_ms] if result.latency_ms is not None else None,
+        ),
+        status_code,
+    )
+
+
+@instrumentation.instrumented
+def batch_handler(event, context):
+    """SQS Handler, probe a batch of urls concurrently and write one increment
+    per (url, status_code) of the batch"""
+    records = event.get("Records", [])
+    instrumentation.log("INFO", "batch", records=len(records))
+
+    failures = []
+    urls = {}
+    for record in records:
+        try:
+            urls[record["messageId"]] = json.loads(record["body"])["url"]
+
+        # pylint: disable=broad-except
+        except Exception as err:
+            instrumentation.log(
+                "WARNING",
+                "invalid message",
+                message_id=record["messageId"],
+                error=str(err),
+            )
+            failures.append(record["messageId"])
+
+    results = probe_urls(list(urls.values()), get_deadline(context))
+
+    increments = {}
+    for (message_id, url), result in zip(urls.items(), results):
+        if result is None:
+            # Not probed before the deadline, let SQS deliver it again
+            failures.append(message_id)
+        else:
+            increments.setdefault((url, result.status_code), []).append(
+                (message_id, result.latency_ms)
+            )
+
+    for (url, status_code), probes in increments.items():
+        message_ids = [message_id for message_id, _ in probes]
+        try:
+            increment_status_code_counter(
+                url,
+                status_code,
+                increment=len(probes),
+                latencies=[latency for _, latency in probes if latency is not None],
+            )
+
+        # pylint: disable=broad-except
+        except Exception as err:
+            # Only retry messages of this counter, others are already written
+            instrumentation.log("ERROR", "increment failed", url=url, error=str(err))
+            failures.extend(message_ids)
+
+    return {
+        "batchItemFailures": [{"itemIdentifier": message_id} for message_id in failures]
+    }
@@ -0,0 +1 @@
+""" Code shared between lambdas, shipped as the shared layer """
@@ -0,0 +1,53 @@
+""" AWS clients & resources used by lambdas """
+
+import os
+import threading
+from functools import lru_cache
+
+import boto3
+
+
+# Build clients on first use instead of at import time, set LAZY_AWS_CLIENTS=true
+# Eager is the default: lambdas init phase runs with a full CPU whatever memory_size is
+LAZY_AWS_CLIENTS = os.environ.get("LAZY_AWS_CLIENTS", "false").lower() == "true"
+# Never set on deployed lambdas, benchmarks point them to a moto server. Passed
+# explicitly, boto3 only reads it by itself from 1.28
+ENDPOINT_URL = os.environ.get("AWS_ENDPOINT_URL") or None
+
+
+class Lazy:
+    """Proxy building its target on first attribute access"""
+
+    def __init__(self, build):
+        self._build = build
+        self._target = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if self._target is None:
+            with self._lock:
+                if self._target is None:
+                    self._target = self._build()
+
+        return getattr(self._target, name)
+
+
+def build(builder):
+    """Call builder now, or on first use when clients are lazy"""
+    return Lazy(builder) if LAZY_AWS_CLIENTS else builder()
+
+
+@lru_cache(maxsize=None)
+def get_resource(service):
+    """One resource per service and container"""
+    return boto3.resource(service, endpoint_url=ENDPOINT_URL)
+
+
+def dynamodb_table(table_name):
+    """DynamoDB Table resource"""
+    return build(lambda: get_resource("dynamodb").Table(table_name))
+
+
+def client(service):
+    """boto3 client"""
+    return build(lambda: boto3.client(service, endpoint_url=ENDPOINT_URL))
@@ -0,0 +1,88 @@
+""" Hourly counter buckets layout, written by lambda_aggregate_url_counters and read by
+lambda_get_url_counter from the url-counter-aggregates table
+
+Bucket items (pk, sk): ("BUCKET#<url>", "<bucket>#<status_code>"), ex:
+("BUCKET#https://google.com", "2024-05-01T13#200"). A Query on an url partition with a
+sort key range reads its counters over a time range.
+
+The "status-bucket" index is keyed on (status_shard, bucket): status_shard is the status
+class of the counter and a shard of its url, ex: "5xx#3". Writes of a status class are
+spread over STATUS_INDEX_SHARDS index partitions, a status class time range is read with
+one Query per shard.
+
+Totals of every url are kept in GLOBAL_TOTAL_SHARDS items (pk, sk): ("GLOBAL#<shard>",
+"TOTAL"), an url counting in the shard of its hash: a fixed number of items is read
+whatever the number of urls, and writes are spread over that many partitions.
+"""
+
+import os
+import zlib
+from datetime import datetime, timedelta, timezone
+
+
+# UTC hours, sorted like strings
+BUCKET_FORMAT = "%Y-%m-%dT%H"
+BUCKET_DURATION = timedelta(hours=1)
+BUCKET_RETENTION_DAYS = int(os.environ.get("BUCKET_RETENTION_DAYS", "30"))
+STATUS_INDEX_NAME = "status-bucket"
+STATUS_INDEX_SHARDS = int(os.environ.get("STATUS_INDEX_SHARDS", "4"))
+GLOBAL_TOTAL_SHARDS = int(os.environ.get("GLOBAL_TOTAL_SHARDS", "4"))
+
+
+def get_bucket(moment):
+    """Bucket of a datetime, or of an epoch timestamp"""
+    if not isinstance(moment, datetime):
+        moment = datetime.fromtimestamp(moment, tz=timezone.utc)
+
+    return moment.astimezone(timezone.utc).strftime(BUCKET_FORMAT)
+
+
+def parse_bucket(bucket):
+    """Start of a bucket, as an UTC datetime"""
+    return datetime.strptime(bucket, BUCKET_FORMAT).replace(tzinfo=timezone.utc)
+
+
+def get_expires_at(bucket):
+    """Epoch seconds the bucket item is deleted at by the table TTL"""
+    return int(
+        (
+            parse_bucket(bucket)
+            + BUCKET_DURATION
+            + timedelta(days=BUCKET_RETENTION_DAYS)
+        ).timestamp()
+    )
+
+
+def get_status_class(status_code):
+    """Status class of a status code, ex: "5xx" """
+    return f"{int(status_code) // 100}xx"
+
+
+def get_status_shard(status_class, url):
+    """Index partition key of the url counters of a status class"""
+    return f"{status_class}#{zlib.crc32(url.encode()) % STATUS_INDEX_SHARDS}"
+
+
+def get_global_keys(url=None):
+    """Table key of the global total shard of an url, or of every shard"""
+    if url is None:
+        return [
+            {"pk": f"GLOBAL#{shard}", "sk": "TOTAL"}
+            for shard in range(GLOBAL_TOTAL_SHARDS)
+        ]
+
+    return {
+        "pk": f"GLOBAL#{zlib.crc32(url.encode()) % GLOBAL_TOTAL_SHARDS}",
+        "sk": "TOTAL",
+    }
+
+
+def get_keys(url, bucket, status_code):
+    """Table key of a bucket item"""
+    return {"pk": f"BUCKET#{url}", "sk": f"{bucket}#{int(status_code)}"}
+
+
+def get_sort_key_range(first_bucket, last_bucket):
+    """Sort keys of every status code of the buckets between first & last included"""
+    # "~" sorts after every digit
+    return f"{first_bucket}#", f"{last_bucket}#~"
@@ -0,0 +1,58 @@
+""" API Gateway events adapter, same handler code for both integration modes
+
+Template mode: the event is the default_request_template rendering, with
+"body-json" and "params", the handler result is the response body.
+Proxy mode: the event is the API Gateway proxy event, the handler returns
+statusCode, headers and a JSON string body.
+"""
+
+import json
+import base64
+from decimal import Decimal
+
+
+CORS_HEADERS = {"Access-Control-Allow-Origin": "*"}
+
+
+def is_proxy_event(event):
+    """True for lambda proxy integration events"""
+    return "requestContext" in event and "httpMethod" in event
+
+
+def get_querystring(event):
+    """Querystring parameters, single valued"""
+    if is_proxy_event(event):
+        return event.get("queryStringParameters") or {}
+    return event.get("params", {}).get("querystring", {})
+
+
+def get_body(event):
+    """JSON body, already parsed by API Gateway in template mode"""
+    if not is_proxy_event(event):
+        return event.get("body-json") or {}
+
+    body = event.get("body")
+    if not body:
+        return {}
+    if event.get("isBase64Encoded"):
+        body = base64.b64decode(body)
+    return json.loads(body)
+
+
+def to_json(value):
+    """Serialize DynamoDB numbers like the Lambda runtime does"""
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def respond(event, body, status_code=200):
+    """Handler result, the body itself in template mode"""
+    if not is_proxy_event(event):
+        return body
+
+    return {
+        "statusCode": status_code,
+        "headers": {**CORS_HEADERS, "Content-Type": "application/json"},
+        "body": json.dumps(body, default=to_json),
+    }
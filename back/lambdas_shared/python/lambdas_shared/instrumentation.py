@@ -0,0 +1,167 @@
+""" Structured JSON logs, sampled event logging and CloudWatch embedded metrics
+
+Logs and metrics are JSON lines written to stdout: CloudWatch Logs extracts metrics
+from the embedded metric format (EMF) documents, no PutMetricData call is made.
+Configured per stage by the INSTRUMENTATION conf entry, see utils_cdk.create_lambda.
+"""
+
+import os
+import json
+import time
+import random
+import functools
+import threading
+
+
+LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+LOG_LEVEL = LOG_LEVELS.get(os.environ.get("LOG_LEVEL", "INFO").upper(), 20)
+# Share of invocations logging their event, and max size of the logged event
+LOG_EVENT_SAMPLE_RATE = float(os.environ.get("LOG_EVENT_SAMPLE_RATE", "0"))
+LOG_EVENT_MAX_BYTES = int(os.environ.get("LOG_EVENT_MAX_BYTES", "1024"))
+# Never logged, whatever the sample rate
+REDACTED_KEYS = {"authorizationtoken", "identitysource", "authtoken", "authorization"}
+
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() == "true"
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "lambdas")
+FUNCTION_NAME = os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "local")
+# EMF limit of values per metric and document
+METRIC_MAX_VALUES = 100
+# DynamoDB only returns the consumed capacity when asked for
+RETURN_CONSUMED_CAPACITY = "TOTAL" if METRICS_ENABLED else "NONE"
+
+COLD_START = True
+REQUEST = {"request_id": None}
+# Metrics of the running invocation, {name: (unit, [values])}, batch writes add theirs
+# from worker threads
+METRICS = {}
+METRICS_LOCK = threading.Lock()
+
+
+def log(level, message, **fields):
+    """Write a JSON log line if level is enabled"""
+    if LOG_LEVELS[level] < LOG_LEVEL:
+        return
+
+    print(
+        json.dumps(
+            {
+                "level": level,
+                "message": message,
+                "function": FUNCTION_NAME,
+                "request_id": REQUEST["request_id"],
+                **fields,
+            },
+            default=str,
+        )
+    )
+
+
+def redact(value):
+    """Copy of value without credentials"""
+    if isinstance(value, dict):
+        return {
+            key: "***" if key.lower() in REDACTED_KEYS else redact(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [redact(item) for item in value]
+    return value
+
+
+def log_event(event):
+    """Log a sample of the events, truncated to LOG_EVENT_MAX_BYTES"""
+    if random.random() >= LOG_EVENT_SAMPLE_RATE:
+        return
+
+    payload = json.dumps(redact(event), default=str)
+    log(
+        "INFO",
+        "event",
+        event=payload[:LOG_EVENT_MAX_BYTES],
+        event_bytes=len(payload),
+        truncated=len(payload) > LOG_EVENT_MAX_BYTES,
+    )
+
+
+def put_metric(name, value, unit="Count"):
+    """Add a value to a metric of the running invocation"""
+    if not METRICS_ENABLED or value is None:
+        return
+
+    with METRICS_LOCK:
+        METRICS.setdefault(name, (unit, []))[1].append(value)
+
+
+def record_consumed_capacity(response):
+    """Add the capacity consumed by a DynamoDB call to DynamoDBConsumedCapacity
+    The call must be made with ReturnConsumedCapacity=RETURN_CONSUMED_CAPACITY"""
+    consumed = response.get("ConsumedCapacity")
+    if consumed is None:
+        return
+
+    for capacity in consumed if isinstance(consumed, list) else [consumed]:
+        put_metric("DynamoDBConsumedCapacity", capacity.get("CapacityUnits", 0))
+
+
+def flush_metrics():
+    """Write the invocation metrics as EMF documents, 100 values per metric at most"""
+    with METRICS_LOCK:
+        metrics = dict(METRICS)
+        METRICS.clear()
+
+    while metrics:
+        document = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": METRICS_NAMESPACE,
+                        "Dimensions": [["function"]],
+                        "Metrics": [
+                            {"Name": name, "Unit": unit}
+                            for name, (unit, _) in metrics.items()
+                        ],
+                    }
+                ],
+            },
+            "function": FUNCTION_NAME,
+        }
+        for name, (_, values) in metrics.items():
+            chunk = values[:METRIC_MAX_VALUES]
+            document[name] = chunk if len(chunk) > 1 else chunk[0]
+        print(json.dumps(document))
+
+        metrics = {
+            name: (unit, values[METRIC_MAX_VALUES:])
+            for name, (unit, values) in metrics.items()
+            if len(values) > METRIC_MAX_VALUES
+        }
+
+
+def instrumented(handler):
+    """Handler decorator: sampled event log, HandlerLatency & ColdStart metrics,
+    errors logged, metrics written at the end of each invocation"""
+
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        global COLD_START  # pylint: disable=global-statement
+        cold_start, COLD_START = COLD_START, False
+
+        REQUEST["request_id"] = getattr(context, "aws_request_id", None)
+        log_event(event)
+        if cold_start:
+            put_metric("ColdStart", 1)
+
+        start = time.perf_counter()
+        try:
+            return handler(event, context)
+        except Exception as err:
+            log("ERROR", "handler failed", error=repr(err))
+            raise
+        finally:
+            put_metric(
+                "HandlerLatency", (time.perf_counter() - start) * 1000, "Milliseconds"
+            )
+            flush_metrics()
+
+    return wrapper
@@ -0,0 +1,866 @@
+""" In-process emulator of the BackStack REST API, to test and benchmark it end to end
+without deploying
+
+The API is read from the synthesized BackStack template: routes, lambda integrations
+with their request templates, the TOKEN authorizer with its validation expression and
+results cache TTL, lambdas handlers & environment. Tables and queues of the template are
+created in moto, which must be mocking AWS. Requests then go through what API Gateway
+does:
+- route lookup, 403 "Missing Authentication Token" on unknown routes
+- TOKEN authorizer: header check, validation expression, policy cached per token for
+AuthorizerResultTtlInSeconds, policy evaluated against the request method ARN
+- non proxy integrations: the request template (default_request_template of
+utils_cdk.add_apigw_lambda_route) is rendered to build the event, the default
+integration response gives the status code, lambda errors included
+- proxy integrations: lambda proxy event, the lambda gives the status code
+
+Not emulated: HTTP APIs, stage cache, stream & queue consumers.
+
+    with mock_dynamodb():
+        emulator = ApiEmulator(synth_back_stack().to_json())
+        emulator.request("GET", "/get-url-counter", query={"url": "https://a.com"},
+                         headers={"AuthToken": "MyAccessToken"})
+"""
+
+import os
+import re
+import json
+import time
+import uuid
+import fnmatch
+import threading
+import statistics
+import importlib.util
+from collections import namedtuple, Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+
+from back.tests.conftest import LAMBDAS_PATH
+
+# Importable once conftest put the shared layer on sys.path
+from lambdas_shared import aws, events  # pylint: disable=wrong-import-order
+
+
+ACCOUNT_ID = "123456789012"
+API_ID = "emulated"
+
+EmulatorResponse = namedtuple(
+    "EmulatorResponse", ["status_code", "headers", "body", "authorizer_invoked"]
+)
+
+
+# ### VELOCITY TEMPLATES ### #
+# Subset of the Velocity Template Language used by API Gateway request templates:
+# references with properties & method calls, #set, #foreach with $foreach.hasNext,
+# #if/#else. Missing values render empty, like API Gateway does.
+
+
+class TemplateSyntaxError(ValueError):
+    """Template outside of the supported VTL subset"""
+
+
+class ExpressionParser:
+    """Parse VTL references & literals of a source from a position"""
+
+    IDENTIFIER = re.compile(r"[A-Za-z][\w-]*")
+    NUMBER = re.compile(r"-?\d+")
+
+    def __init__(self, source, position=0):
+        self.source = source
+        self.position = position
+
+    def peek(self, text):
+        """True when text starts at the current position"""
+        return self.source.startswith(text, self.position)
+
+    def skip_spaces(self):
+        """Move after spaces"""
+        while self.position < len(self.source) and self.source[self.position].isspace():
+            self.position += 1
+
+    def expect(self, text):
+        """Move after text, which must be at the current position"""
+        self.skip_spaces()
+        if not self.peek(text):
+            raise TemplateSyntaxError(
+                f"Expected {text!r} at {self.source[self.position:self.position + 30]!r}"
+            )
+        self.position += len(text)
+
+    def identifier(self):
+        """Parse an identifier"""
+        match = self.IDENTIFIER.match(self.source, self.position)
+        if not match:
+            raise TemplateSyntaxError(f"Identifier expected at {self.position}")
+        self.position = match.end()
+        return match.group()
+
+    def expression(self):
+        """Parse a reference, a string, a number, a boolean or a negation"""
+        self.skip_spaces()
+        if self.peek("!"):
+            self.position += 1
+            return ("not", self.expression())
+        if self.peek("'") or self.peek('"'):
+            quote = self.source[self.position]
+            end = self.source.index(quote, self.position + 1)
+            value = self.source[self.position + 1 : end]
+            self.position = end + 1
+            return ("literal", value)
+        if self.peek("$"):
+            return self.reference()
+        for word, value in [("true", True), ("false", False)]:
+            if self.peek(word):
+                self.position += len(word)
+                return ("literal", value)
+        match = self.NUMBER.match(self.source, self.position)
+        if match:
+            self.position = match.end()
+            return ("literal", int(match.group()))
+        raise TemplateSyntaxError(f"Expression expected at {self.position}")
+
+    def reference(self):
+        """Parse $name.property.method(arguments)..., also $!name and ${name}"""
+        self.expect("$")
+        if self.peek("!"):
+            self.position += 1
+        braced = self.peek("{")
+        if braced:
+            self.position += 1
+
+        name = self.identifier()
+        members = []
+        while self.peek(".") and self.IDENTIFIER.match(self.source, self.position + 1):
+            self.position += 1
+            member = self.identifier()
+            arguments = None
+            if self.peek("("):
+                self.position += 1
+                arguments = []
+                self.skip_spaces()
+                while not self.peek(")"):
+                    arguments.append(self.expression())
+                    self.skip_spaces()
+                    if self.peek(","):
+                        self.position += 1
+                self.position += 1
+            members.append((member, arguments))
+
+        if braced:
+            self.expect("}")
+        return ("reference", name, members)
+
+
+def parse_template(source):
+    """Parse a template into nodes: ("text", text), ("reference", ...),
+    ("set", name, expression), ("foreach", name, expression, nodes),
+    ("if", expression, nodes, else_nodes)"""
+    directive = re.compile(r"#(set|foreach|if|elseif|else|end)\b|\$!?\{?[A-Za-z]")
+    # Stack of (node, its nodes list being filled)
+    root = []
+    stack = [(None, root)]
+    position = 0
+
+    while position < len(source):
+        match = directive.search(source, position)
+        end = match.start() if match else len(source)
+        if end > position:
+            stack[-1][1].append(("text", source[position:end]))
+        if not match:
+            break
+
+        if match.group(1) is None:
+            parser = ExpressionParser(source, match.start())
+            stack[-1][1].append(parser.reference())
+            position = parser.position
+            continue
+
+        name = match.group(1)
+        parser = ExpressionParser(source, match.end())
+        if name == "end":
+            if len(stack) == 1:
+                raise TemplateSyntaxError("#end without directive")
+            stack.pop()
+            position = match.end()
+        elif name == "else":
+            node, _ = stack[-1]
+            if node is None or node[0] != "if":
+                raise TemplateSyntaxError("#else outside of #if")
+            stack[-1] = (node, node[3])
+            position = match.end()
+        elif name == "elseif":
+            raise TemplateSyntaxError("#elseif is not supported")
+        else:
+            parser.expect("(")
+            if name == "set":
+                variable = parser.reference()[1]
+                parser.expect("=")
+                stack[-1][1].append(("set", variable, parser.expression()))
+            elif name == "foreach":
+                variable = parser.reference()[1]
+                parser.expect("in")
+                node = ("foreach", variable, parser.expression(), [])
+                stack[-1][1].append(node)
+                stack.append((node, node[3]))
+            else:
+                node = ("if", parser.expression(), [], [])
+                stack[-1][1].append(node)
+                stack.append((node, node[2]))
+            parser.expect(")")
+            position = parser.position
+
+    if len(stack) > 1:
+        raise TemplateSyntaxError("Missing #end")
+    return root
+
+
+def get_member(value, name, arguments):
+    """Property or method call on a template value, like Velocity on Java objects"""
+    if value is None:
+        return None
+
+    if arguments is None:
+        if isinstance(value, dict):
+            return value.get(name)
+        return getattr(value, name, None)
+
+    if isinstance(value, dict):
+        methods = {
+            "keySet": lambda: list(value),
+            "get": lambda key: value.get(key),
+            "containsKey": lambda key: key in value,
+            "size": lambda: len(value),
+            "isEmpty": lambda: not value,
+        }
+    elif isinstance(value, (list, str)):
+        methods = {
+            "get": lambda index: value[index],
+            "size": lambda: len(value),
+            "length": lambda: len(value),
+            "isEmpty": lambda: not value,
+        }
+    else:
+        methods = {name: getattr(value, name, None)}
+
+    if methods.get(name) is None:
+        raise TemplateSyntaxError(f"Unknown method {name} of {type(value).__name__}")
+    return methods[name](*arguments)
+
+
+def evaluate(expression, variables):
+    """Value of a parsed expression"""
+    if expression[0] == "literal":
+        return expression[1]
+    if expression[0] == "not":
+        return not evaluate(expression[1], variables)
+
+    _, name, members = expression
+    value = variables.get(name)
+    for member, arguments in members:
+        value = get_member(
+            value,
+            member,
+            None
+            if arguments is None
+            else [evaluate(argument, variables) for argument in arguments],
+        )
+    return value
+
+
+def to_text(value):
+    """Rendering of a value, Java style booleans"""
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+
+def render_nodes(nodes, variables, output):
+    """Append the rendering of nodes to output"""
+    for node in nodes:
+        if node[0] == "text":
+            output.append(node[1])
+        elif node[0] == "reference":
+            output.append(to_text(evaluate(node, variables)))
+        elif node[0] == "set":
+            variables[node[1]] = evaluate(node[2], variables)
+        elif node[0] == "if":
+            branch = node[2] if evaluate(node[1], variables) else node[3]
+            render_nodes(branch, variables, output)
+        else:
+            _, name, expression, children = node
+            items = list(evaluate(expression, variables) or [])
+            outer = variables.get("foreach")
+            for index, item in enumerate(items):
+                variables[name] = item
+                variables["foreach"] = {
+                    "index": index,
+                    "count": index + 1,
+                    "hasNext": index < len(items) - 1,
+                    "first": index == 0,
+                    "last": index == len(items) - 1,
+                }
+                render_nodes(children, variables, output)
+            variables["foreach"] = outer
+
+
+def render_template(source, variables):
+    """Render a request template with $input, $util, $context & $stageVariables"""
+    output = []
+    render_nodes(parse_template(source), dict(variables), output)
+    return "".join(output)
+
+
+def escape_javascript(value):
+    """$util.escapeJavaScript, Apache Commons StringEscapeUtils.escapeJavaScript:
+    single quotes are escaped too, which is not valid JSON"""
+    escapes = {
+        "'": "\\'",
+        '"': '\\"',
+        "\\": "\\\\",
+        "/": "\\/",
+        "\b": "\\b",
+        "\n": "\\n",
+        "\t": "\\t",
+        "\f": "\\f",
+        "\r": "\\r",
+    }
+    return "".join(
+        escapes.get(char)
+        or (f"\\u{ord(char):04X}" if ord(char) < 32 or ord(char) > 0x7F else char)
+        for char in to_text(value)
+    )
+
+
+class TemplateUtil:
+    """$util of request templates"""
+
+    # pylint: disable=invalid-name,no-self-use
+    def escapeJavaScript(self, value):
+        """Escape a string to be put in a JSON string"""
+        return escape_javascript(value)
+
+    def parseJson(self, value):
+        """Parse a JSON string"""
+        return json.loads(value)
+
+
+class TemplateInput:
+    """$input of request templates: request body & parameters"""
+
+    def __init__(self, body, path, querystring, header):
+        self.body = body or ""
+        self._params = {"path": path, "querystring": querystring, "header": header}
+
+    def json(self, path):
+        """JSON of the body at a JSONPath, "$" or "$.name.name" """
+        value = json.loads(self.body) if self.body.strip() else {}
+        for name in path.split(".")[1:]:
+            value = value.get(name) if isinstance(value, dict) else None
+        return json.dumps(value)
+
+    def params(self, name=None):
+        """Every parameter by type, or the value of a parameter by name"""
+        if name is None:
+            return self._params
+        for values in self._params.values():
+            if name in values:
+                return values[name]
+        return None
+
+
+# ### CLOUDFORMATION TEMPLATE ### #
+
+
+class LambdaContext:
+    """Lambda context handed to handlers"""
+
+    def __init__(self, function_name, timeout):
+        self.function_name = function_name
+        self.aws_request_id = str(uuid.uuid4())
+        self.memory_limit_in_mb = 128
+        self._deadline = time.monotonic() + timeout
+
+    def get_remaining_time_in_millis(self):
+        """Lambda context API"""
+        return int(max(self._deadline - time.monotonic(), 0) * 1000)
+
+
+class AuthorizerCache:
+    """API Gateway authorizer results cache: the policy returned for a token is reused
+    for every request with that token during ttl seconds"""
+
+    def __init__(self, ttl, clock=time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = {}
+        self.invocations = 0
+        self.lock = threading.Lock()
+
+    def get(self, token, authorize):
+        """Return (policy, invoked) for token, calling authorize() on a miss"""
+        with self.lock:
+            entry = self.entries.get(token)
+            if entry and entry[0] > self.clock():
+                return entry[1], False
+
+        # Outside of the lock, like concurrent API Gateway requests
+        policy = authorize()
+        with self.lock:
+            self.invocations += 1
+            if self.ttl > 0:
+                self.entries[token] = (self.clock() + self.ttl, policy)
+        return policy, True
+
+
+def is_allowed(policy_document, method_arn):
+    """IAM evaluation of an authorizer policy for a method ARN: explicit deny wins,
+    then an allow is needed"""
+    effects = set()
+    for statement in policy_document.get("Statement", []):
+        resources = statement.get("Resource", [])
+        resources = [resources] if isinstance(resources, str) else resources
+        if any(fnmatch.fnmatchcase(method_arn, resource) for resource in resources):
+            effects.add(statement.get("Effect"))
+
+    if "Deny" in effects:
+        return False
+    return "Allow" in effects
+
+
+class ApiEmulator:
+    """REST API of a synthesized stack template, see module docstring"""
+
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, template, stage=None, region="eu-west-3", clock=time.monotonic):
+        self.resources = template["Resources"]
+        # Stage deployed by the template by default
+        self.stage = stage or next(
+            (
+                resource["Properties"]["StageName"]
+                for resource in self.resources.values()
+                if resource["Type"] == "AWS::ApiGateway::Stage"
+            ),
+            "prod",
+        )
+        self.region = region
+        self.clock = clock
+        self.physical_ids = {}
+        self.lambdas = {}
+        self.authorizers = {}
+
+        self.create_resources()
+        self.routes = self.get_routes()
+        if not self.routes:
+            raise ValueError(
+                "No REST API method in template, HTTP APIs aren't emulated"
+            )
+
+        for method in self.routes.values():
+            integration = method["Integration"]
+            if integration["Type"] in ("AWS", "AWS_PROXY"):
+                self.load_lambda(self.find_function(integration["Uri"]))
+            if method.get("AuthorizerId"):
+                authorizer_id = method["AuthorizerId"]["Ref"]
+                properties = self.resources[authorizer_id]["Properties"]
+                self.authorizers[authorizer_id] = AuthorizerCache(
+                    properties.get("AuthorizerResultTtlInSeconds", 300), clock
+                )
+                self.load_lambda(self.find_function(properties["AuthorizerUri"]))
+
+    def get_type(self, logical_id):
+        """CloudFormation type of a resource"""
+        return self.resources[logical_id]["Type"]
+
+    def create_resources(self):
+        """Create the template tables & queues in moto, named after their logical id"""
+        # Shared layer resources may belong to another moto mock
+        aws.get_resource.cache_clear()
+
+        for logical_id, resource in self.resources.items():
+            properties = resource.get("Properties", {})
+            if resource["Type"] == "AWS::DynamoDB::Table":
+                table_properties = {
+                    key: properties[key]
+                    for key in [
+                        "KeySchema",
+                        "AttributeDefinitions",
+                        "GlobalSecondaryIndexes",
+                        "LocalSecondaryIndexes",
+                        "StreamSpecification",
+                    ]
+                    if key in properties
+                }
+                if "StreamSpecification" in table_properties:
+                    table_properties["StreamSpecification"] = {
+                        "StreamEnabled": True,
+                        **table_properties["StreamSpecification"],
+                    }
+                boto3.client("dynamodb").create_table(
+                    TableName=logical_id,
+                    BillingMode="PAY_PER_REQUEST",
+                    **table_properties,
+                )
+                self.physical_ids[logical_id] = logical_id
+            elif resource["Type"] == "AWS::SQS::Queue":
+                self.physical_ids[logical_id] = boto3.client("sqs").create_queue(
+                    QueueName=logical_id
+                )["QueueUrl"]
+
+    def resolve(self, value):
+        """Value of a template property, with Ref, Fn::GetAtt & Fn::Join"""
+        if not isinstance(value, dict):
+            return value
+        if "Ref" in value:
+            if value["Ref"] == "AWS::Partition":
+                return "aws"
+            return self.physical_ids.get(value["Ref"], value["Ref"])
+        if "Fn::GetAtt" in value:
+            logical_id, attribute = value["Fn::GetAtt"]
+            return (
+                f"arn:aws:{self.get_type(logical_id).split('::')[1].lower()}:"
+                f"{self.region}:{ACCOUNT_ID}:{logical_id}:{attribute}"
+            )
+        if "Fn::Join" in value:
+            separator, parts = value["Fn::Join"]
+            return separator.join(str(self.resolve(part)) for part in parts)
+        raise ValueError(f"Unsupported intrinsic function {list(value)}")
+
+    def find_function(self, value):
+        """Logical id of the lambda function an integration or authorizer URI targets,
+        through aliases"""
+        if isinstance(value, list):
+            found = (self.find_function(item) for item in value)
+            return next((logical_id for logical_id in found if logical_id), None)
+        if not isinstance(value, dict):
+            return None
+
+        target = value.get("Ref") or (value.get("Fn::GetAtt") or [None])[0]
+        if target in self.resources:
+            if self.get_type(target) == "AWS::Lambda::Function":
+                return target
+            if self.get_type(target) == "AWS::Lambda::Alias":
+                return self.find_function(
+                    self.resources[target]["Properties"]["FunctionName"]
+                )
+        return self.find_function(list(value.values()))
+
+    def load_lambda(self, logical_id):
+        """Import a lambda with its template environment, lambdas read it at import"""
+        if logical_id in self.lambdas:
+            return
+
+        properties = self.resources[logical_id]["Properties"]
+        module_name, handler_name = properties["Handler"].split(".")
+        environment = {
+            name: str(self.resolve(value))
+            for name, value in properties.get("Environment", {})
+            .get("Variables", {})
+            .items()
+        }
+
+        saved = dict(os.environ)
+        os.environ.update({**environment, "AWS_LAMBDA_FUNCTION_NAME": logical_id})
+        try:
+            spec = importlib.util.spec_from_file_location(
+                module_name,
+                os.path.join(LAMBDAS_PATH, module_name, f"{module_name}.py"),
+            )
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        finally:
+            os.environ.clear()
+            os.environ.update(saved)
+
+        self.lambdas[logical_id] = (
+            getattr(module, handler_name),
+            properties.get("Timeout", 3),
+        )
+
+    def invoke(self, logical_id, event):
+        """Call a lambda handler with a fresh context"""
+        handler, timeout = self.lambdas[logical_id]
+        return handler(event, LambdaContext(logical_id, timeout))
+
+    def get_resource_path(self, logical_id):
+        """Path of an API Gateway resource, from its parents"""
+        if logical_id is None:
+            return ""
+        properties = self.resources[logical_id]["Properties"]
+        parent = properties["ParentId"].get("Ref")
+        return f"{self.get_resource_path(parent)}/{properties['PathPart']}"
+
+    def get_routes(self):
+        """Methods properties by (resource path, HTTP method)"""
+        routes = {}
+        for resource in self.resources.values():
+            if resource["Type"] != "AWS::ApiGateway::Method":
+                continue
+            properties = resource["Properties"]
+            path = self.get_resource_path(properties["ResourceId"].get("Ref")) or "/"
+            routes[(path, properties["HttpMethod"])] = properties
+        return routes
+
+    def match_route(self, method, path):
+        """Return (resource path, path parameters, method properties) or None"""
+        segments = path.strip("/").split("/")
+        for (resource_path, http_method), properties in self.routes.items():
+            if http_method not in (method, "ANY"):
+                continue
+            parts = resource_path.strip("/").split("/")
+            if len(parts) != len(segments):
+                continue
+            parameters = {}
+            for part, segment in zip(parts, segments):
+                if part.startswith("{") and part.endswith("}"):
+                    parameters[part[1:-1]] = segment
+                elif part != segment:
+                    break
+            else:
+                return resource_path, parameters, properties
+        return None
+
+    def authorize(self, method_properties, method_arn, headers):
+        """Run the TOKEN authorizer of a method, return (authorizer context, invoked)
+        or an error response"""
+        authorizer_id = method_properties["AuthorizerId"]["Ref"]
+        properties = self.resources[authorizer_id]["Properties"]
+        header = properties["IdentitySource"].split(".")[-1].lower()
+        token = next(
+            (value for name, value in headers.items() if name.lower() == header), None
+        )
+
+        expression = properties.get("IdentityValidationExpression")
+        if not token or (expression and not re.fullmatch(expression, token)):
+            return EmulatorResponse(401, {}, {"message": "Unauthorized"}, False)
+
+        def authorize():
+            return self.invoke(
+                self.find_function(properties["AuthorizerUri"]),
+                {"type": "TOKEN", "authorizationToken": token, "methodArn": method_arn},
+            )
+
+        try:
+            policy, invoked = self.authorizers[authorizer_id].get(token, authorize)
+        # pylint: disable=broad-except
+        except Exception as err:
+            if str(err) == "Unauthorized":
+                return EmulatorResponse(401, {}, {"message": "Unauthorized"}, True)
+            return EmulatorResponse(500, {}, {"message": None}, True)
+
+        if not is_allowed(policy["policyDocument"], method_arn):
+            return EmulatorResponse(
+                403,
+                {},
+                {"message": "User is not authorized to access this resource"},
+                invoked,
+            )
+        return {
+            "principalId": policy["principalId"],
+            **policy.get("context", {}),
+        }, invoked
+
+    # pylint: disable=too-many-arguments,too-many-locals
+    def request(
+        self, method, path, query=None, headers=None, body=None, source_ip=None
+    ):
+        """Send a request to the API, return an EmulatorResponse"""
+        query = query or {}
+        headers = headers or {}
+        if body is not None and not isinstance(body, str):
+            body = json.dumps(body)
+
+        route = self.match_route(method, path)
+        if route is None:
+            return EmulatorResponse(
+                403, {}, {"message": "Missing Authentication Token"}, False
+            )
+        resource_path, path_parameters, properties = route
+        integration = properties["Integration"]
+
+        authorizer_context, invoked = {}, False
+        if properties.get("AuthorizationType") == "CUSTOM":
+            method_arn = (
+                f"arn:aws:execute-api:{self.region}:{ACCOUNT_ID}:{API_ID}/"
+                f"{self.stage}/{method}/{path.lstrip('/')}"
+            )
+            authorized = self.authorize(properties, method_arn, headers)
+            if isinstance(authorized, EmulatorResponse):
+                return authorized
+            authorizer_context, invoked = authorized
+
+        context = {
+            "apiId": API_ID,
+            "httpMethod": method,
+            "stage": self.stage,
+            "requestId": str(uuid.uuid4()),
+            "resourceId": resource_path,
+            "resourcePath": resource_path,
+            "authorizer": authorizer_context,
+            "identity": {
+                "accountId": "",
+                "apiKey": "",
+                "caller": "",
+                "cognitoAuthenticationProvider": "",
+                "cognitoAuthenticationType": "",
+                "cognitoIdentityId": "",
+                "cognitoIdentityPoolId": "",
+                "sourceIp": source_ip or "127.0.0.1",
+                "user": "",
+                "userAgent": next(
+                    (v for k, v in headers.items() if k.lower() == "user-agent"), ""
+                ),
+                "userArn": "",
+            },
+        }
+
+        if integration["Type"] == "MOCK":
+            return self.respond(integration, None, invoked)
+        if integration["Type"] == "AWS_PROXY":
+            return self.proxy_request(
+                integration,
+                {
+                    "resource": resource_path,
+                    "path": path,
+                    "httpMethod": method,
+                    "headers": headers or None,
+                    "multiValueHeaders": {k: [v] for k, v in headers.items()} or None,
+                    "queryStringParameters": query or None,
+                    "multiValueQueryStringParameters": {
+                        k: [v] for k, v in query.items()
+                    }
+                    or None,
+                    "pathParameters": path_parameters or None,
+                    "stageVariables": None,
+                    "requestContext": {**context, "path": f"/{self.stage}{path}"},
+                    "body": body,
+                    "isBase64Encoded": False,
+                },
+                invoked,
+            )
+
+        content_type = next(
+            (v for k, v in headers.items() if k.lower() == "content-type"),
+            "application/json",
+        )
+        template = integration.get("RequestTemplates", {}).get(
+            content_type.split(";")[0].strip()
+        )
+        if template is None:
+            return EmulatorResponse(
+                415, {}, {"message": "Unsupported Media Type"}, invoked
+            )
+
+        try:
+            payload = json.loads(
+                render_template(
+                    template,
+                    {
+                        "input": TemplateInput(body, path_parameters, query, headers),
+                        "util": TemplateUtil(),
+                        "context": context,
+                        "stageVariables": {},
+                    },
+                )
+            )
+        except ValueError as err:
+            return EmulatorResponse(
+                400,
+                {},
+                {"message": f"Could not parse request body into json: {err}"},
+                invoked,
+            )
+
+        try:
+            result = self.invoke(self.find_function(integration["Uri"]), payload)
+        # pylint: disable=broad-except
+        except Exception as err:
+            body = {"errorMessage": str(err), "errorType": type(err).__name__}
+            return self.respond(integration, body, invoked)
+
+        try:
+            # Lambda runtime serialization
+            body = json.loads(json.dumps(result, default=events.to_json))
+        except TypeError as err:
+            body = {"errorMessage": str(err), "errorType": "Runtime.MarshalError"}
+        return self.respond(integration, body, invoked)
+
+    def proxy_request(self, integration, event, invoked):
+        """Call a lambda proxy integration"""
+        try:
+            result = self.invoke(self.find_function(integration["Uri"]), event)
+            body = result.get("body")
+            return EmulatorResponse(
+                int(result["statusCode"]),
+                result.get("headers") or {},
+                json.loads(body) if body else None,
+                invoked,
+            )
+        # pylint: disable=broad-except
+        except Exception:
+            return EmulatorResponse(
+                502, {}, {"message": "Internal server error"}, invoked
+            )
+
+    @staticmethod
+    def respond(integration, body, invoked):
+        """Response of the default integration response, lambda errors included as
+        no selection pattern is set"""
+        default = next(
+            response
+            for response in integration.get("IntegrationResponses", [])
+            if not response.get("SelectionPattern")
+        )
+        headers = {
+            name.split(".")[-1]: value.strip("'")
+            for name, value in (default.get("ResponseParameters") or {}).items()
+        }
+        return EmulatorResponse(int(default["StatusCode"]), headers, body, invoked)
+
+
+# ### REPLAY ### #
+
+
+def replay(emulator, requests, rate, workers=8):
+    """Send requests at rate requests/s, open loop: latencies are measured from the
+    time each request was due, queueing behind busy workers included.
+    requests are emulator.request keyword arguments"""
+    start = time.perf_counter()
+
+    def send(index, request):
+        due = start + index / rate
+        delay = due - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        sent = time.perf_counter()
+        response = emulator.request(**request)
+        done = time.perf_counter()
+        return response.status_code, (done - sent) * 1000, (done - due) * 1000
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(send, range(len(requests)), requests))
+    duration = time.perf_counter() - start
+
+    def percentiles(values):
+        cuts = statistics.quantiles(values, n=100) if len(values) > 1 else values * 99
+        return {
+            "p50_ms": statistics.median(values),
+            "p90_ms": cuts[89],
+            "p99_ms": cuts[98],
+            "max_ms": max(values),
+        }
+
+    return {
+        "requests": len(results),
+        "duration_s": duration,
+        "target_rate": rate,
+        "throughput": len(results) / duration,
+        "status_codes": dict(Counter(status for status, _, _ in results)),
+        "service": percentiles([service for _, service, _ in results]),
+        "latency": percentiles([latency for _, _, latency in results]),
+        "authorizer_invocations": sum(
+            cache.invocations for cache in emulator.authorizers.values()
+        ),
+    }
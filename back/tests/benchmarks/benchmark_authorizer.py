@@ -0,0 +1,75 @@
+"""
+    Benchmark lambda_auth: authorizer invocations per API request depending on the
+    authorizer results cache TTL, and duration of an invocation with and without the
+    in-container policies cache.
+
+        python3 -m back.tests.benchmarks.benchmark_authorizer --ttl 0 60 300
+"""
+
+import time
+import random
+import argparse
+import statistics
+
+from back.tests.conftest import load_lambda
+
+
+METHOD_ARN = "arn:aws:execute-api:eu-west-3:123456789012:api-id/dev/GET/get-url-counter"
+
+
+def count_invocations(requests_times, tokens, ttl):
+    """Replay requests against API Gateway authorizer cache semantics: a token policy
+    is reused for ttl seconds after the invocation that produced it"""
+    cached_until = {}
+    invocations = 0
+
+    for request_time, token in zip(requests_times, tokens):
+        if ttl <= 0 or cached_until.get(token, -1) <= request_time:
+            invocations += 1
+            cached_until[token] = request_time + ttl
+
+    return invocations
+
+
+def time_invocations(lambda_auth, invocations):
+    """Return every invocation duration in µs"""
+    durations = []
+    for _ in range(invocations):
+        start = time.perf_counter()
+        lambda_auth.lambda_handler({"methodArn": METHOD_ARN}, None)
+        durations.append((time.perf_counter() - start) * 1000000)
+
+    return durations
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=100000)
+    parser.add_argument("--tokens", type=int, default=50)
+    parser.add_argument("--duration", type=int, default=3600, help="in seconds")
+    parser.add_argument("--ttl", type=int, nargs="+", default=[0, 60, 300, 3600])
+    parser.add_argument("--invocations", type=int, default=5000)
+    args = parser.parse_args()
+
+    requests_times = sorted(
+        random.uniform(0, args.duration) for _ in range(args.requests)
+    )
+    tokens = [random.randrange(args.tokens) for _ in range(args.requests)]
+
+    print(f"{args.requests} requests from {args.tokens} tokens over {args.duration}s")
+    print(f"{'ttl':>6} {'invocations':>12} {'per request':>12}")
+    for ttl in args.ttl:
+        invocations = count_invocations(requests_times, tokens, ttl)
+        print(f"{ttl:>6} {invocations:>12} {invocations / args.requests:>12.4f}")
+
+    print(f"\n{'policies cache':>14} {'p50 µs':>8} {'p99 µs':>8}")
+    for cache_size in [0, 128]:
+        lambda_auth = load_lambda("auth")
+        lambda_auth.POLICIES_CACHE_SIZE = cache_size
+        # Requests printing is not what is measured here
+        lambda_auth.print = lambda *_: None
+        durations = time_invocations(lambda_auth, args.invocations)
+        print(
+            f"{'on' if cache_size else 'off':>14} {statistics.median(durations):>8.1f} "
+            f"{statistics.quantiles(durations, n=100)[98]:>8.1f}"
+        )
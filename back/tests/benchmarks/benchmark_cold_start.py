@@ -0,0 +1,363 @@
+"""
+    Cold start benchmark of every lambda under back/lambdas.
+
+    Each lambda is loaded many times, each time in a fresh interpreter started with
+    -X importtime, against a moto server standing in for AWS and a local HTTP target.
+    Reports import time per imported module, first invocation and warm invocation
+    latencies, in ms (medians over runs).
+
+        python3 -m back.tests.benchmarks.benchmark_cold_start --runs 20
+        python3 -m back.tests.benchmarks.benchmark_cold_start --lazy
+        python3 -m back.tests.benchmarks.benchmark_cold_start --save-baseline
+
+    --check exits with an error when a lambda cold start (import + first invocation)
+    is more than --max-regression slower than cold_start_baseline.json. Cold starts
+    are compared as ratios to a reference measured in the same run, a fresh
+    interpreter importing boto3 and building a DynamoDB resource, so the baseline
+    holds on slower or faster machines.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import statistics
+import subprocess
+import contextlib
+import importlib.util
+
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+ROOT_PATH = os.path.join(BENCHMARKS_PATH, "../../..")
+LAMBDAS_PATH = os.path.join(ROOT_PATH, "back/lambdas")
+LAYERS_PATHS = [
+    os.path.join(ROOT_PATH, "back/lambdas_shared/python"),
+    os.path.join(ROOT_PATH, "back/lambdas_layers/requests/python"),
+    os.path.join(ROOT_PATH, "back/lambdas_layers/jwt/python"),
+]
+BASELINE_PATH = os.path.join(BENCHMARKS_PATH, "cold_start_baseline.json")
+IMPORTS_MARKER = "--- lambda imports ---"
+# Init work every lambda does, cold starts are gated relative to it
+REFERENCE_CODE = """
+import time
+start = time.perf_counter()
+import boto3
+boto3.resource("dynamodb")
+print((time.perf_counter() - start) * 1000)
+"""
+
+
+class LambdaContext:
+    """Minimal lambda context"""
+
+    # pylint: disable=no-self-use
+    def get_remaining_time_in_millis(self):
+        """Lambda context API"""
+        return 10000
+
+
+def run_child(name, event, warm_invocations):
+    """Import & invoke a lambda in this fresh interpreter, print timings as JSON"""
+    # Layers content is in /opt/python for deployed lambdas
+    sys.path[:0] = [path for path in LAYERS_PATHS if os.path.isdir(path)]
+    module_name = f"lambda_{name}"
+    spec = importlib.util.spec_from_file_location(
+        module_name, os.path.join(LAMBDAS_PATH, module_name, f"{module_name}.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+
+    sys.stderr.write(f"{IMPORTS_MARKER}\n")
+    sys.stderr.flush()
+    start = time.perf_counter()
+    spec.loader.exec_module(module)
+    import_ms = (time.perf_counter() - start) * 1000
+
+    durations = []
+    with contextlib.redirect_stdout(open(os.devnull, "w", encoding="utf-8")):
+        for _ in range(1 + warm_invocations):
+            start = time.perf_counter()
+            module.lambda_handler(json.loads(event), LambdaContext())
+            durations.append((time.perf_counter() - start) * 1000)
+
+    print(
+        json.dumps(
+            {
+                "import_ms": import_ms,
+                "first_invocation_ms": durations[0],
+                "warm_invocation_ms": statistics.median(durations[1:] or durations),
+            }
+        )
+    )
+
+
+def parse_importtime(stderr):
+    """Return cumulative import time in ms of each module imported by the lambda"""
+    lines = stderr.split(f"{IMPORTS_MARKER}\n", 1)[-1].splitlines()
+    imports = []
+
+    for line in lines:
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative, package = line[len("import time:") :].split("|")
+        imports.append(
+            (len(package) - len(package.lstrip()), package.strip(), cumulative)
+        )
+
+    if not imports:
+        return {}
+
+    # Only keep modules imported by the lambda itself, their imports are included
+    top_level = min(indent for indent, _, _ in imports)
+    return {
+        package: int(cumulative) / 1000
+        for indent, package, cumulative in imports
+        if indent == top_level
+    }
+
+
+def get_free_port():
+    """Return a port nobody listens on"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def create_tables(endpoint_url):
+    """Create the BackStack tables in the moto server"""
+    # pylint: disable=import-outside-toplevel
+    import boto3
+
+    ddb = boto3.resource("dynamodb", endpoint_url=endpoint_url)
+    for table_name, keys in [
+        ("url-request-count", [("url", "S"), ("status_code", "N")]),
+        ("url-counter-aggregates", [("pk", "S"), ("sk", "S")]),
+    ]:
+        ddb.create_table(
+            TableName=table_name,
+            KeySchema=[
+                {"AttributeName": keys[0][0], "KeyType": "HASH"},
+                {"AttributeName": keys[1][0], "KeyType": "RANGE"},
+            ],
+            AttributeDefinitions=[
+                {"AttributeName": name, "AttributeType": attribute_type}
+                for name, attribute_type in keys
+            ],
+            BillingMode="PAY_PER_REQUEST",
+        )
+
+
+def get_events(target):
+    """A representative event for each lambda"""
+    return {
+        "auth": {
+            "methodArn": "arn:aws:execute-api:eu-west-3:123456789012:api/dev/GET/get",
+            "authorizationToken": "MyAccessToken",
+        },
+        "get_url_counter": {"params": {"querystring": {"url": target}}},
+        "request_and_increment_url_counter": {"body-json": {"url": target}},
+        "aggregate_url_counters": {
+            "Records": [
+                {
+                    "dynamodb": {
+                        "SequenceNumber": "100000000000000000001",
+                        "NewImage": {
+                            "url": {"S": target},
+                            "status_code": {"N": "200"},
+                            "counter": {"N": "1"},
+                        },
+                    }
+                }
+            ]
+        },
+    }
+
+
+def benchmark_lambda(name, event, env, runs, warm_invocations):
+    """Run a lambda cold start runs times, return medians"""
+    results = []
+    imports = []
+
+    for _ in range(runs):
+        child = subprocess.run(
+            [
+                sys.executable,
+                "-X",
+                "importtime",
+                "-m",
+                "back.tests.benchmarks.benchmark_cold_start",
+                "--child",
+                name,
+                "--event",
+                json.dumps(event),
+                "--warm",
+                str(warm_invocations),
+            ],
+            env=env,
+            cwd=ROOT_PATH,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        results.append(json.loads(child.stdout.splitlines()[-1]))
+        imports.append(parse_importtime(child.stderr))
+
+    summary = {
+        key: statistics.median(result[key] for result in results) for key in results[0]
+    }
+    summary["cold_start_ms"] = summary["import_ms"] + summary["first_invocation_ms"]
+    summary["imports_ms"] = {
+        package: statistics.median(run.get(package, 0) for run in imports)
+        for package in imports[0]
+    }
+
+    return summary
+
+
+def benchmark_reference(env, runs):
+    """Median duration in ms of the reference cold start"""
+    return statistics.median(
+        float(
+            subprocess.run(
+                [sys.executable, "-c", REFERENCE_CODE],
+                env=env,
+                cwd=ROOT_PATH,
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+        )
+        for _ in range(runs)
+    )
+
+
+def main(args):
+    """Benchmark every lambda, compare with or save the baseline"""
+    # pylint: disable=import-outside-toplevel
+    import logging
+    import threading
+    from http.server import ThreadingHTTPServer
+    from moto.server import ThreadedMotoServer
+    from back.tests.conftest import StatusHandler
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    moto_port = get_free_port()
+    moto_server = ThreadedMotoServer(
+        ip_address="127.0.0.1", port=moto_port, verbose=False
+    )
+    moto_server.start()
+    endpoint_url = f"http://127.0.0.1:{moto_port}"
+
+    http_server = ThreadingHTTPServer(("127.0.0.1", 0), StatusHandler)
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    target = f"http://127.0.0.1:{http_server.server_port}/status/200"
+
+    env = {
+        **os.environ,
+        "AWS_ACCESS_KEY_ID": "benchmark",
+        "AWS_SECRET_ACCESS_KEY": "benchmark",
+        "AWS_DEFAULT_REGION": "eu-west-3",
+        "AWS_ENDPOINT_URL": endpoint_url,
+        "TABLE_URL_REQUEST_COUNT_NAME": "url-request-count",
+        "TABLE_URL_AGGREGATES_NAME": "url-counter-aggregates",
+        "LAZY_AWS_CLIENTS": "true" if args.lazy else "false",
+        "PYTHONPATH": ROOT_PATH,
+    }
+    os.environ.update(
+        {
+            key: env[key]
+            for key in [
+                "AWS_ACCESS_KEY_ID",
+                "AWS_SECRET_ACCESS_KEY",
+                "AWS_DEFAULT_REGION",
+            ]
+        }
+    )
+    create_tables(endpoint_url)
+
+    events = get_events(target)
+    names = args.lambdas or sorted(
+        directory[len("lambda_") :]
+        for directory in os.listdir(LAMBDAS_PATH)
+        if directory.startswith("lambda_")
+    )
+
+    reference_ms = benchmark_reference(env, args.runs)
+    print(f"reference cold start: {reference_ms:.1f} ms")
+
+    report = {}
+    for name in names:
+        if name not in events:
+            print(f"No event for lambda_{name}, skipped")
+            continue
+        report[name] = benchmark_lambda(name, events[name], env, args.runs, args.warm)
+
+        summary = report[name]
+        summary["cold_start_ratio"] = summary["cold_start_ms"] / reference_ms
+        print(
+            f"\nlambda_{name}: cold start {summary['cold_start_ms']:.1f} ms "
+            f"({summary['cold_start_ratio']:.2f}x reference, import "
+            f"{summary['import_ms']:.1f} ms, first invocation "
+            f"{summary['first_invocation_ms']:.1f} ms), warm invocation "
+            f"{summary['warm_invocation_ms']:.2f} ms"
+        )
+        for package, import_ms in sorted(
+            summary["imports_ms"].items(), key=lambda item: -item[1]
+        )[: args.top]:
+            print(f"    import {package:<40} {import_ms:>8.1f} ms")
+
+    moto_server.stop()
+    http_server.shutdown()
+
+    if args.save_baseline:
+        with open(BASELINE_PATH, "w", encoding="utf-8") as file:
+            json.dump(
+                {
+                    name: {
+                        "cold_start_ms": round(summary["cold_start_ms"], 1),
+                        "cold_start_ratio": round(summary["cold_start_ratio"], 3),
+                    }
+                    for name, summary in report.items()
+                },
+                file,
+                indent=2,
+            )
+        print(f"\nBaseline saved in {BASELINE_PATH}")
+
+    if args.check:
+        with open(BASELINE_PATH, encoding="utf-8") as file:
+            baseline = json.load(file)
+
+        regressions = [
+            f"lambda_{name}: {summary['cold_start_ratio']:.2f}x reference, "
+            f"baseline {baseline[name]['cold_start_ratio']}x"
+            for name, summary in report.items()
+            if name in baseline
+            and summary["cold_start_ratio"]
+            > baseline[name]["cold_start_ratio"] * (1 + args.max_regression)
+        ]
+        if regressions:
+            print("\nCold start regressions:\n" + "\n".join(regressions))
+            sys.exit(1)
+        print("\nNo cold start regression")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lambdas", nargs="+", help="Lambda names, default all")
+    parser.add_argument("--runs", type=int, default=10, help="Fresh interpreters")
+    parser.add_argument("--warm", type=int, default=20, help="Warm invocations")
+    parser.add_argument("--lazy", action="store_true", help="LAZY_AWS_CLIENTS=true")
+    parser.add_argument("--top", type=int, default=5, help="Imports shown")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--check", action="store_true", help="Fail on regression")
+    parser.add_argument("--max-regression", type=float, default=0.5)
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--event", help=argparse.SUPPRESS)
+    arguments = parser.parse_args()
+
+    if arguments.child:
+        run_child(arguments.child, arguments.event, arguments.warm)
+    else:
+        main(arguments)
@@ -0,0 +1,167 @@
+"""
+    Benchmark API Gateway integration modes: size of the event a lambda receives and
+    time to parse it, as the runtime does (json.loads), then to read the querystring
+    & body with lambdas_shared.events.
+
+    Events are the ones of a browser GET /get-url-counter and POST
+    /increment-url-counter, rendered by default_request_template or proxied.
+
+        python3 -m back.tests.benchmarks.benchmark_event_modes --iterations 20000
+"""
+
+import json
+import time
+import argparse
+import statistics
+
+# Puts the shared layer on sys.path, as pytest does
+import back.tests.conftest  # pylint: disable=unused-import
+
+from lambdas_shared import events  # pylint: disable=wrong-import-order
+
+
+HEADERS = {
+    "Accept": "application/json, text/plain, */*",
+    "Accept-Encoding": "gzip, deflate, br",
+    "Accept-Language": "fr-FR,fr;q=0.9,en-US;q=0.8,en;q=0.7",
+    "AuthToken": "MyAccessToken",
+    "CloudFront-Forwarded-Proto": "https",
+    "CloudFront-Is-Desktop-Viewer": "true",
+    "CloudFront-Is-Mobile-Viewer": "false",
+    "CloudFront-Viewer-Country": "FR",
+    "Content-Type": "application/json",
+    "Host": "api-id.execute-api.eu-west-3.amazonaws.com",
+    "Origin": "https://front.example.com",
+    "Referer": "https://front.example.com/",
+    "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 Chrome/120.0",
+    "Via": "2.0 0123456789abcdef.cloudfront.net (CloudFront)",
+    "X-Amz-Cf-Id": "Yx8Qa7q0qbNwE8Htl0XvV5uB6S8m5iJ6VqRkOC1mG5NfHxBd8bRkUg==",
+    "X-Amzn-Trace-Id": "Root=1-65a1b2c3-0123456789abcdef01234567",
+    "X-Forwarded-For": "203.0.113.10, 130.176.0.1",
+    "X-Forwarded-Port": "443",
+    "X-Forwarded-Proto": "https",
+}
+IDENTITY = {
+    "accountId": "",
+    "apiKey": "",
+    "caller": "",
+    "cognitoAuthenticationProvider": "",
+    "cognitoAuthenticationType": "",
+    "cognitoIdentityId": "",
+    "cognitoIdentityPoolId": "",
+    "sourceIp": "203.0.113.10",
+    "user": "",
+    "userAgent": HEADERS["User-Agent"],
+    "userArn": "",
+}
+
+
+def get_template_event(method, path, querystring, body):
+    """Event rendered by add_apigw_lambda_route default_request_template"""
+    return {
+        "body-json": body or {},
+        "params": {"path": {}, "querystring": querystring, "header": HEADERS},
+        "stage-variables": {},
+        "context": {
+            "account-id": IDENTITY["accountId"],
+            "api-id": "api-id",
+            "api-key": IDENTITY["apiKey"],
+            "authorizer-principal-id": "user",
+            "caller": IDENTITY["caller"],
+            "cognito-authentication-provider": "",
+            "cognito-authentication-type": "",
+            "cognito-identity-id": "",
+            "cognito-identity-pool-id": "",
+            "http-method": method,
+            "stage": "dev",
+            "source-ip": IDENTITY["sourceIp"],
+            "user": IDENTITY["user"],
+            "user-agent": IDENTITY["userAgent"],
+            "user-arn": IDENTITY["userArn"],
+            "request-id": "c6af9ac6-7b61-11e6-9a41-93e8deadbeef",
+            "resource-id": "abc123",
+            "resource-path": path,
+        },
+    }
+
+
+def get_proxy_event(method, path, querystring, body):
+    """Lambda proxy integration event"""
+    return {
+        "resource": path,
+        "path": path,
+        "httpMethod": method,
+        "headers": HEADERS,
+        "multiValueHeaders": {name: [value] for name, value in HEADERS.items()},
+        "queryStringParameters": querystring or None,
+        "multiValueQueryStringParameters": {
+            name: [value] for name, value in querystring.items()
+        }
+        or None,
+        "pathParameters": None,
+        "stageVariables": None,
+        "requestContext": {
+            "resourceId": "abc123",
+            "authorizer": {"principalId": "user", "integrationLatency": 0},
+            "resourcePath": path,
+            "httpMethod": method,
+            "extendedRequestId": "EXAMPLEid=",
+            "requestTime": "09/Apr/2015:12:34:56 +0000",
+            "path": f"/dev{path}",
+            "accountId": "123456789012",
+            "protocol": "HTTP/1.1",
+            "stage": "dev",
+            "domainPrefix": "api-id",
+            "requestTimeEpoch": 1428582896000,
+            "requestId": "c6af9ac6-7b61-11e6-9a41-93e8deadbeef",
+            "identity": IDENTITY,
+            "domainName": HEADERS["Host"],
+            "apiId": "api-id",
+        },
+        "body": json.dumps(body) if body is not None else None,
+        "isBase64Encoded": False,
+    }
+
+
+def time_parse(payload, iterations):
+    """Return every parse duration in µs, payload as received by the runtime"""
+    durations = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        event = json.loads(payload)
+        events.get_querystring(event)
+        events.get_body(event)
+        durations.append((time.perf_counter() - start) * 1000000)
+
+    return durations
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--urls", type=int, default=1, help="urls in the POST body")
+    args = parser.parse_args()
+
+    requests_list = {
+        "GET /get-url-counter": ("GET", {"url": "https://google.com"}, None),
+        "POST /increment-url-counter": (
+            "POST",
+            {},
+            {"urls": [f"https://site-{i}.com" for i in range(args.urls)]}
+            if args.urls > 1
+            else {"url": "https://google.com"},
+        ),
+    }
+    modes = {"template": get_template_event, "proxy": get_proxy_event}
+
+    print(f"{'request':<28} {'mode':>9} {'bytes':>7} {'p50 µs':>8} {'p99 µs':>8}")
+    for request, (method, querystring, body) in requests_list.items():
+        path = request.split(" ")[1]
+        for mode, get_event in modes.items():
+            payload = json.dumps(get_event(method, path, querystring, body))
+            durations = time_parse(payload, args.iterations)
+            print(
+                f"{request:<28} {mode:>9} {len(payload):>7} "
+                f"{statistics.median(durations):>8.1f} "
+                f"{statistics.quantiles(durations, n=100)[98]:>8.1f}"
+            )
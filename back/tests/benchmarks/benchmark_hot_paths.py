@@ -0,0 +1,259 @@
+"""
+    Micro-benchmarks of the lambdas hot paths, in process, against moto DynamoDB and a
+    local HTTP target: increment_status_code_counter, get_table_data, AuthPolicy.build
+    and every lambda_handler. Reports ops/sec, p50 & p99 latencies in µs.
+
+        python3 -m back.tests.benchmarks.benchmark_hot_paths --rounds 2000
+        python3 -m back.tests.benchmarks.benchmark_hot_paths --only get_table_data_url
+        python3 -m back.tests.benchmarks.benchmark_hot_paths --save-baseline
+
+    --check exits with an error when a hot path p50 is more than --max-regression
+    slower than hot_paths_baseline.json, or its p99 more than --max-tail-regression.
+    Latencies are compared as ratios to the p50 of a reference measured in the same
+    run, a moto GetItem, so the baseline holds on slower or faster machines.
+"""
+
+import os
+import sys
+import json
+import gc
+import itertools
+import time
+import argparse
+import statistics
+import contextlib
+
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.path.join(BENCHMARKS_PATH, "hot_paths_baseline.json")
+METHOD_ARN = "arn:aws:execute-api:eu-west-3:123456789012:api-id/dev/GET/get-url-counter"
+# Status codes of the benchmarked url, and urls of the whole table
+STATUS_CODES = [200, 201, 204, 301, 302, 304, 400, 401, 403, 404, 429, 500, 502, 503]
+TABLE_URLS = 100
+MIN_ROUND_US = 1000
+# Machine & moto speed, hot paths are gated relative to it
+REFERENCE = "reference_get_item"
+
+
+def time_calls(function, rounds, warmup):
+    """Return the duration in µs of a call for each of rounds rounds, after warmup
+    calls. Fast calls are repeated in a round lasting MIN_ROUND_US at least, timer
+    resolution and overhead stay negligible. Garbage left by a previous benchmark is
+    collected first, not during this one"""
+    start = time.perf_counter()
+    for _ in range(warmup):
+        function()
+    call_us = (time.perf_counter() - start) * 1000000 / max(warmup, 1)
+    calls_per_round = max(1, int(MIN_ROUND_US / max(call_us, 0.001)))
+    gc.collect()
+
+    durations = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(calls_per_round):
+            function()
+        durations.append((time.perf_counter() - start) * 1000000 / calls_per_round)
+
+    return durations
+
+
+def summarize(durations):
+    """ops/sec, p50 & p99 of call durations in µs"""
+    return {
+        "ops_per_sec": 1000000 / statistics.mean(durations),
+        "p50_us": statistics.median(durations),
+        "p99_us": statistics.quantiles(durations, n=100)[98],
+    }
+
+
+def add_ratios(report):
+    """p50 & p99 of each hot path divided by the reference p50"""
+    reference_us = report[REFERENCE]["p50_us"]
+    for summary in report.values():
+        summary["p50_ratio"] = summary["p50_us"] / reference_us
+        summary["p99_ratio"] = summary["p99_us"] / reference_us
+
+
+def get_benchmarks(target):
+    """Benchmarked calls by name, lambdas loaded against the mocked tables"""
+    # pylint: disable=import-outside-toplevel
+    import boto3
+    from back.tests.conftest import load_lambda
+
+    table = boto3.resource("dynamodb").Table("url-request-count")
+    with table.batch_writer() as batch:
+        for status_code in STATUS_CODES:
+            batch.put_item(
+                Item={"url": target, "status_code": status_code, "counter": 10}
+            )
+        for index in range(TABLE_URLS):
+            batch.put_item(
+                Item={"url": f"https://{index}.com", "status_code": 200, "counter": 1}
+            )
+
+    lambda_increment = load_lambda("request_and_increment_url_counter")
+    lambda_get = load_lambda("get_url_counter")
+    lambda_auth = load_lambda("auth")
+    lambda_aggregate = load_lambda("aggregate_url_counters")
+
+    policy = lambda_auth.AuthPolicy("principalId", "123456789012")
+    policy.rest_api_id, policy.region, policy.stage = "api-id", "eu-west-3", "dev"
+    policy.allow_method(lambda_auth.HttpVerb.GET, "*")
+    policy.allow_method(lambda_auth.HttpVerb.POST, "*")
+
+    # Each call brings new changes, retried batches would be skipped
+    sequences = itertools.count(10**20)
+
+    def get_stream_event():
+        return {
+            "Records": [
+                {
+                    "dynamodb": {
+                        "SequenceNumber": str(next(sequences)),
+                        "ApproximateCreationDateTime": 1714568400,
+                        "NewImage": {
+                            "url": {"S": target},
+                            "status_code": {"N": "200"},
+                            "counter": {"N": "2"},
+                        },
+                        "OldImage": {
+                            "url": {"S": target},
+                            "status_code": {"N": "200"},
+                            "counter": {"N": "1"},
+                        },
+                    }
+                }
+            ]
+        }
+
+    return {
+        REFERENCE: lambda: table.get_item(Key={"url": target, "status_code": 200}),
+        "increment_status_code_counter": lambda: (
+            lambda_increment.increment_status_code_counter(
+                target, 200, latencies=[12.5]
+            )
+        ),
+        "get_table_data_url": lambda: lambda_get.get_table_data(target),
+        "get_table_data_scan": lambda: lambda_get.get_table_data(None),
+        "auth_policy_build": policy.build,
+        "lambda_auth": lambda: lambda_auth.lambda_handler(
+            {"methodArn": METHOD_ARN, "authorizationToken": "MyAccessToken"}, None
+        ),
+        "lambda_get_url_counter": lambda: lambda_get.lambda_handler(
+            {"params": {"querystring": {"url": target}}}, None
+        ),
+        "lambda_request_and_increment_url_counter": lambda: (
+            lambda_increment.lambda_handler({"body-json": {"url": target}}, None)
+        ),
+        "lambda_aggregate_url_counters": lambda: lambda_aggregate.lambda_handler(
+            get_stream_event(), None
+        ),
+    }
+
+
+def check_regressions(report, baseline, max_regression, max_tail_regression):
+    """Return a message per hot path slower than its baseline past the thresholds"""
+    regressions = []
+
+    for name, summary in report.items():
+        if name not in baseline:
+            continue
+        for key, threshold in [
+            ("p50_ratio", max_regression),
+            ("p99_ratio", max_tail_regression),
+        ]:
+            if summary[key] > baseline[name][key] * (1 + threshold):
+                regressions.append(
+                    f"{name}: {key} {summary[key]:.2f}, baseline {baseline[name][key]}"
+                )
+
+    return regressions
+
+
+def main(args):
+    """Benchmark every hot path, compare with or save the baseline"""
+    # pylint: disable=import-outside-toplevel
+    import threading
+    from http.server import ThreadingHTTPServer
+    from moto import mock_dynamodb
+    from back.tests.conftest import StatusHandler
+    from back.tests.benchmarks.benchmark_cold_start import create_tables
+
+    os.environ.update(
+        {
+            "AWS_ACCESS_KEY_ID": "benchmark",
+            "AWS_SECRET_ACCESS_KEY": "benchmark",
+            "AWS_DEFAULT_REGION": "eu-west-3",
+            "TABLE_URL_REQUEST_COUNT_NAME": "url-request-count",
+            "TABLE_URL_AGGREGATES_NAME": "url-counter-aggregates",
+            # Reads are measured, not the warm cache, and moto ignores scan segments
+            "CACHE_TTL_SECONDS": "0",
+            "SCAN_SEGMENTS": "1",
+        }
+    )
+
+    http_server = ThreadingHTTPServer(("127.0.0.1", 0), StatusHandler)
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    target = f"http://127.0.0.1:{http_server.server_port}/status/200"
+
+    report = {}
+    with mock_dynamodb():
+        create_tables(None)
+        benchmarks = get_benchmarks(target)
+
+        print(f"{'hot path':<42} {'ops/sec':>10} {'p50 µs':>10} {'p99 µs':>10}")
+        for name, function in benchmarks.items():
+            if args.only and name not in args.only and name != REFERENCE:
+                continue
+            # Handlers write their JSON logs & metrics to stdout
+            with contextlib.redirect_stdout(open(os.devnull, "w", encoding="utf-8")):
+                durations = time_calls(function, args.rounds, args.warmup)
+            report[name] = summarize(durations)
+            print(
+                f"{name:<42} {report[name]['ops_per_sec']:>10.0f} "
+                f"{report[name]['p50_us']:>10.1f} {report[name]['p99_us']:>10.1f}"
+            )
+
+    http_server.shutdown()
+    add_ratios(report)
+
+    if args.save_baseline:
+        with open(BASELINE_PATH, "w", encoding="utf-8") as file:
+            json.dump(
+                {
+                    name: {
+                        key: round(value, 3 if key.endswith("ratio") else 1)
+                        for key, value in summary.items()
+                    }
+                    for name, summary in report.items()
+                    if name != REFERENCE
+                },
+                file,
+                indent=2,
+            )
+            file.write("\n")
+        print(f"\nBaseline saved in {BASELINE_PATH}")
+
+    if args.check:
+        with open(BASELINE_PATH, encoding="utf-8") as file:
+            baseline = json.load(file)
+
+        regressions = check_regressions(
+            report, baseline, args.max_regression, args.max_tail_regression
+        )
+        if regressions:
+            print("\nHot path regressions:\n" + "\n".join(regressions))
+            sys.exit(1)
+        print("\nNo hot path regression")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--only", nargs="+", help="Hot path names, default all")
+    parser.add_argument("--rounds", type=int, default=300, help="Timed rounds")
+    parser.add_argument("--warmup", type=int, default=30, help="Untimed calls first")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--check", action="store_true", help="Fail on regression")
+    parser.add_argument("--max-regression", type=float, default=0.5, help="On p50")
+    parser.add_argument("--max-tail-regression", type=float, default=3.0, help="p99")
+    main(parser.parse_args())
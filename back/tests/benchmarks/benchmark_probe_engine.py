@@ -0,0 +1,64 @@
+"""
+    Benchmark the probe engine of lambda_request_and_increment_url_counter against the
+    previous requests.get(url) probe, on a local HTTP server.
+
+        python3 -m back.tests.benchmarks.benchmark_probe_engine --body-size 1000000
+"""
+
+import os
+import time
+import argparse
+import threading
+import statistics
+from http.server import ThreadingHTTPServer
+
+import requests
+
+from back.tests.conftest import StatusHandler, load_lambda
+
+
+def legacy_probe(url):
+    """Probe as it was done before: new connection, no timeout, full body download"""
+    return requests.get(url).status_code
+
+
+def run(probe, url, probes):
+    """Return every probe duration in ms"""
+    durations = []
+    for _ in range(probes):
+        start = time.perf_counter()
+        probe(url)
+        durations.append((time.perf_counter() - start) * 1000)
+
+    return durations
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--probes", type=int, default=200)
+    parser.add_argument("--body-size", type=int, default=1000000)
+    args = parser.parse_args()
+
+    # Probes don't touch DynamoDB, the table only has to be named
+    os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-3")
+    os.environ.setdefault("TABLE_URL_REQUEST_COUNT_NAME", "benchmark")
+    lambda_probe = load_lambda("request_and_increment_url_counter")
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StatusHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    target = f"http://127.0.0.1:{server.server_port}/bytes/{args.body_size}"
+
+    print(f"{args.probes} probes of {target}")
+    print(f"{'engine':>14} {'p50 ms':>8} {'p99 ms':>8} {'probes/s':>9}")
+    for name, probe in [
+        ("requests.get", legacy_probe),
+        ("probe_url", lambda_probe.probe_url),
+    ]:
+        durations = run(probe, target, args.probes)
+        print(
+            f"{name:>14} {statistics.median(durations):>8.2f} "
+            f"{statistics.quantiles(durations, n=100)[98]:>8.2f} "
+            f"{1000 * len(durations) / sum(durations):>9.0f}"
+        )
+
+    server.shutdown()
@@ -0,0 +1,136 @@
+"""
+    Replay recorded API requests against the in-process BackStack API emulator, see
+    back/tests/api_emulator.py, at a target rate. Lambdas run against moto DynamoDB and
+    probe a local HTTP target. Reports throughput and latency percentiles, measured
+    from the time each request was due.
+
+    The log is JSON lines of emulator.request arguments: method, path, query, headers
+    & body, "{target}" is replaced by the local HTTP target base url. It is replayed
+    in a loop up to --requests.
+
+        python3 -m back.tests.benchmarks.benchmark_replay --rate 200 --requests 2000
+        python3 -m back.tests.benchmarks.benchmark_replay --context AUTHORIZER_CACHE_TTL=0
+        python3 -m back.tests.benchmarks.benchmark_replay --log my_requests.jsonl
+"""
+
+import os
+import json
+import logging
+import argparse
+import threading
+import contextlib
+
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+LOG_PATH = os.path.join(BENCHMARKS_PATH, "replay_requests.jsonl")
+
+
+def serialized(lock, method):
+    """Wrap a method so that calls don't overlap"""
+
+    def wrapper(*args, **kwargs):
+        with lock:
+            return method(*args, **kwargs)
+
+    return wrapper
+
+
+def load_requests(log_path, target, count):
+    """count requests of the log, replayed in a loop"""
+    with open(log_path, encoding="utf-8") as file:
+        logged = [
+            json.loads(line.replace("{target}", target))
+            for line in file
+            if line.strip()
+        ]
+
+    return [logged[index % len(logged)] for index in range(count)]
+
+
+def parse_context(values):
+    """NAME=value pairs, values are JSON when they parse"""
+    context = {}
+    for value in values or []:
+        name, _, raw = value.partition("=")
+        try:
+            context[name] = json.loads(raw)
+        except ValueError:
+            context[name] = raw
+    return context
+
+
+def main(args):
+    """Synthesize BackStack, emulate it and replay the log"""
+    # pylint: disable=import-outside-toplevel
+    from http.server import ThreadingHTTPServer
+    from moto import mock_dynamodb, mock_sqs
+    from moto.dynamodb.models import DynamoDBBackend
+    from back.tests.conftest import StatusHandler
+    from back.tests.test_back_stack import synth_back_stack
+    from back.tests.api_emulator import ApiEmulator, replay
+
+    os.environ.update(
+        {
+            "AWS_ACCESS_KEY_ID": "benchmark",
+            "AWS_SECRET_ACCESS_KEY": "benchmark",
+            "AWS_DEFAULT_REGION": "eu-west-3",
+        }
+    )
+    # DynamoDB serves concurrent requests, moto's backend must not
+    lock = threading.Lock()
+    for method in [
+        "get_item",
+        "put_item",
+        "update_item",
+        "query",
+        "scan",
+        "batch_write_item",
+    ]:
+        setattr(
+            DynamoDBBackend, method, serialized(lock, getattr(DynamoDBBackend, method))
+        )
+    logging.getLogger("botocore").setLevel(logging.ERROR)
+
+    context = parse_context(args.context)
+    template = synth_back_stack(args.conf, **context).to_json()
+
+    http_server = ThreadingHTTPServer(("127.0.0.1", 0), StatusHandler)
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    requests = load_requests(
+        args.log, f"http://127.0.0.1:{http_server.server_port}", args.requests
+    )
+
+    with mock_dynamodb(), mock_sqs():
+        emulator = ApiEmulator(template)
+        # Lambdas write their JSON logs & metrics to stdout
+        with contextlib.redirect_stdout(open(os.devnull, "w", encoding="utf-8")):
+            report = replay(emulator, requests, args.rate, args.workers)
+
+    http_server.shutdown()
+
+    print(
+        f"{report['requests']} requests in {report['duration_s']:.1f}s, "
+        f"{report['throughput']:.1f} req/s for {report['target_rate']} req/s targeted, "
+        f"{report['authorizer_invocations']} authorizer invocations"
+    )
+    print(f"status codes: {report['status_codes']}")
+    print(f"{'':<10} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for name in ["service", "latency"]:
+        print(
+            f"{name:<10} "
+            + " ".join(
+                f"{report[name][key]:>8.1f}"
+                for key in ["p50_ms", "p90_ms", "p99_ms", "max_ms"]
+            )
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--log", default=LOG_PATH, help="Recorded requests, JSON lines")
+    parser.add_argument("--conf", default="test", help="conf/<conf>_conf.json stage")
+    parser.add_argument("--context", nargs="+", help="Conf overrides, NAME=value")
+    parser.add_argument("--rate", type=float, default=100, help="Requests per second")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=16, help="Concurrent requests")
+    main(parser.parse_args())
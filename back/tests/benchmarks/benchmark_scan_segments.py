@@ -0,0 +1,88 @@
+"""
+    Benchmark full table reads of lambda_get_url_counter against the number of scan
+    segments.
+
+    moto does not implement parallel scans, run it against DynamoDB Local:
+        docker run -p 8000:8000 amazon/dynamodb-local
+        python3 -m back.tests.benchmarks.benchmark_scan_segments --items 200000
+"""
+
+import os
+import time
+import argparse
+
+import boto3
+
+from back.tests.conftest import load_lambda
+
+
+def get_table(endpoint_url, table_name, items):
+    """Create and fill the benchmark table unless it already holds enough items"""
+    ddb = boto3.resource("dynamodb", endpoint_url=endpoint_url)
+
+    if table_name not in [table.name for table in ddb.tables.all()]:
+        ddb.create_table(
+            TableName=table_name,
+            KeySchema=[
+                {"AttributeName": "url", "KeyType": "HASH"},
+                {"AttributeName": "status_code", "KeyType": "RANGE"},
+            ],
+            AttributeDefinitions=[
+                {"AttributeName": "url", "AttributeType": "S"},
+                {"AttributeName": "status_code", "AttributeType": "N"},
+            ],
+            BillingMode="PAY_PER_REQUEST",
+        ).wait_until_exists()
+
+    table = ddb.Table(table_name)
+    if table.item_count < items:
+        print(f"Loading {items} items in {table_name}")
+        with table.batch_writer() as batch:
+            for index in range(items):
+                batch.put_item(
+                    Item={
+                        "url": f"https://benchmark-{index}.com",
+                        "status_code": 200,
+                        "counter": index,
+                    }
+                )
+
+    return table
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--endpoint-url", default="http://localhost:8000")
+    parser.add_argument("--table-name", default="url-request-count-benchmark")
+    parser.add_argument("--items", type=int, default=100000)
+    parser.add_argument("--page-size", type=int, default=None)
+    parser.add_argument("--segments", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    args = parser.parse_args()
+
+    # DynamoDB Local accepts any credentials
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-3")
+    os.environ["TABLE_URL_REQUEST_COUNT_NAME"] = args.table_name
+
+    lambda_get = load_lambda("get_url_counter")
+    lambda_get.TABLE_URL_REQUEST_COUNT = get_table(
+        args.endpoint_url, args.table_name, args.items
+    )
+
+    print(
+        f"{'segments':>8} {'items':>10} {'seconds':>8} {'items/s':>10} {'speedup':>8}"
+    )
+    reference = None
+    for total_segments in args.segments:
+        start = time.perf_counter()
+        read = sum(
+            1 for _ in lambda_get.scan_table(total_segments, page_size=args.page_size)
+        )
+        elapsed = time.perf_counter() - start
+        reference = reference or elapsed
+
+        print(
+            f"{total_segments:>8} {read:>10} {elapsed:>8.2f} "
+            f"{read / elapsed:>10.0f} {reference / elapsed:>7.2f}x"
+        )
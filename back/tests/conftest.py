@@ -0,0 +1,185 @@
+""" Shared fixtures for Back Stack unit tests """
+
+import os
+import sys
+import time
+import zlib
+import threading
+import importlib.util
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import boto3
+import pytest
+from moto import mock_dynamodb, mock_sqs
+
+
+LAMBDAS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../lambdas")
+# Shared layer content, found in /opt/python by deployed lambdas
+LAMBDAS_SHARED_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "../lambdas_shared/python"
+)
+sys.path.insert(0, LAMBDAS_SHARED_PATH)
+
+# pylint: disable=wrong-import-position,wrong-import-order
+from lambdas_shared import aws
+
+
+@pytest.fixture
+def aws_credentials(monkeypatch):
+    """Fake credentials so no test can ever reach a real AWS account"""
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_SECURITY_TOKEN", "testing")
+    monkeypatch.setenv("AWS_SESSION_TOKEN", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "eu-west-3")
+
+
+@pytest.fixture
+def url_request_count_table(aws_credentials, monkeypatch):
+    """Moto version of the url-request-count table from BackStack"""
+    # pylint: disable=unused-argument,redefined-outer-name
+    # Resources are kept by the shared layer, don't reuse those of another test
+    aws.get_resource.cache_clear()
+
+    with mock_dynamodb():
+        table = boto3.resource("dynamodb").create_table(
+            TableName="url-request-count",
+            KeySchema=[
+                {"AttributeName": "url", "KeyType": "HASH"},
+                {"AttributeName": "status_code", "KeyType": "RANGE"},
+            ],
+            AttributeDefinitions=[
+                {"AttributeName": "url", "AttributeType": "S"},
+                {"AttributeName": "status_code", "AttributeType": "N"},
+            ],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        monkeypatch.setenv("TABLE_URL_REQUEST_COUNT_NAME", table.name)
+        yield table
+
+
+@pytest.fixture
+def url_counter_aggregates_table(url_request_count_table, monkeypatch):
+    """Moto version of the url-counter-aggregates table from BackStack"""
+    # pylint: disable=unused-argument,redefined-outer-name
+    table = boto3.resource("dynamodb").create_table(
+        TableName="url-counter-aggregates",
+        KeySchema=[
+            {"AttributeName": "pk", "KeyType": "HASH"},
+            {"AttributeName": "sk", "KeyType": "RANGE"},
+        ],
+        AttributeDefinitions=[
+            {"AttributeName": "pk", "AttributeType": "S"},
+            {"AttributeName": "sk", "AttributeType": "S"},
+            {"AttributeName": "status_shard", "AttributeType": "S"},
+            {"AttributeName": "bucket", "AttributeType": "S"},
+        ],
+        GlobalSecondaryIndexes=[
+            {
+                "IndexName": "status-bucket",
+                "KeySchema": [
+                    {"AttributeName": "status_shard", "KeyType": "HASH"},
+                    {"AttributeName": "bucket", "KeyType": "RANGE"},
+                ],
+                "Projection": {
+                    "ProjectionType": "INCLUDE",
+                    "NonKeyAttributes": ["url", "status_code", "counter"],
+                },
+            }
+        ],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    monkeypatch.setenv("TABLE_URL_AGGREGATES_NAME", table.name)
+    yield table
+
+
+@pytest.fixture
+def probe_queue(url_request_count_table, monkeypatch):
+    """Moto version of the url probes queue from BackStack async mode"""
+    # pylint: disable=unused-argument,redefined-outer-name
+    with mock_sqs():
+        queue_url = boto3.client("sqs").create_queue(QueueName="url-probes")["QueueUrl"]
+        monkeypatch.setenv("PROBE_QUEUE_URL", queue_url)
+        yield queue_url
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    """Local probes target:
+    - /status/<code>: answer <code>
+    - /sleep/<seconds>: answer 200 once slept
+    - /bytes/<size>: answer 200 with a <size> bytes body
+    - /get-only: answer 405 to HEAD requests, 200 to GET
+    anything else answers 200"""
+
+    def _reply(self, with_body):
+        """Send the status code requested in path"""
+        parts = self.path.strip("/").split("/")
+        status_code = int(parts[1]) if parts[0] == "status" else 200
+        body_size = int(parts[1]) if parts[0] == "bytes" else 0
+        if parts[0] == "sleep":
+            time.sleep(float(parts[1]))
+        if parts[0] == "get-only" and not with_body:
+            status_code = 405
+
+        self.send_response(status_code)
+        self.send_header("Content-Length", str(body_size))
+        self.end_headers()
+        if with_body and body_size:
+            self.wfile.write(b"x" * body_size)
+
+    # pylint: disable=invalid-name
+    def do_GET(self):
+        """GET requests"""
+        self._reply(with_body=True)
+
+    # pylint: disable=invalid-name
+    def do_HEAD(self):
+        """HEAD requests"""
+        self._reply(with_body=False)
+
+    def log_message(self, *_):
+        """Keep tests output clean"""
+
+
+@pytest.fixture(scope="session")
+def http_server():
+    """Local HTTP target for probes, returns its base url"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StatusHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield f"http://127.0.0.1:{server.server_port}"
+
+    server.shutdown()
+
+
+def emulate_segmented_scan(table, monkeypatch):
+    """moto ignores Segment & TotalSegments and returns the whole table to every
+    segment, split items between segments on their partition key like DynamoDB does"""
+    scan = table.scan
+
+    def segmented_scan(Segment=None, TotalSegments=None, **kwargs):
+        # pylint: disable=invalid-name
+        res = scan(**kwargs)
+        if TotalSegments:
+            res["Items"] = [
+                item
+                for item in res["Items"]
+                if zlib.crc32(item["url"].encode()) % TotalSegments == Segment
+            ]
+        return res
+
+    monkeypatch.setattr(table, "scan", segmented_scan)
+
+
+def load_lambda(name):
+    """Import a fresh copy of back/lambdas/lambda_<name>/lambda_<name>.py
+    Lambdas read their environment at import time, so import them once mocks are set"""
+    module_name = f"lambda_{name}"
+    spec = importlib.util.spec_from_file_location(
+        module_name, os.path.join(LAMBDAS_PATH, module_name, f"{module_name}.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
@@ -0,0 +1,186 @@
+""" Unit Tests for the in-process API emulator """
+
+import json
+import functools
+
+import pytest
+from moto import mock_dynamodb, mock_sqs
+
+from back.tests.api_emulator import ApiEmulator, AuthorizerCache, render_template
+from back.tests.api_emulator import replay, TemplateInput, TemplateUtil
+from back.tests.test_back_stack import synth_back_stack
+
+
+HEADERS = {"AuthToken": "MyAccessToken", "User-Agent": "pytest"}
+
+
+@functools.lru_cache(maxsize=None)
+def get_template(**context):
+    """BackStack test template, synthesized once per context"""
+    return synth_back_stack(**context).to_json()
+
+
+@pytest.fixture(name="emulator")
+def fixture_emulator(aws_credentials):
+    """Emulator of the test stage API, with a clock moved by hand"""
+    # pylint: disable=unused-argument
+    now = [1000.0]
+    with mock_dynamodb(), mock_sqs():
+        emulator = ApiEmulator(get_template(), clock=lambda: now[0])
+        emulator.now = now
+        yield emulator
+
+
+def get_request_template(template):
+    """default_request_template of the GET /get-url-counter integration"""
+    return next(
+        resource["Properties"]["Integration"]["RequestTemplates"]["application/json"]
+        for resource in template["Resources"].values()
+        if resource["Type"] == "AWS::ApiGateway::Method"
+        and resource["Properties"]["HttpMethod"] == "GET"
+    )
+
+
+def test_request_template_renders_lambda_event():
+    """default_request_template gives the event lambdas read in template mode"""
+    rendered = render_template(
+        get_request_template(get_template()),
+        {
+            "input": TemplateInput(
+                '{"url": "https://a.com/\\u00e9"}',
+                {},
+                {"url": "https://a.com", "limit": "10"},
+                {"AuthToken": "MyAccessToken", "Accept": 'text/"json"'},
+            ),
+            "util": TemplateUtil(),
+            "context": {
+                "httpMethod": "POST",
+                "stage": "test",
+                "resourcePath": "/increment-url-counter",
+                "authorizer": {"principalId": "user"},
+                "identity": {"sourceIp": "203.0.113.10"},
+            },
+            "stageVariables": {},
+        },
+    )
+
+    event = json.loads(rendered)
+    assert event["body-json"] == {"url": "https://a.com/é"}
+    assert event["params"] == {
+        "path": {},
+        "querystring": {"url": "https://a.com", "limit": "10"},
+        "header": {"AuthToken": "MyAccessToken", "Accept": 'text/"json"'},
+    }
+    assert event["stage-variables"] == {}
+    assert event["context"]["http-method"] == "POST"
+    assert event["context"]["resource-path"] == "/increment-url-counter"
+    assert event["context"]["authorizer-principal-id"] == "user"
+    assert event["context"]["source-ip"] == "203.0.113.10"
+    assert event["context"]["user-arn"] == ""
+
+
+def test_requests_go_through_authorizer_and_handlers(emulator, http_server):
+    """Counters written through POST are read through GET, with CORS headers"""
+    target = f"{http_server}/status/404"
+
+    posted = emulator.request(
+        "POST",
+        "/increment-url-counter",
+        headers={**HEADERS, "Content-Type": "application/json"},
+        body={"url": target},
+    )
+    read = emulator.request(
+        "GET", "/get-url-counter", query={"url": target}, headers=HEADERS
+    )
+
+    assert posted.status_code == 201
+    assert posted.body["counter"] == 1
+    assert read.status_code == 200
+    assert read.headers == {"Access-Control-Allow-Origin": "*"}
+    assert [(item["status_code"], item["counter"]) for item in read.body] == [(404, 1)]
+
+
+def test_authorizer_results_cache_ttl(emulator):
+    """A token policy is reused until AuthorizerResultTtlInSeconds elapsed"""
+    ttl = next(iter(emulator.authorizers.values())).ttl
+
+    def invoked():
+        return emulator.request("GET", "/get-url-counter", headers=HEADERS)[3]
+
+    assert ttl == 60
+    assert [invoked(), invoked()] == [True, False]
+    emulator.now[0] += ttl
+    assert invoked()
+
+    cache = AuthorizerCache(ttl=0)
+    for _ in range(3):
+        cache.get("MyAccessToken", dict)
+    assert cache.invocations == 3
+
+
+def test_gateway_responses(emulator):
+    """Rejected by API Gateway: bad token, unknown route, unparsable template"""
+    assert emulator.request("GET", "/get-url-counter", headers={"AuthToken": "x"}) == (
+        401,
+        {},
+        {"message": "Unauthorized"},
+        False,
+    )
+    assert emulator.request("GET", "/unknown", headers=HEADERS) == (
+        403,
+        {},
+        {"message": "Missing Authentication Token"},
+        False,
+    )
+    # escapeJavaScript escapes single quotes, which JSON doesn't allow
+    assert (
+        emulator.request(
+            "GET", "/get-url-counter", query={"url": "it's"}, headers=HEADERS
+        ).status_code
+        == 400
+    )
+    preflight = emulator.request("OPTIONS", "/get-url-counter")
+    assert preflight.status_code == 204
+    assert "AuthToken" in preflight.headers["Access-Control-Allow-Headers"]
+
+
+def test_lambda_errors_keep_default_status(emulator):
+    """Without selection pattern, lambda errors get the default integration response"""
+    response = emulator.request(
+        "GET", "/get-url-counter", query={"limit": "0"}, headers=HEADERS
+    )
+
+    assert response.status_code == 200
+    assert response.body["errorType"] == "Runtime.MarshalError"
+
+
+def test_proxy_routes(aws_credentials):
+    """Proxy routes get the proxy event and answer their own status code"""
+    # pylint: disable=unused-argument
+    template = synth_back_stack(APIGW_PROXY_ROUTES=["/get-url-counter"]).to_json()
+
+    with mock_dynamodb(), mock_sqs():
+        emulator = ApiEmulator(template)
+        response = emulator.request(
+            "GET", "/get-url-counter", query={"url": "https://a.com"}, headers=HEADERS
+        )
+
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == "application/json"
+    assert response.body == []
+
+
+def test_replay_reports_throughput_and_latency(emulator):
+    """Every request is sent, latencies are measured from their due time"""
+    requests = [
+        {"method": "GET", "path": "/get-url-counter", "headers": HEADERS},
+        {"method": "OPTIONS", "path": "/get-url-counter"},
+    ] * 10
+
+    report = replay(emulator, requests, rate=500, workers=1)
+
+    assert report["requests"] == 20
+    assert report["status_codes"] == {200: 10, 204: 10}
+    assert report["authorizer_invocations"] == 1
+    assert report["throughput"] > 0
+    assert report["latency"]["p99_ms"] >= report["service"]["p50_ms"]
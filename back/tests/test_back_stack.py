@@ -1,24 +1,483 @@
-""" Unit Tests for Front Stack """
-# import aws_cdk as cdk
-
-# from aws_cdk import assertions
-
-# from back.back_stack import BackStack
-
-# app = cdk.App()
-# ENV = cdk.Environment(
-#     region=app.node.try_get_context("AWS_DEFAULT_REGION"),
-#     account=app.node.try_get_context("AWS_ACCOUNT"),
-# )
-# PROJECT_NAME = app.node.try_get_context("PROJECT_NAME")
-# STAGE = app.node.try_get_context("STAGE")
-
-# # example tests. To run these tests, uncomment this file along with the example
-# # resource in aws_cdk_jenkins_cicd/aws_cdk_jenkins_cicd_stack.py
-# def test_sqs_queue_created():
-#     """Example Unit Test"""
-#     print(ENV)
-#     stack = BackStack(app, f"back-{PROJECT_NAME}-{STAGE}", env=ENV)
-#     template = assertions.Template.from_stack(stack)
-
-# template.has_resource_properties("AWS::SQS::Queue", {"VisibilityTimeout": 300})
+""" Unit Tests for Back Stack """
+
+import json
+import os
+
+import aws_cdk as cdk
+from aws_cdk import assertions
+
+from back.back_stack import BackStack
+
+
+CONF_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../conf")
+
+
+def synth_back_stack(conf="test", **context):
+    """Synthesize BackStack with a stage conf, overridden by context"""
+    with open(os.path.join(CONF_PATH, f"{conf}_conf.json"), encoding="utf-8") as file:
+        app = cdk.App(context={**json.load(file), **context})
+
+    stack = BackStack(
+        app,
+        f"back-{app.node.try_get_context('PROJECT_NAME')}-{conf}",
+        # VPC lookup needs an explicit account & region
+        env=cdk.Environment(account="123456789012", region="eu-west-3"),
+    )
+
+    return assertions.Template.from_stack(stack)
+
+
+def test_sync_mode_has_no_probes_queue():
+    """By default probes are run inside the API request"""
+    template = synth_back_stack()
+
+    # The counters stream DLQ only
+    template.resource_count_is("AWS::SQS::Queue", 1)
+    template.has_resource_properties(
+        "AWS::ApiGateway::Method",
+        {
+            "HttpMethod": "POST",
+            "MethodResponses": [assertions.Match.object_like({"StatusCode": "201"})],
+        },
+    )
+
+
+def test_async_mode_creates_probes_pipeline():
+    """Async mode enqueues probes and consumes them by batches"""
+    template = synth_back_stack(URL_COUNTER_ASYNC=True)
+
+    template.resource_count_is("AWS::SQS::Queue", 3)
+    template.has_resource_properties(
+        "AWS::Lambda::EventSourceMapping",
+        {"BatchSize": 100, "FunctionResponseTypes": ["ReportBatchItemFailures"]},
+    )
+    template.has_resource_properties(
+        "AWS::Lambda::Function",
+        {"Handler": "lambda_request_and_increment_url_counter.batch_handler"},
+    )
+    template.has_resource_properties(
+        "AWS::ApiGateway::Method",
+        {
+            "HttpMethod": "POST",
+            "MethodResponses": [assertions.Match.object_like({"StatusCode": "202"})],
+        },
+    )
+
+
+def test_counters_stream_feeds_aggregates():
+    """Counters table streams its changes to the aggregates lambda"""
+    template = synth_back_stack()
+
+    template.resource_count_is("AWS::DynamoDB::Table", 2)
+    template.has_resource_properties(
+        "AWS::DynamoDB::Table",
+        {"StreamSpecification": {"StreamViewType": "NEW_AND_OLD_IMAGES"}},
+    )
+    template.has_resource_properties(
+        "AWS::Lambda::EventSourceMapping",
+        {
+            "StartingPosition": "TRIM_HORIZON",
+            "BatchSize": 500,
+            "BisectBatchOnFunctionError": True,
+            "DestinationConfig": {
+                "OnFailure": {"Destination": assertions.Match.any_value()}
+            },
+        },
+    )
+
+
+def test_api_stage_caching():
+    """Stage caching is keyed on the get-url-counter querystring"""
+    assert not synth_back_stack().find_resources(
+        "AWS::ApiGateway::Stage", {"Properties": {"CacheClusterEnabled": True}}
+    )
+
+    template = synth_back_stack(API_CACHE_CLUSTER_SIZE="0.5")
+
+    template.has_resource_properties(
+        "AWS::ApiGateway::Stage",
+        {
+            "CacheClusterEnabled": True,
+            "CacheClusterSize": "0.5",
+            "MethodSettings": assertions.Match.array_with(
+                [
+                    assertions.Match.object_like(
+                        {
+                            "ResourcePath": "/~1get-url-counter",
+                            "HttpMethod": "GET",
+                            "CachingEnabled": True,
+                            "CacheTtlInSeconds": 30,
+                        }
+                    )
+                ]
+            ),
+        },
+    )
+    template.has_resource_properties(
+        "AWS::ApiGateway::Method",
+        {
+            "HttpMethod": "GET",
+            "RequestParameters": assertions.Match.object_like(
+                {"method.request.querystring.url": False}
+            ),
+            "Integration": assertions.Match.object_like(
+                {
+                    "CacheKeyParameters": assertions.Match.array_with(
+                        ["method.request.querystring.url"]
+                    )
+                }
+            ),
+        },
+    )
+
+
+def test_authorizer_cache_ttl_per_stage():
+    """Authorizer results are cached for the TTL of the stage conf"""
+    synth_back_stack("test").has_resource_properties(
+        "AWS::ApiGateway::Authorizer", {"AuthorizerResultTtlInSeconds": 60}
+    )
+    synth_back_stack("prod").has_resource_properties(
+        "AWS::ApiGateway::Authorizer", {"AuthorizerResultTtlInSeconds": 300}
+    )
+
+
+def test_authorizer_jwt_mode():
+    """A JWKS url switches lambda_auth to JWT verification"""
+    template = synth_back_stack(
+        AUTH_JWT={"JWKS_URL": "https://issuer/.well-known/jwks.json"}
+    )
+
+    template.has_resource_properties(
+        "AWS::ApiGateway::Authorizer",
+        {"IdentityValidationExpression": r"^(Bearer )?[\w-]+\.[\w-]+\.[\w-]+$"},
+    )
+    template.has_resource_properties(
+        "AWS::Lambda::Function",
+        {
+            "Handler": "lambda_auth.lambda_handler",
+            "Layers": assertions.Match.any_value(),
+            "Environment": {
+                "Variables": assertions.Match.object_like(
+                    {"JWKS_URL": "https://issuer/.well-known/jwks.json"}
+                )
+            },
+        },
+    )
+
+
+def test_lambda_profiles_per_stage():
+    """Memory, timeout and concurrency of each lambda come from the stage conf"""
+    test_template = synth_back_stack("test")
+    test_template.has_resource_properties(
+        "AWS::Lambda::Function",
+        {
+            "FunctionName": "auth-project-name-test",
+            "MemorySize": 128,
+            "Timeout": 10,
+            "ReservedConcurrentExecutions": assertions.Match.absent(),
+        },
+    )
+    test_template.resource_count_is("AWS::Lambda::Alias", 0)
+
+    prod_template = synth_back_stack("prod")
+    prod_template.has_resource_properties(
+        "AWS::Lambda::Function",
+        {
+            "FunctionName": "auth-project-name-production",
+            "MemorySize": 512,
+            "Timeout": 5,
+            "ReservedConcurrentExecutions": 100,
+        },
+    )
+    prod_template.has_resource_properties(
+        "AWS::Lambda::Function",
+        {
+            "FunctionName": "request-and-increment-url-counter-project-name-production",
+            "MemorySize": 1024,
+        },
+    )
+    prod_template.resource_count_is("AWS::Lambda::Alias", 2)
+    prod_template.has_resource_properties(
+        "AWS::Lambda::Alias",
+        {
+            "Name": "live",
+            "ProvisionedConcurrencyConfig": {"ProvisionedConcurrentExecutions": 2},
+        },
+    )
+    # API Gateway invokes the aliases carrying the provisioned concurrency
+    for alias_id in prod_template.find_resources("AWS::Lambda::Alias"):
+        prod_template.has_resource_properties(
+            "AWS::Lambda::Permission",
+            {
+                "FunctionName": {"Ref": alias_id},
+                "Principal": "apigateway.amazonaws.com",
+            },
+        )
+
+
+def test_vpc_layout():
+    """Lambdas are in the VPC with a DynamoDB endpoint, unless their profile opts out"""
+    template = synth_back_stack()
+
+    template.has_resource_properties(
+        "AWS::EC2::VPCEndpoint",
+        {
+            "ServiceName": {
+                "Fn::Join": [
+                    "",
+                    ["com.amazonaws.", {"Ref": "AWS::Region"}, ".dynamodb"],
+                ]
+            },
+            "VpcEndpointType": "Gateway",
+        },
+    )
+    template.resource_count_is("AWS::EC2::VPCEndpoint", 1)
+    template.has_resource_properties(
+        "AWS::Lambda::Function",
+        {
+            "FunctionName": "get-url-counter-project-name-test",
+            "VpcConfig": assertions.Match.object_like(
+                {"SubnetIds": ["p-12345", "p-67890"]}
+            ),
+        },
+    )
+    template.has_resource_properties(
+        "AWS::Lambda::Function",
+        {
+            "FunctionName": "auth-project-name-test",
+            "VpcConfig": assertions.Match.absent(),
+        },
+    )
+
+    # Everything in the VPC, and an SQS endpoint for the async probes queue
+    in_vpc_profiles = {
+        name: {"IN_VPC": True}
+        for name in ["auth", "request_and_increment_url_counter", "consume_url_probes"]
+    }
+    template = synth_back_stack(LAMBDA_PROFILES=in_vpc_profiles, URL_COUNTER_ASYNC=True)
+
+    template.resource_count_is("AWS::EC2::VPCEndpoint", 2)
+    template.has_resource_properties(
+        "AWS::EC2::VPCEndpoint",
+        {"ServiceName": "com.amazonaws.eu-west-3.sqs", "VpcEndpointType": "Interface"},
+    )
+    template.has_resource_properties(
+        "AWS::Lambda::Function",
+        {
+            "FunctionName": "auth-project-name-test",
+            "VpcConfig": assertions.Match.object_like({}),
+        },
+    )
+
+
+def test_public_only_vpc():
+    """A VPC without private subnets, like the default one, gets lambdas in its public subnets"""
+    lookup_key = (
+        "vpc-provider:account=123456789012:filter.isDefault=true:filter.vpc-id=vpc-id"
+        ":region=eu-west-3:returnAsymmetricSubnets=true"
+    )
+    public_subnets = [
+        {
+            "subnetId": f"s-{zone}",
+            "cidr": cidr,
+            "availabilityZone": f"eu-west-3{zone}",
+            "routeTableId": "rtb-12345",
+        }
+        for zone, cidr in [("a", "172.31.0.0/20"), ("b", "172.31.16.0/20")]
+    ]
+    template = synth_back_stack(
+        **{
+            lookup_key: {
+                "vpcId": "vpc-12345",
+                "vpcCidrBlock": "172.31.0.0/16",
+                "availabilityZones": [],
+                "subnetGroups": [
+                    {"name": "Public", "type": "Public", "subnets": public_subnets}
+                ],
+            }
+        }
+    )
+
+    template.has_resource_properties(
+        "AWS::Lambda::Function",
+        {
+            "FunctionName": "get-url-counter-project-name-test",
+            "VpcConfig": assertions.Match.object_like({"SubnetIds": ["s-a", "s-b"]}),
+        },
+    )
+    template.resource_count_is("AWS::EC2::VPCEndpoint", 1)
+
+
+def test_proxy_routes():
+    """Routes listed in APIGW_PROXY_ROUTES skip the request template"""
+    template = synth_back_stack(APIGW_PROXY_ROUTES=["/get-url-counter"])
+
+    template.has_resource_properties(
+        "AWS::ApiGateway::Method",
+        {
+            "HttpMethod": "GET",
+            "Integration": assertions.Match.object_like(
+                {
+                    "Type": "AWS_PROXY",
+                    "RequestTemplates": assertions.Match.absent(),
+                    "CacheKeyParameters": assertions.Match.array_with(
+                        ["method.request.querystring.url"]
+                    ),
+                }
+            ),
+        },
+    )
+    template.has_resource_properties(
+        "AWS::ApiGateway::Method",
+        {
+            "HttpMethod": "POST",
+            "Integration": assertions.Match.object_like(
+                {
+                    "Type": "AWS",
+                    "RequestTemplates": assertions.Match.object_like(
+                        {"application/json": assertions.Match.any_value()}
+                    ),
+                }
+            ),
+        },
+    )
+
+
+def test_rest_api_endpoint_type_and_compression():
+    """EDGE or REGIONAL REST API, responses compressed above the conf threshold"""
+    template = synth_back_stack()
+    template.has_resource_properties(
+        "AWS::ApiGateway::RestApi",
+        {
+            "EndpointConfiguration": {"Types": ["REGIONAL"]},
+            "MinimumCompressionSize": 1024,
+        },
+    )
+    template.resource_count_is("AWS::ApiGatewayV2::Api", 0)
+
+    template = synth_back_stack(
+        API_ENDPOINT_TYPE="EDGE", API_MINIMUM_COMPRESSION_SIZE=None
+    )
+    template.has_resource_properties(
+        "AWS::ApiGateway::RestApi",
+        {
+            "EndpointConfiguration": {"Types": ["EDGE"]},
+            "MinimumCompressionSize": assertions.Match.absent(),
+        },
+    )
+
+
+def test_http_api_endpoint_type():
+    """HTTP API with the same authorizer lambda and routes, proxied to the lambdas"""
+    template = synth_back_stack(API_ENDPOINT_TYPE="HTTP")
+
+    template.resource_count_is("AWS::ApiGateway::RestApi", 0)
+    template.has_resource_properties(
+        "AWS::ApiGatewayV2::Api",
+        {
+            "ProtocolType": "HTTP",
+            "CorsConfiguration": assertions.Match.object_like(
+                {"AllowHeaders": ["Content-Type", "AuthToken"]}
+            ),
+        },
+    )
+    template.has_resource_properties(
+        "AWS::ApiGatewayV2::Authorizer",
+        {
+            "AuthorizerType": "REQUEST",
+            "AuthorizerPayloadFormatVersion": "1.0",
+            "IdentitySource": ["$request.header.AuthToken"],
+            "AuthorizerResultTtlInSeconds": 60,
+        },
+    )
+    template.resource_count_is("AWS::ApiGatewayV2::Route", 2)
+    for route_key in ["POST /increment-url-counter", "GET /get-url-counter"]:
+        template.has_resource_properties(
+            "AWS::ApiGatewayV2::Route",
+            {"RouteKey": route_key, "AuthorizationType": "CUSTOM"},
+        )
+    template.resource_count_is("AWS::ApiGatewayV2::Integration", 2)
+    template.has_resource_properties(
+        "AWS::ApiGatewayV2::Integration",
+        {"IntegrationType": "AWS_PROXY", "PayloadFormatVersion": "1.0"},
+    )
+    template.has_resource_properties(
+        "AWS::Lambda::Function",
+        {
+            "Handler": "lambda_auth.lambda_handler",
+            "Environment": {
+                "Variables": assertions.Match.object_like(
+                    {"AUTH_TOKEN_PATTERN": "MyAccessToken"}
+                )
+            },
+        },
+    )
+
+
+def test_instrumentation_conf_per_stage():
+    """Every lambda gets the stage instrumentation settings, auth the shared layer"""
+    template = synth_back_stack(conf="prod")
+
+    for handler in [
+        "lambda_auth.lambda_handler",
+        "lambda_get_url_counter.lambda_handler",
+        "lambda_aggregate_url_counters.lambda_handler",
+    ]:
+        template.has_resource_properties(
+            "AWS::Lambda::Function",
+            {
+                "Handler": handler,
+                "Environment": {
+                    "Variables": assertions.Match.object_like(
+                        {
+                            "LOG_LEVEL": "INFO",
+                            "LOG_EVENT_SAMPLE_RATE": "0.01",
+                            "METRICS_ENABLED": "true",
+                            "METRICS_NAMESPACE": "project-name",
+                        }
+                    )
+                },
+            },
+        )
+    (lambda_auth,) = template.find_resources(
+        "AWS::Lambda::Function",
+        {"Properties": {"Handler": "lambda_auth.lambda_handler"}},
+    ).values()
+    assert len(lambda_auth["Properties"]["Layers"]) == 1
+
+
+def test_aggregates_table_buckets_ttl_and_status_index():
+    """Hourly buckets expire and are indexed on status & bucket"""
+    template = synth_back_stack()
+
+    template.has_resource_properties(
+        "AWS::DynamoDB::Table",
+        {
+            "TimeToLiveSpecification": {
+                "AttributeName": "expires_at",
+                "Enabled": True,
+            },
+            "GlobalSecondaryIndexes": [
+                assertions.Match.object_like(
+                    {
+                        "IndexName": "status-bucket",
+                        "KeySchema": [
+                            {"AttributeName": "status_shard", "KeyType": "HASH"},
+                            {"AttributeName": "bucket", "KeyType": "RANGE"},
+                        ],
+                    }
+                )
+            ],
+        },
+    )
+    template.has_resource_properties(
+        "AWS::Lambda::Function",
+        {
+            "Handler": "lambda_aggregate_url_counters.lambda_handler",
+            "Environment": {
+                "Variables": assertions.Match.object_like(
+                    {"BUCKET_RETENTION_DAYS": "30", "STATUS_INDEX_SHARDS": "4"}
+                )
+            },
+        },
+    )
@@ -0,0 +1,175 @@
+""" Unit Tests for the authorizer lambda """
+
+import json
+import time
+
+import jwt
+import pytest
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from back.tests.conftest import load_lambda
+
+
+METHOD_ARN = (
+    "arn:aws:execute-api:eu-west-3:123456789012:api-id/test/GET/get-url-counter"
+)
+
+
+def test_policy_is_built_once_per_api_stage(monkeypatch):
+    """Warm invocations reuse the policy built for the same api & stage"""
+    lambda_auth = load_lambda("auth")
+    builds = []
+    build_policy = lambda_auth.build_policy
+    monkeypatch.setattr(
+        lambda_auth,
+        "build_policy",
+        lambda *key: builds.append(key) or build_policy(*key),
+    )
+
+    first = lambda_auth.lambda_handler({"methodArn": METHOD_ARN}, None)
+    second = lambda_auth.lambda_handler({"methodArn": METHOD_ARN}, None)
+    lambda_auth.lambda_handler(
+        {"methodArn": METHOD_ARN.replace("/test/", "/dev/")}, None
+    )
+
+    assert first == second
+    assert len(builds) == 2
+    assert first["policyDocument"]["Statement"][0]["Resource"] == [
+        "arn:aws:execute-api:eu-west-3:123456789012:api-id/test/GET/*",
+        "arn:aws:execute-api:eu-west-3:123456789012:api-id/test/POST/*",
+    ]
+    assert "context" not in next(iter(lambda_auth.POLICIES_CACHE.values()))
+
+
+def test_policies_cache_is_bounded():
+    """Least recently used policies are dropped once the cache is full"""
+    lambda_auth = load_lambda("auth")
+    lambda_auth.POLICIES_CACHE_SIZE = 2
+
+    for stage in ["a", "b", "a", "c"]:
+        lambda_auth.lambda_handler(
+            {"methodArn": METHOD_ARN.replace("/test/", f"/{stage}/")}, None
+        )
+
+    assert [key[-1] for key in lambda_auth.POLICIES_CACHE] == ["a", "c"]
+
+
+def test_invalid_resource_path_is_refused():
+    """Precompiled path pattern still validates resources"""
+    lambda_auth = load_lambda("auth")
+    policy = lambda_auth.AuthPolicy("principal", "123456789012")
+
+    with pytest.raises(NameError):
+        policy.allow_method(lambda_auth.HttpVerb.GET, "/invalid path")
+
+
+def generate_jwk(kid):
+    """Generate a RSA private key and the public JWK matching it"""
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(private_key.public_key()))
+
+    return private_key, {**jwk, "kid": kid, "use": "sig"}
+
+
+@pytest.fixture(name="signing_key")
+def fixture_signing_key(monkeypatch):
+    """Private key of the JWKS given to lambda_auth"""
+    private_key, jwk = generate_jwk("key-1")
+    monkeypatch.setenv("JWKS", json.dumps({"keys": [jwk]}))
+    monkeypatch.setenv("JWT_ISSUER", "https://issuer")
+
+    return private_key
+
+
+def sign(private_key, kid="key-1", **claims):
+    """Return a signed JWT"""
+    claims = {
+        "sub": "user-1",
+        "iss": "https://issuer",
+        "exp": time.time() + 60,
+        **claims,
+    }
+    return jwt.encode(claims, private_key, algorithm="RS256", headers={"kid": kid})
+
+
+def authorize(lambda_auth, token):
+    """Invoke lambda_auth like a TOKEN authorizer does"""
+    return lambda_auth.lambda_handler(
+        {"methodArn": METHOD_ARN, "authorizationToken": token}, None
+    )
+
+
+def test_jwt_verified_and_claims_cached(signing_key, monkeypatch):
+    """Valid token gives its subject as principal, and is verified only once"""
+    lambda_auth = load_lambda("auth")
+    decodes = []
+    decode = lambda_auth.jwt.decode
+    monkeypatch.setattr(
+        lambda_auth.jwt,
+        "decode",
+        lambda *args, **kwargs: decodes.append(args) or decode(*args, **kwargs),
+    )
+    token = sign(signing_key)
+
+    assert authorize(lambda_auth, f"Bearer {token}")["principalId"] == "user-1"
+    assert authorize(lambda_auth, token)["principalId"] == "user-1"
+    assert len(decodes) == 1
+
+
+@pytest.mark.parametrize(
+    "claims",
+    [{"exp": time.time() - 1}, {"iss": "https://other-issuer"}, {"kid": "unknown"}],
+)
+def test_invalid_jwt_is_unauthorized(signing_key, claims):
+    """Expired, foreign or unknown key tokens are refused"""
+    lambda_auth = load_lambda("auth")
+
+    with pytest.raises(Exception, match="Unauthorized"):
+        authorize(lambda_auth, sign(signing_key, **claims))
+
+
+def test_signing_keys_rotation_and_negative_lookups(monkeypatch):
+    """Unknown kids reload the key set at most once per min_refresh"""
+    lambda_auth = load_lambda("auth")
+    key_sets = [{"key-1": "public-1"}, {"key-1": "public-1", "key-2": "public-2"}]
+    loads = []
+    now = [1000.0]
+    signing_keys = lambda_auth.SigningKeys(
+        lambda: loads.append(now[0]) or key_sets[min(len(loads) - 1, 1)],
+        max_age=3600,
+        min_refresh=60,
+    )
+    monkeypatch.setattr(lambda_auth.time, "monotonic", lambda: now[0])
+
+    assert signing_keys.get("key-1") == "public-1"
+    for _ in range(10):
+        assert signing_keys.get("key-2") is None
+    assert len(loads) == 1
+
+    now[0] += 60
+    assert signing_keys.get("key-2") == "public-2"
+    assert len(loads) == 2
+
+
+def test_http_api_identity_source_and_token_pattern(monkeypatch):
+    """HTTP APIs REQUEST events carry the token in identitySource, and have no
+    validation regex: malformed tokens are refused by lambda_auth itself"""
+    monkeypatch.setenv("AUTH_TOKEN_PATTERN", "MyAccessToken")
+    lambda_auth = load_lambda("auth")
+
+    for identity_source in ["MyAccessToken", ["MyAccessToken"]]:
+        response = lambda_auth.lambda_handler(
+            {
+                "type": "REQUEST",
+                "methodArn": METHOD_ARN,
+                "identitySource": identity_source,
+            },
+            None,
+        )
+        assert response["policyDocument"]["Statement"][0]["Effect"] == "Allow"
+
+    for identity_source in ["OtherToken", None]:
+        with pytest.raises(Exception, match="Unauthorized"):
+            lambda_auth.lambda_handler(
+                {"methodArn": METHOD_ARN, "identitySource": identity_source}, None
+            )
@@ -0,0 +1,96 @@
+""" Unit Tests for the probe engine of the request and increment lambda """
+
+import time
+
+from back.tests.conftest import load_lambda
+
+
+def test_probe_uses_head_without_body(url_request_count_table, http_server):
+    """HEAD is enough when the target allows it, latency is measured"""
+    # pylint: disable=unused-argument
+    lambda_probe = load_lambda("request_and_increment_url_counter")
+    methods = []
+    request = lambda_probe.SESSION.request
+    lambda_probe.SESSION.request = lambda method, *args, **kwargs: (
+        methods.append(method) or request(method, *args, **kwargs)
+    )
+
+    result = lambda_probe.probe_url(f"{http_server}/bytes/1000000")
+
+    assert result.status_code == 200
+    assert result.latency_ms > 0
+    assert methods == ["HEAD"]
+
+
+def test_probe_falls_back_to_get(url_request_count_table, http_server):
+    """Targets refusing HEAD are probed with a streamed GET"""
+    # pylint: disable=unused-argument
+    lambda_probe = load_lambda("request_and_increment_url_counter")
+
+    assert lambda_probe.probe_url(f"{http_server}/get-only").status_code == 200
+    assert lambda_probe.probe_url(f"{http_server}/status/404").status_code == 404
+
+
+def test_probe_timeout_counts_as_unreachable(url_request_count_table, http_server):
+    """Read timeout is configurable and an unanswered probe is a 500"""
+    # pylint: disable=unused-argument
+    lambda_probe = load_lambda("request_and_increment_url_counter")
+    lambda_probe.PROBE_READ_TIMEOUT = 0.2
+
+    assert lambda_probe.probe_url(f"{http_server}/sleep/1") == (500, None)
+
+
+def test_latency_is_stored_with_counter(url_request_count_table, http_server):
+    """Counter items keep the sum, count and last value of probes latency"""
+    lambda_probe = load_lambda("request_and_increment_url_counter")
+    event = {"body-json": {"url": f"{http_server}/status/200"}}
+
+    lambda_probe.lambda_handler(event, None)
+    res = lambda_probe.lambda_handler(event, None)
+
+    item = url_request_count_table.get_item(
+        Key={"url": f"{http_server}/status/200", "status_code": 200}
+    )["Item"]
+    assert item["counter"] == 2
+    assert item["latency_samples"] == 2
+    assert item["latency_ms_sum"] >= item["last_latency_ms"] == res["latency_ms"]
+
+
+def test_probe_requests_share_the_deadline(url_request_count_table, monkeypatch):
+    """GET after a refused HEAD only gets the time left before the deadline"""
+    # pylint: disable=unused-argument
+    lambda_probe = load_lambda("request_and_increment_url_counter")
+    timeouts = {}
+
+    def request_without_body(method, url, timeout):
+        timeouts[method] = timeout
+        time.sleep(0.3)
+        return lambda_probe.ProbeResult(405 if method == "HEAD" else 200, 300.0)
+
+    monkeypatch.setattr(lambda_probe, "request_without_body", request_without_body)
+
+    result = lambda_probe.probe_url("https://a.com", deadline=time.monotonic() + 1)
+
+    assert result.status_code == 200
+    assert timeouts["HEAD"][1] > 0.9
+    assert timeouts["GET"][1] < 0.75
+
+
+def test_late_probes_are_dropped(url_request_count_table, monkeypatch):
+    """Probes answered after the deadline give no result and no metric"""
+    # pylint: disable=unused-argument
+    lambda_probe = load_lambda("request_and_increment_url_counter")
+    monkeypatch.setattr(
+        lambda_probe,
+        "request_without_body",
+        lambda method, url, timeout: time.sleep(0.3)
+        or lambda_probe.ProbeResult(200, 300.0),
+    )
+    lambda_probe.instrumentation.METRICS.clear()
+
+    assert (
+        lambda_probe.probe_url_before("https://a.com", time.monotonic() + 0.1) is None
+    )
+    assert lambda_probe.probe_urls(["https://a.com"], time.monotonic() + 0.1) == [None]
+    time.sleep(0.5)
+    assert "ProbeLatency" not in lambda_probe.instrumentation.METRICS
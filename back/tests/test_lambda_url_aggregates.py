@@ -0,0 +1,278 @@
+""" Unit Tests for the url counters aggregates """
+
+import itertools
+from datetime import datetime, timezone
+
+import pytest
+from boto3.dynamodb.types import TypeSerializer
+
+from back.tests.conftest import load_lambda
+
+
+SERIALIZER = TypeSerializer()
+# Stream SequenceNumbers have 21 digits at least
+SEQUENCES = itertools.count(10**20)
+
+
+def stream_record(old=None, new=None, at=None):
+    """Build a DynamoDB stream record from old & new counter items, changed at the
+    at datetime, with the next sequence number"""
+    images = {"SequenceNumber": str(next(SEQUENCES))}
+    for name, item in [("OldImage", old), ("NewImage", new)]:
+        if item:
+            images[name] = {
+                key: SERIALIZER.serialize(value) for key, value in item.items()
+            }
+
+    if at:
+        images["ApproximateCreationDateTime"] = at.timestamp()
+
+    return {"dynamodb": images}
+
+
+def get_global_total(table, lambda_aggregate):
+    """Sum of the global total shards counters"""
+    total = 0
+    for key in lambda_aggregate.counter_buckets.get_global_keys():
+        total += table.get_item(Key=key).get("Item", {}).get("counter", 0)
+
+    return total
+
+
+def test_stream_records_maintain_aggregates(url_counter_aggregates_table):
+    """Inserts, updates and sharded counters all end up in the summaries"""
+    lambda_aggregate = load_lambda("aggregate_url_counters")
+
+    lambda_aggregate.lambda_handler(
+        {
+            "Records": [
+                stream_record(
+                    new={"url": "https://a.com", "status_code": 200, "counter": 1}
+                ),
+                stream_record(
+                    old={"url": "https://a.com", "status_code": 200, "counter": 1},
+                    new={"url": "https://a.com", "status_code": 200, "counter": 3},
+                ),
+                stream_record(
+                    new={"url": "https://a.com", "status_code": 503, "counter": 2}
+                ),
+                stream_record(
+                    new={
+                        "url": "https://b.com#1",
+                        "shard_of": "https://b.com",
+                        "status_code": 404,
+                        "counter": 4,
+                    }
+                ),
+            ]
+        },
+        None,
+    )
+
+    def get_aggregate(partition_key, sort_key):
+        return url_counter_aggregates_table.get_item(
+            Key={"pk": partition_key, "sk": sort_key}
+        )["Item"]
+
+    assert {
+        name: value
+        for name, value in get_aggregate("URL", "https://a.com").items()
+        if not name.startswith("seq#")
+    } == {
+        "pk": "URL",
+        "sk": "https://a.com",
+        "counter": 5,
+        "counter_2xx": 3,
+        "counter_5xx": 2,
+    }
+    assert get_aggregate("URL", "https://b.com")["counter_4xx"] == 4
+    assert get_aggregate("CLASS#5xx", "https://a.com")["counter"] == 2
+    assert get_global_total(url_counter_aggregates_table, lambda_aggregate) == 9
+    assert not any(
+        name.startswith("seq#")
+        for item in url_counter_aggregates_table.scan()["Items"]
+        if item["pk"].startswith("GLOBAL#")
+        for name in item
+    )
+
+
+def test_retried_stream_batches_are_counted_once(url_counter_aggregates_table):
+    """A batch failing after some writes, retried whole then split in two, changes
+    every aggregate once"""
+    lambda_aggregate = load_lambda("aggregate_url_counters")
+    records = [
+        stream_record(new={"url": "https://a.com", "status_code": 200, "counter": 1}),
+        stream_record(
+            old={"url": "https://a.com", "status_code": 200, "counter": 1},
+            new={"url": "https://a.com", "status_code": 200, "counter": 2},
+        ),
+        stream_record(new={"url": "https://b.com", "status_code": 500, "counter": 1}),
+        stream_record(
+            old={"url": "https://a.com", "status_code": 200, "counter": 2},
+            new={"url": "https://a.com", "status_code": 200, "counter": 4},
+        ),
+    ]
+    # Aggregates of the first records are written before the batch fails
+    lambda_aggregate.write_aggregates(lambda_aggregate.merge_deltas(records[:2]))
+
+    for batch in [records, records[:2], records[2:]]:
+        lambda_aggregate.lambda_handler({"Records": batch}, None)
+
+    def get_counter(partition_key, sort_key):
+        return url_counter_aggregates_table.get_item(
+            Key={"pk": partition_key, "sk": sort_key}
+        )["Item"]["counter"]
+
+    assert get_counter("URL", "https://a.com") == 4
+    assert get_counter("CLASS#2xx", "https://a.com") == 4
+    assert get_counter("URL", "https://b.com") == 1
+    assert get_global_total(url_counter_aggregates_table, lambda_aggregate) == 5
+
+
+def test_get_url_counter_summaries(url_counter_aggregates_table):
+    """Summaries are read from the aggregates table"""
+    for partition_key, sort_key, counter in [
+        ("URL", "https://a.com", 5),
+        ("URL", "https://b.com", 1),
+        ("CLASS#5xx", "https://b.com", 1),
+        ("GLOBAL#0", "TOTAL", 2),
+        ("GLOBAL#3", "TOTAL", 4),
+    ]:
+        url_counter_aggregates_table.put_item(
+            Item={
+                "pk": partition_key,
+                "sk": sort_key,
+                "counter": counter,
+                "seq#200#https://a.com": "1",
+            }
+        )
+    lambda_get = load_lambda("get_url_counter")
+
+    def get_summary(**querystring):
+        return lambda_get.lambda_handler({"params": {"querystring": querystring}}, None)
+
+    assert get_summary(summary="global") == [{"counter": 6}]
+    assert get_summary(summary="urls") == [
+        {"url": "https://a.com", "counter": 5},
+        {"url": "https://b.com", "counter": 1},
+    ]
+    assert get_summary(summary="urls", url="https://b.com") == [
+        {"url": "https://b.com", "counter": 1}
+    ]
+    assert get_summary(summary="5xx") == [{"url": "https://b.com", "counter": 1}]
+    assert get_summary(summary="4xx") == []
+
+
+def hour(value):
+    """UTC datetime of 2024-05-01 at the given hour"""
+    return datetime(2024, 5, 1, value, 30, tzinfo=timezone.utc)
+
+
+def write_buckets(lambda_aggregate):
+    """Counters changed at 10:30, 11:30 and 12:30"""
+    lambda_aggregate.lambda_handler(
+        {
+            "Records": [
+                stream_record(
+                    new={"url": "https://a.com", "status_code": 200, "counter": 2},
+                    at=hour(10),
+                ),
+                stream_record(
+                    old={"url": "https://a.com", "status_code": 200, "counter": 2},
+                    new={"url": "https://a.com", "status_code": 200, "counter": 5},
+                    at=hour(11),
+                ),
+                stream_record(
+                    new={"url": "https://a.com", "status_code": 503, "counter": 1},
+                    at=hour(11),
+                ),
+                stream_record(
+                    new={
+                        "url": "https://b.com#3",
+                        "shard_of": "https://b.com",
+                        "status_code": 500,
+                        "counter": 4,
+                    },
+                    at=hour(12),
+                ),
+                stream_record(
+                    new={"url": "https://c.com", "status_code": 503, "counter": 2},
+                    at=hour(12),
+                ),
+            ]
+        },
+        None,
+    )
+
+
+def test_stream_records_fill_hourly_buckets(url_counter_aggregates_table):
+    """Each change lands in the bucket of its hour, with its TTL & index keys"""
+    lambda_aggregate = load_lambda("aggregate_url_counters")
+    write_buckets(lambda_aggregate)
+
+    def get_bucket(url, sort_key):
+        return url_counter_aggregates_table.get_item(
+            Key={"pk": f"BUCKET#{url}", "sk": sort_key}
+        )["Item"]
+
+    assert get_bucket("https://a.com", "2024-05-01T10#200")["counter"] == 2
+    item = get_bucket("https://a.com", "2024-05-01T11#200")
+    assert item["counter"] == 3
+    assert item["bucket"] == "2024-05-01T11"
+    assert item["status_code"] == 200
+    assert item["status_shard"].startswith("2xx#")
+    # End of the bucket hour + 30 days retention
+    assert (
+        item["expires_at"] == datetime(2024, 5, 31, 12, tzinfo=timezone.utc).timestamp()
+    )
+    assert get_bucket("https://b.com", "2024-05-01T12#500")["url"] == "https://b.com"
+
+
+def test_get_url_counter_time_ranges_never_scan(
+    url_counter_aggregates_table, monkeypatch
+):
+    """Time ranges of an url and status classes are read with queries only"""
+    write_buckets(load_lambda("aggregate_url_counters"))
+    lambda_get = load_lambda("get_url_counter")
+    for table in [lambda_get.TABLE_URL_REQUEST_COUNT, lambda_get.TABLE_URL_AGGREGATES]:
+        monkeypatch.setattr(table, "scan", pytest.fail)
+
+    def get_counters(**querystring):
+        return lambda_get.lambda_handler({"params": {"querystring": querystring}}, None)
+
+    assert get_counters(
+        url="https://a.com", **{"from": "2024-05-01T11:00Z", "to": "2024-05-01T12:00Z"}
+    ) == [
+        {
+            "url": "https://a.com",
+            "bucket": "2024-05-01T11",
+            "status_code": 200,
+            "counter": 3,
+        },
+        {
+            "url": "https://a.com",
+            "bucket": "2024-05-01T11",
+            "status_code": 503,
+            "counter": 1,
+        },
+    ]
+    assert [
+        item["counter"]
+        for item in get_counters(
+            url="https://a.com", status="2xx", to="2024-05-01T12:00Z", hours="3"
+        )
+    ] == [2, 3]
+
+    assert get_counters(status="5xx", to="2024-05-01T12:59Z", hours="24") == [
+        {"url": "https://b.com", "status_code": 500, "counter": 4},
+        {"url": "https://c.com", "status_code": 503, "counter": 2},
+        {"url": "https://a.com", "status_code": 503, "counter": 1},
+    ]
+    assert get_counters(status="503", to="2024-05-01T12:59Z", hours="24") == [
+        {"url": "https://c.com", "status_code": 503, "counter": 2},
+        {"url": "https://a.com", "status_code": 503, "counter": 1},
+    ]
+    assert get_counters(status="5xx", to="2024-05-01T11:59Z", hours="1") == [
+        {"url": "https://a.com", "status_code": 503, "counter": 1}
+    ]
+    assert isinstance(get_counters(hours="1"), ValueError)
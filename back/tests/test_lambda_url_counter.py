@@ -0,0 +1,377 @@
+""" Unit Tests for URL counter lambdas """
+
+import json
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from moto.dynamodb.models import DynamoDBBackend
+
+from back.tests.conftest import emulate_segmented_scan, load_lambda
+
+
+def test_increment_creates_then_increments_counter(url_request_count_table):
+    """First call creates the counter, next ones increment it"""
+    # pylint: disable=unused-argument
+    lambda_increment = load_lambda("request_and_increment_url_counter")
+
+    first = lambda_increment.increment_status_code_counter("https://a.com", 200)
+    second = lambda_increment.increment_status_code_counter("https://a.com", 200)
+
+    assert first == {"url": "https://a.com", "status_code": 200, "counter": 1}
+    assert second["counter"] == 2
+
+
+def serialized(lock, method):
+    """Wrap a method so that calls don't overlap"""
+
+    def wrapper(*args, **kwargs):
+        with lock:
+            return method(*args, **kwargs)
+
+    return wrapper
+
+
+def test_concurrent_increments_are_single_adds(url_request_count_table, monkeypatch):
+    """Racing increments each send one UpdateItem ADD, never a read then a write back:
+    DynamoDB applies every ADD atomically, so none is lost, sharded or not"""
+    # moto doesn't lock items during updates, DynamoDB does
+    monkeypatch.setattr(
+        DynamoDBBackend,
+        "update_item",
+        serialized(threading.Lock(), DynamoDBBackend.update_item),
+    )
+    lambda_increment = load_lambda("request_and_increment_url_counter")
+    lambda_increment.URL_COUNTER_SHARDS = {"https://hot.com": 8}
+    increments = 400
+    calls = []
+
+    def record_call(params, model, **_):
+        calls.append((model.name, params["UpdateExpression"]))
+
+    events = lambda_increment.TABLE_URL_REQUEST_COUNT.meta.client.meta.events
+    events.register("before-parameter-build.dynamodb", record_call)
+    try:
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            for url in ["https://a.com", "https://hot.com"]:
+                list(
+                    executor.map(
+                        lambda _, url=url: (
+                            lambda_increment.increment_status_code_counter(url, 200)
+                        ),
+                        range(increments),
+                    )
+                )
+    finally:
+        events.unregister("before-parameter-build.dynamodb", record_call)
+
+    assert len(calls) == 2 * increments
+    assert all(
+        name == "UpdateItem" and expression.startswith("ADD #counter :increment")
+        for name, expression in calls
+    )
+    items = url_request_count_table.scan()["Items"]
+    assert {item["url"] for item in items if "shard_of" in item} <= {
+        f"https://hot.com#{shard}" for shard in range(8)
+    }
+    assert {item["url"] for item in items if "shard_of" not in item} == {
+        "https://a.com"
+    }
+    totals = Counter()
+    for item in items:
+        totals[item.get("shard_of", item["url"])] += item["counter"]
+    assert totals == {"https://a.com": increments, "https://hot.com": increments}
+
+
+def test_get_url_counter_merges_shards(url_request_count_table, monkeypatch):
+    """Reader sums every shard of an url, including pre-sharding counters"""
+    url_request_count_table.put_item(
+        Item={"url": "https://hot.com", "status_code": 200, "counter": 5}
+    )
+    for shard in range(3):
+        url_request_count_table.put_item(
+            Item={
+                "url": f"https://hot.com#{shard}",
+                "status_code": 200,
+                "counter": 10,
+                "shard_of": "https://hot.com",
+            }
+        )
+    url_request_count_table.put_item(
+        Item={
+            "url": "https://hot.com#1",
+            "status_code": 404,
+            "counter": 1,
+            "shard_of": "https://hot.com",
+        }
+    )
+    monkeypatch.setenv("URL_COUNTER_SHARDS", json.dumps({"https://hot.com": 3}))
+    lambda_get = load_lambda("get_url_counter")
+    emulate_segmented_scan(lambda_get.TABLE_URL_REQUEST_COUNT, monkeypatch)
+
+    items = lambda_get.lambda_handler(
+        {"params": {"querystring": {"url": "https://hot.com"}}}, None
+    )
+
+    assert sorted(items, key=lambda item: item["status_code"]) == [
+        {"url": "https://hot.com", "status_code": 200, "counter": 35},
+        {"url": "https://hot.com", "status_code": 404, "counter": 1},
+    ]
+    assert {"url": "https://hot.com", "status_code": 200, "counter": 35} in (
+        lambda_get.lambda_handler({}, None)
+    )
+
+
+def test_get_url_counter_pages_sharded_url(url_request_count_table, monkeypatch):
+    """Pages of an url follow the status codes, shards merged on every page"""
+    # 302 only on one shard, the other shard query skips it. moto pages in write
+    # order, items are written in sort key order
+    for shard in range(2):
+        for status_code in [200, 301, 302, 404, 500]:
+            if status_code == 302 and shard == 0:
+                continue
+            url_request_count_table.put_item(
+                Item={
+                    "url": f"https://hot.com#{shard}",
+                    "status_code": status_code,
+                    "counter": 7 if status_code == 302 else shard + 1,
+                    "latency_ms_sum": 10,
+                    "shard_of": "https://hot.com",
+                }
+            )
+    monkeypatch.setenv("URL_COUNTER_SHARDS", json.dumps({"https://hot.com": 2}))
+    lambda_get = load_lambda("get_url_counter")
+
+    pages = []
+    querystring = {"url": "https://hot.com", "limit": "2", "fields": "counter"}
+    while True:
+        page = lambda_get.lambda_handler({"params": {"querystring": querystring}}, None)
+        pages.append(page["items"])
+        if not page["next_cursor"]:
+            break
+        querystring = {**querystring, "cursor": page["next_cursor"]}
+
+    assert pages == [
+        [
+            {"url": "https://hot.com", "status_code": 200, "counter": 3},
+            {"url": "https://hot.com", "status_code": 301, "counter": 3},
+        ],
+        [
+            {"url": "https://hot.com", "status_code": 302, "counter": 7},
+            {"url": "https://hot.com", "status_code": 404, "counter": 3},
+        ],
+        [{"url": "https://hot.com", "status_code": 500, "counter": 3}],
+    ]
+
+
+def test_get_url_counter_pages_whole_table(url_request_count_table):
+    """Whole table pages are bounded Scan pages, consistent reads skip the cache"""
+    with url_request_count_table.batch_writer() as batch:
+        for index in range(25):
+            batch.put_item(
+                Item={"url": f"https://{index}.com", "status_code": 200, "counter": 1}
+            )
+    lambda_get = load_lambda("get_url_counter")
+
+    urls = []
+    querystring = {"limit": "10", "consistent": "true"}
+    while querystring:
+        page = lambda_get.lambda_handler({"params": {"querystring": querystring}}, None)
+        assert len(page["items"]) <= 10
+        urls.extend(item["url"] for item in page["items"])
+        querystring = page["next_cursor"] and {
+            "limit": "10",
+            "consistent": "true",
+            "cursor": page["next_cursor"],
+        }
+
+    assert sorted(urls) == sorted(f"https://{index}.com" for index in range(25))
+    assert lambda_get.CACHE.stats()["entries"] == 0
+
+
+def test_get_url_counter_pages_whole_table_shards(url_request_count_table, monkeypatch):
+    """Whole table pages return each sharded url once, summed over every shard,
+    whichever pages its shards are scanned on"""
+    for url, counter, shard_of in [
+        ("https://a.com", 1, None),
+        ("https://hot.com#1", 3, "https://hot.com"),
+        ("https://b.com", 1, None),
+        ("https://hot.com", 4, None),
+        ("https://hot.com#0", 2, "https://hot.com"),
+        ("https://old.com#0", 5, "https://old.com"),
+    ]:
+        item = {"url": url, "status_code": 200, "counter": counter}
+        url_request_count_table.put_item(
+            Item={**item, "shard_of": shard_of} if shard_of else item
+        )
+    monkeypatch.setenv("URL_COUNTER_SHARDS", json.dumps({"https://hot.com": 2}))
+    lambda_get = load_lambda("get_url_counter")
+
+    items = []
+    querystring = {"limit": "2", "fields": "counter"}
+    while querystring:
+        page = lambda_get.lambda_handler({"params": {"querystring": querystring}}, None)
+        items.extend(page["items"])
+        querystring = page["next_cursor"] and {
+            "limit": "2",
+            "fields": "counter",
+            "cursor": page["next_cursor"],
+        }
+
+    assert sorted(items, key=lambda item: item["url"]) == [
+        {"url": "https://a.com", "status_code": 200, "counter": 1},
+        {"url": "https://b.com", "status_code": 200, "counter": 1},
+        {"url": "https://hot.com", "status_code": 200, "counter": 9},
+        # No longer in URL_COUNTER_SHARDS, its other shards can't be found
+        {"url": "https://old.com", "status_code": 200, "counter": 5, "partial": True},
+    ]
+
+
+def test_get_url_counter_rejects_bad_page_parameters(url_request_count_table):
+    """Unknown fields, out of range limits & forged cursors are refused"""
+    # pylint: disable=unused-argument
+    lambda_get = load_lambda("get_url_counter")
+
+    for querystring in [
+        {"fields": "counter,secret"},
+        {"limit": "0"},
+        {"limit": str(lambda_get.MAX_PAGE_SIZE + 1)},
+        {"cursor": "not-a-cursor"},
+        {"cursor": lambda_get.encode_cursor(["url"])},
+    ]:
+        assert isinstance(
+            lambda_get.lambda_handler({"params": {"querystring": querystring}}, None),
+            ValueError,
+        )
+
+
+def test_segmented_scan_reads_every_page(url_request_count_table, monkeypatch):
+    """Full table read goes through every segment and every page"""
+    with url_request_count_table.batch_writer() as batch:
+        for index in range(250):
+            batch.put_item(
+                Item={"url": f"https://{index}.com", "status_code": 200, "counter": 1}
+            )
+    lambda_get = load_lambda("get_url_counter")
+    emulate_segmented_scan(lambda_get.TABLE_URL_REQUEST_COUNT, monkeypatch)
+
+    items = list(lambda_get.scan_table(total_segments=4, page_size=20))
+
+    assert len(items) == 250
+    assert len({item["url"] for item in items}) == 250
+
+
+def test_segmented_scan_stops_when_reader_leaves(url_request_count_table, monkeypatch):
+    """Closing the stream early must not leave segments blocked on the queue"""
+    with url_request_count_table.batch_writer() as batch:
+        for index in range(100):
+            batch.put_item(
+                Item={"url": f"https://{index}.com", "status_code": 200, "counter": 1}
+            )
+    lambda_get = load_lambda("get_url_counter")
+    emulate_segmented_scan(lambda_get.TABLE_URL_REQUEST_COUNT, monkeypatch)
+
+    items = lambda_get.scan_table(total_segments=2, page_size=1)
+    first = next(items)
+    items.close()
+
+    assert first["counter"] == 1
+
+
+def test_get_url_counter_cache(url_request_count_table, monkeypatch):
+    """Warm invocations are served from cache until the entry expires"""
+    url_request_count_table.put_item(
+        Item={"url": "https://a.com", "status_code": 200, "counter": 1}
+    )
+    lambda_get = load_lambda("get_url_counter")
+    event = {"params": {"querystring": {"url": "https://a.com"}}}
+    now = [1000.0]
+    monkeypatch.setattr(lambda_get.time, "monotonic", lambda: now[0])
+    metrics = []
+    monkeypatch.setattr(
+        lambda_get.instrumentation,
+        "put_metric",
+        lambda name, value, unit="Count": metrics.append((name, value)),
+    )
+
+    assert lambda_get.lambda_handler(event, None)[0]["counter"] == 1
+    url_request_count_table.put_item(
+        Item={"url": "https://a.com", "status_code": 200, "counter": 2}
+    )
+    assert lambda_get.lambda_handler(event, None)[0]["counter"] == 1
+
+    now[0] += lambda_get.CACHE.ttl
+    assert lambda_get.lambda_handler(event, None)[0]["counter"] == 2
+    assert lambda_get.CACHE.stats() == {
+        "hits": 1,
+        "misses": 2,
+        "entries": 1,
+        "max_entries": 256,
+    }
+    # Each invocation reports its hits & misses, not only the container totals
+    assert [name for name, _ in metrics if name.startswith("Cache")] == [
+        "CacheMisses",
+        "CacheEntries",
+        "CacheHits",
+        "CacheEntries",
+        "CacheMisses",
+        "CacheEntries",
+    ]
+
+
+def test_ttl_cache_evicts_least_recently_used(url_request_count_table):
+    """Cache never holds more than max_entries"""
+    # pylint: disable=unused-argument
+    lambda_get = load_lambda("get_url_counter")
+    cache = lambda_get.TTLCache(max_entries=2, ttl=60)
+
+    cache.get("a", lambda: 1)
+    cache.get("b", lambda: 2)
+    cache.get("a", lambda: 1)
+    cache.get("c", lambda: 3)
+
+    assert list(cache.entries) == ["a", "c"]
+
+
+def test_get_url_counter_proxy_integration(url_request_count_table):
+    """Proxy events get a proxy response with the same counters"""
+    url_request_count_table.put_item(
+        Item={"url": "https://a.com", "status_code": 200, "counter": 2}
+    )
+    lambda_get = load_lambda("get_url_counter")
+
+    response = lambda_get.lambda_handler(
+        {
+            "httpMethod": "GET",
+            "requestContext": {"stage": "test"},
+            "queryStringParameters": {"url": "https://a.com"},
+        },
+        None,
+    )
+
+    assert response["statusCode"] == 200
+    assert json.loads(response["body"]) == [
+        {"url": "https://a.com", "status_code": 200, "counter": 2}
+    ]
+
+
+def test_handler_emits_probe_and_capacity_metrics(
+    url_request_count_table, http_server, capsys
+):
+    """Probe latency and DynamoDB consumed capacity of the invocation are written"""
+    # pylint: disable=unused-argument
+    lambda_increment = load_lambda("request_and_increment_url_counter")
+
+    lambda_increment.lambda_handler(
+        {"body-json": {"url": f"{http_server}/status/200"}}, None
+    )
+    metrics = [
+        json.loads(line)
+        for line in capsys.readouterr().out.splitlines()
+        if '"_aws"' in line
+    ]
+
+    assert len(metrics) == 1
+    assert metrics[0]["ProbeLatency"] > 0
+    assert metrics[0]["DynamoDBConsumedCapacity"] > 0
+    assert "HandlerLatency" in metrics[0]
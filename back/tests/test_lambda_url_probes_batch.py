@@ -0,0 +1,106 @@
+""" Unit Tests for batch probes of the request and increment lambda """
+
+import time
+
+from back.tests.conftest import load_lambda
+
+
+class LambdaContext:
+    """Minimal lambda context, only remaining time is used"""
+
+    def __init__(self, remaining_seconds):
+        self.remaining_seconds = remaining_seconds
+
+    def get_remaining_time_in_millis(self):
+        """Lambda context API"""
+        return self.remaining_seconds * 1000
+
+
+def test_batch_probes_write_grouped_counters(url_request_count_table, http_server):
+    """Each url gets its result, identical (url, status_code) share one write"""
+    lambda_probe = load_lambda("request_and_increment_url_counter")
+    urls = [f"{http_server}/status/200"] * 3 + [f"{http_server}/status/404"]
+
+    res = lambda_probe.lambda_handler(
+        {"body-json": {"urls": urls}}, LambdaContext(remaining_seconds=10)
+    )
+
+    assert [result["status_code"] for result in res["results"]] == [200] * 3 + [404]
+    assert [result["counter"] for result in res["results"]] == [3, 3, 3, 1]
+    assert len(url_request_count_table.scan()["Items"]) == 2
+
+
+def test_batch_probes_respect_deadline(url_request_count_table, http_server):
+    """Probes still running at the deadline are reported, not counted"""
+    lambda_probe = load_lambda("request_and_increment_url_counter")
+    lambda_probe.DEADLINE_MARGIN_SECONDS = 0
+
+    res = lambda_probe.lambda_handler(
+        {
+            "body-json": {
+                "urls": [f"{http_server}/status/200", f"{http_server}/sleep/3"]
+            }
+        },
+        LambdaContext(remaining_seconds=1),
+    )
+
+    assert res["results"][0]["counter"] == 1
+    assert res["results"][1] == {
+        "url": f"{http_server}/sleep/3",
+        "error": "deadline exceeded",
+    }
+    assert len(url_request_count_table.scan()["Items"]) == 1
+
+
+def test_batch_probes_limit_concurrency_per_host(url_request_count_table, http_server):
+    """A single host never gets more than PROBE_PER_HOST_CONCURRENCY probes at once"""
+    # pylint: disable=unused-argument
+    lambda_probe = load_lambda("request_and_increment_url_counter")
+    lambda_probe.PROBE_PER_HOST_CONCURRENCY = 1
+    lambda_probe.DEADLINE_MARGIN_SECONDS = 0
+
+    res = lambda_probe.probe_urls(
+        [f"{http_server}/sleep/0.5"] * 3, lambda_probe.get_deadline(LambdaContext(1.5))
+    )
+
+    # Serialized on the same host, only 2 probes fit before the deadline
+    assert [result and result.status_code for result in res] == [200, 200, None]
+
+
+def test_batch_probes_dont_block_on_busy_host(url_request_count_table, http_server):
+    """Urls of a busy host wait for it without holding workers other hosts could use"""
+    # pylint: disable=unused-argument
+    lambda_probe = load_lambda("request_and_increment_url_counter")
+    lambda_probe.PROBE_CONCURRENCY = 2
+    lambda_probe.PROBE_PER_HOST_CONCURRENCY = 1
+    lambda_probe.DEADLINE_MARGIN_SECONDS = 0
+    other_host = http_server.replace("127.0.0.1", "localhost")
+
+    res = lambda_probe.probe_urls(
+        [f"{http_server}/sleep/0.5"] * 3 + [f"{other_host}/status/404"],
+        lambda_probe.get_deadline(LambdaContext(0.8)),
+    )
+
+    # The second worker probes the other host instead of waiting on the first one
+    assert [result and result.status_code for result in res] == [200, None, None, 404]
+
+
+def test_batch_probes_cancel_queued_probes(url_request_count_table, http_server):
+    """Probes still queued at the deadline never start"""
+    # pylint: disable=unused-argument
+    lambda_probe = load_lambda("request_and_increment_url_counter")
+    lambda_probe.PROBE_CONCURRENCY = 1
+    lambda_probe.DEADLINE_MARGIN_SECONDS = 0
+    probed = []
+    probe_url_before = lambda_probe.probe_url_before
+    lambda_probe.probe_url_before = lambda url, deadline: (
+        probed.append(url) or probe_url_before(url, deadline)
+    )
+
+    res = lambda_probe.probe_urls(
+        [f"{http_server}/sleep/0.6"] * 3, lambda_probe.get_deadline(LambdaContext(0.3))
+    )
+    time.sleep(1)
+
+    assert res == [None, None, None]
+    assert len(probed) == 1
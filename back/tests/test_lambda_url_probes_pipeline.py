@@ -0,0 +1,75 @@
+""" Unit Tests for the async url probes pipeline """
+
+import boto3
+
+from back.tests.conftest import load_lambda
+
+
+def receive_sqs_event(queue_url):
+    """Drain the moto queue into a lambda SQS event"""
+    sqs = boto3.client("sqs")
+    records = []
+
+    while True:
+        messages = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10).get(
+            "Messages", []
+        )
+        if not messages:
+            return {"Records": records}
+        records.extend(
+            {"messageId": message["MessageId"], "body": message["Body"]}
+            for message in messages
+        )
+
+
+def test_async_handler_enqueues_probe(probe_queue, url_request_count_table):
+    """In async mode, the route handler only sends the url to the queue"""
+    lambda_probe = load_lambda("request_and_increment_url_counter")
+
+    res = lambda_probe.lambda_handler({"body-json": {"url": "https://a.com"}}, None)
+
+    assert res["url"] == "https://a.com"
+    assert len(receive_sqs_event(probe_queue)["Records"]) == 1
+    assert url_request_count_table.scan()["Items"] == []
+
+
+def test_batch_handler_merges_increments(
+    probe_queue, url_request_count_table, http_server, monkeypatch
+):
+    """Probes of the same (url, status_code) are written with one UpdateItem"""
+    lambda_probe = load_lambda("request_and_increment_url_counter")
+    urls = [f"{http_server}/status/200"] * 30 + [f"{http_server}/status/404"] * 5
+    for url in urls:
+        lambda_probe.lambda_handler({"body-json": {"url": url}}, None)
+
+    update_calls = []
+    update_item = lambda_probe.TABLE_URL_REQUEST_COUNT.update_item
+    monkeypatch.setattr(
+        lambda_probe.TABLE_URL_REQUEST_COUNT,
+        "update_item",
+        lambda **kwargs: update_calls.append(kwargs) or update_item(**kwargs),
+    )
+
+    res = lambda_probe.batch_handler(receive_sqs_event(probe_queue), None)
+
+    assert res == {"batchItemFailures": []}
+    assert len(update_calls) == 2
+    counters = {
+        item["url"]: item["counter"] for item in url_request_count_table.scan()["Items"]
+    }
+    assert counters == {
+        f"{http_server}/status/200": 30,
+        f"{http_server}/status/404": 5,
+    }
+
+
+def test_batch_handler_reports_invalid_messages(probe_queue):
+    """Unreadable messages are sent back to the queue, not lost silently"""
+    # pylint: disable=unused-argument
+    lambda_probe = load_lambda("request_and_increment_url_counter")
+
+    res = lambda_probe.batch_handler(
+        {"Records": [{"messageId": "invalid", "body": "not json"}]}, None
+    )
+
+    assert res == {"batchItemFailures": [{"itemIdentifier": "invalid"}]}
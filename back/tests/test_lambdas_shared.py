@@ -0,0 +1,160 @@
+""" Unit Tests for the code shared between lambdas """
+
+import base64
+import json
+from decimal import Decimal
+
+import pytest
+
+# The shared layer is put on sys.path by conftest
+from lambdas_shared import aws, events, instrumentation
+
+
+def get_proxy_event(querystring=None, body=None, base64_encoded=False):
+    """Minimal lambda proxy integration event"""
+    if body is not None:
+        body = json.dumps(body)
+        if base64_encoded:
+            body = base64.b64encode(body.encode()).decode()
+
+    return {
+        "httpMethod": "GET" if body is None else "POST",
+        "requestContext": {"stage": "test"},
+        "queryStringParameters": querystring,
+        "body": body,
+        "isBase64Encoded": base64_encoded,
+    }
+
+
+def test_lazy_clients_are_built_on_first_use(monkeypatch):
+    """Lazy clients cost nothing until used, and are built once"""
+    monkeypatch.setattr(aws, "LAZY_AWS_CLIENTS", True)
+    builds = []
+
+    lazy = aws.build(lambda: builds.append(1) or {"key": "value"})
+
+    assert not builds
+    assert lazy.get("key") == "value"
+    assert lazy.get("key") == "value"
+    assert len(builds) == 1
+
+
+def test_eager_clients_are_built_now(monkeypatch):
+    """Default clients are built at import time, during the lambda init phase"""
+    monkeypatch.setattr(aws, "LAZY_AWS_CLIENTS", False)
+
+    assert aws.build(lambda: {"key": "value"}) == {"key": "value"}
+
+
+def test_clients_use_the_endpoint_url(monkeypatch, aws_credentials):
+    """AWS_ENDPOINT_URL is passed to boto3, which only reads it from 1.28"""
+    # pylint: disable=unused-argument
+    monkeypatch.setattr(aws, "ENDPOINT_URL", "http://127.0.0.1:5000")
+    monkeypatch.setattr(aws, "LAZY_AWS_CLIENTS", False)
+
+    assert aws.client("sqs").meta.endpoint_url == "http://127.0.0.1:5000"
+
+
+def test_events_adapter_reads_both_shapes():
+    """Template and proxy events give handlers the same querystring & body"""
+    template_event = {
+        "body-json": {"url": "https://a.com"},
+        "params": {"querystring": {"url": "https://a.com"}},
+    }
+
+    for event in [
+        template_event,
+        get_proxy_event({"url": "https://a.com"}, {"url": "https://a.com"}),
+        get_proxy_event({"url": "https://a.com"}, {"url": "https://a.com"}, True),
+    ]:
+        assert events.get_querystring(event) == {"url": "https://a.com"}
+        assert events.get_body(event) == {"url": "https://a.com"}
+
+    assert events.get_querystring(get_proxy_event()) == {}
+    assert events.get_body(get_proxy_event()) == {}
+
+
+def test_events_adapter_responds_per_shape():
+    """Proxy responses carry status code, CORS header and a JSON body"""
+    body = {"counter": Decimal(3), "latency_ms": Decimal("12.5")}
+
+    assert events.respond({"params": {}}, body, 201) is body
+
+    response = events.respond(get_proxy_event(), body, 201)
+    assert response["statusCode"] == 201
+    assert response["headers"]["Access-Control-Allow-Origin"] == "*"
+    assert json.loads(response["body"]) == {"counter": 3, "latency_ms": 12.5}
+
+
+def read_json_lines(capsys):
+    """JSON lines written to stdout since the last read"""
+    return [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+
+
+def test_events_are_sampled_truncated_and_redacted(capsys, monkeypatch):
+    """Only a share of events is logged, cut to LOG_EVENT_MAX_BYTES, without token"""
+    event = {"authorizationToken": "secret", "body-json": {"urls": ["x" * 100] * 50}}
+
+    monkeypatch.setattr(instrumentation, "LOG_EVENT_SAMPLE_RATE", 0)
+    instrumentation.log_event(event)
+    assert not capsys.readouterr().out
+
+    monkeypatch.setattr(instrumentation, "LOG_EVENT_SAMPLE_RATE", 1)
+    monkeypatch.setattr(instrumentation, "LOG_EVENT_MAX_BYTES", 200)
+    instrumentation.log_event(event)
+    (line,) = read_json_lines(capsys)
+
+    assert line["level"] == "INFO"
+    assert line["truncated"] is True
+    assert line["event_bytes"] > 5000
+    assert len(line["event"]) == 200
+    assert "secret" not in line["event"]
+
+
+def test_metrics_are_written_as_emf(capsys):
+    """Each invocation writes its metrics, 100 values per document at most"""
+    # Probe tests calling probe_urls outside of a handler leave theirs
+    instrumentation.METRICS.clear()
+    instrumentation.put_metric("HandlerLatency", 12.5, "Milliseconds")
+    for latency in range(150):
+        instrumentation.put_metric("ProbeLatency", latency, "Milliseconds")
+    instrumentation.flush_metrics()
+    first, second = read_json_lines(capsys)
+
+    directive = first["_aws"]["CloudWatchMetrics"][0]
+    assert directive["Dimensions"] == [["function"]]
+    assert {"Name": "ProbeLatency", "Unit": "Milliseconds"} in directive["Metrics"]
+    assert first["HandlerLatency"] == 12.5
+    assert first["ProbeLatency"] == list(range(100))
+    assert second["ProbeLatency"] == list(range(100, 150))
+    assert "HandlerLatency" not in second
+
+    instrumentation.flush_metrics()
+    assert not capsys.readouterr().out
+
+
+def test_instrumented_handler(capsys, monkeypatch):
+    """Cold start is counted once, latency always, errors are logged and raised"""
+    monkeypatch.setattr(instrumentation, "COLD_START", True)
+    monkeypatch.setattr(instrumentation, "LOG_EVENT_SAMPLE_RATE", 0)
+
+    @instrumentation.instrumented
+    def handler(event, _):
+        if event.get("fail"):
+            raise ValueError("failed")
+        instrumentation.record_consumed_capacity(
+            {"ConsumedCapacity": {"TableName": "table", "CapacityUnits": 1.0}}
+        )
+        return "ok"
+
+    assert handler({}, None) == "ok"
+    (cold,) = read_json_lines(capsys)
+    assert cold["ColdStart"] == 1
+    assert cold["DynamoDBConsumedCapacity"] == 1.0
+    assert cold["HandlerLatency"] >= 0
+
+    with pytest.raises(ValueError):
+        handler({"fail": True}, None)
+    error, warm = read_json_lines(capsys)
+    assert error["level"] == "ERROR" and "failed" in error["error"]
+    assert "ColdStart" not in warm and "HandlerLatency" in warm
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+""" Deploy only the stacks whose synthesized template or assets changed
+
+    python3 cdk_changes.py plan
+    python3 cdk_changes.py deploy --deployed s3://bucket/project-stage.json
+
+Each stack of cdk.out is fingerprinted from its template and the content of its
+assets, and compared with the fingerprints saved after the last successful deploy.
+Changed stacks are deployed in waves: stacks of a wave don't depend on each other
+and are deployed concurrently.
+"""
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+
+STACK_ARTIFACT = "aws:cloudformation:stack"
+ASSETS_ARTIFACT = "cdk:asset-manifest"
+
+
+def hash_path(path):
+    """Hash of a file, or of every file name & content of a folder"""
+    digest = hashlib.sha256()
+
+    if os.path.isfile(path):
+        files = [(os.path.basename(path), path)]
+    else:
+        files = sorted(
+            (os.path.relpath(os.path.join(root, file), path), os.path.join(root, file))
+            for root, _, files_list in os.walk(path)
+            for file in files_list
+        )
+
+    for name, file_path in files:
+        digest.update(name.encode())
+        with open(file_path, "rb") as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b""):
+                digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def get_assets_paths(cdk_out, assets_file):
+    """Source paths of the file & docker image assets of an asset manifest"""
+    with open(os.path.join(cdk_out, assets_file), encoding="utf-8") as file:
+        assets = json.load(file)
+
+    paths = [asset["source"]["path"] for asset in assets.get("files", {}).values()]
+    paths += [
+        asset["source"]["directory"]
+        for asset in assets.get("dockerImages", {}).values()
+    ]
+
+    return sorted(paths)
+
+
+def load_stacks(cdk_out):
+    """Return the fingerprint and the stacks dependencies of every cdk.out stack"""
+    with open(os.path.join(cdk_out, "manifest.json"), encoding="utf-8") as file:
+        artifacts = json.load(file)["artifacts"]
+
+    stacks = {}
+    for name, artifact in artifacts.items():
+        if artifact["type"] != STACK_ARTIFACT:
+            continue
+
+        digest = hashlib.sha256()
+        template_file = artifact["properties"]["templateFile"]
+        digest.update(hash_path(os.path.join(cdk_out, template_file)).encode())
+
+        dependencies = []
+        for dependency in artifact.get("dependencies", []):
+            if artifacts[dependency]["type"] == STACK_ARTIFACT:
+                dependencies.append(dependency)
+            elif artifacts[dependency]["type"] == ASSETS_ARTIFACT:
+                assets_file = artifacts[dependency]["properties"]["file"]
+                for path in get_assets_paths(cdk_out, assets_file):
+                    digest.update(hash_path(os.path.join(cdk_out, path)).encode())
+
+        stacks[name] = {
+            "fingerprint": digest.hexdigest(),
+            "dependencies": sorted(dependencies),
+        }
+
+    return stacks
+
+
+def plan_deploy(stacks, deployed):
+    """Return the waves of stacks to deploy, a wave only depends on previous ones"""
+    levels = {}
+
+    def get_level(name):
+        if name not in levels:
+            levels[name] = 1 + max(
+                (get_level(dependency) for dependency in stacks[name]["dependencies"]),
+                default=-1,
+            )
+        return levels[name]
+
+    changed = [
+        name
+        for name, stack in stacks.items()
+        if deployed.get(name, {}).get("fingerprint") != stack["fingerprint"]
+    ]
+
+    waves = {}
+    for name in changed:
+        waves.setdefault(get_level(name), []).append(name)
+
+    return [sorted(waves[level]) for level in sorted(waves)]
+
+
+def load_deployed(location):
+    """Stacks deployed last time, from a local file or an s3:// URI"""
+    if location.startswith("s3://"):
+        # pylint: disable=import-outside-toplevel
+        import boto3
+
+        s3_client = boto3.client("s3")
+        bucket, key = location[len("s3://") :].split("/", 1)
+        try:
+            body = s3_client.get_object(Bucket=bucket, Key=key)["Body"]
+            return json.loads(body.read())
+        except s3_client.exceptions.NoSuchKey:
+            return {}
+
+    if not os.path.isfile(location):
+        return {}
+
+    with open(location, encoding="utf-8") as file:
+        return json.load(file)
+
+
+def save_deployed(location, deployed):
+    """Save deployed stacks, to a local file or an s3:// URI"""
+    body = json.dumps(deployed, indent=2, sort_keys=True)
+
+    if location.startswith("s3://"):
+        # pylint: disable=import-outside-toplevel
+        import boto3
+
+        bucket, key = location[len("s3://") :].split("/", 1)
+        boto3.client("s3").put_object(Bucket=bucket, Key=key, Body=body.encode())
+    else:
+        with open(location, "w", encoding="utf-8") as file:
+            file.write(body)
+
+
+def deploy_stack(cdk_out, name):
+    """cdk deploy a single stack from the already synthesized cdk.out
+    Return its outputs, None when the deploy failed"""
+    outputs_file = os.path.join(cdk_out, f"{name}.outputs.json")
+    returncode = subprocess.call(
+        [
+            "cdk",
+            "deploy",
+            "--app",
+            cdk_out,
+            "--exclusively",
+            "--require-approval=never",
+            "--outputs-file",
+            outputs_file,
+            name,
+        ]
+    )
+    if returncode != 0:
+        return None
+
+    with open(outputs_file, encoding="utf-8") as file:
+        return json.load(file).get(name, {})
+
+
+def deploy(cdk_out, deployed_location, outputs_file, max_workers=None):
+    """Deploy changed stacks wave by wave, return False when a deploy failed"""
+    stacks = load_stacks(cdk_out)
+    deployed = load_deployed(deployed_location)
+    waves = plan_deploy(stacks, deployed)
+
+    for wave in waves:
+        print(f"Deploying {', '.join(wave)}")
+        with ThreadPoolExecutor(max_workers=max_workers or len(wave)) as executor:
+            outputs = dict(
+                zip(wave, executor.map(lambda name: deploy_stack(cdk_out, name), wave))
+            )
+
+        # Save each success, failed stacks are deployed again next time
+        for name, stack_outputs in outputs.items():
+            if stack_outputs is not None:
+                deployed[name] = {
+                    "fingerprint": stacks[name]["fingerprint"],
+                    "outputs": stack_outputs,
+                }
+        save_deployed(deployed_location, deployed)
+
+        failed = [
+            name for name, stack_outputs in outputs.items() if stack_outputs is None
+        ]
+        if failed:
+            print(f"Deploy failed for {', '.join(failed)}")
+            return False
+
+    # Same content as cdk deploy --all --outputs-file, unchanged stacks included
+    with open(outputs_file, "w", encoding="utf-8") as file:
+        json.dump(
+            {
+                name: deployed[name].get("outputs", {})
+                for name in stacks
+                if name in deployed
+            },
+            file,
+            indent=2,
+        )
+
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["plan", "deploy"])
+    parser.add_argument(
+        "--cdk-out", help="Synthesized cloud assembly", default="cdk.out"
+    )
+    parser.add_argument(
+        "--deployed",
+        help="Stacks deployed last time, local file or s3:// URI",
+        default=".cdk-deployed.json",
+    )
+    parser.add_argument("--outputs-file", default="deploy-output.json")
+    parser.add_argument("--max-workers", help="Concurrent deploys", type=int)
+    args = parser.parse_args()
+
+    if args.command == "plan":
+        print(
+            json.dumps(
+                plan_deploy(load_stacks(args.cdk_out), load_deployed(args.deployed)),
+                indent=2,
+            )
+        )
+    elif not deploy(args.cdk_out, args.deployed, args.outputs_file, args.max_workers):
+        sys.exit(1)
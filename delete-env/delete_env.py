@@ -2,36 +2,237 @@
 
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
+
 import boto3
+from botocore.exceptions import ClientError, WaiterError
 
 AWS_DEFAULT_REGION = os.environ.get("AWS_DEFAULT_REGION")
+# delete_objects maximum
+DELETE_BATCH_SIZE = 1000
+MAX_WORKERS = 16
+# Every status but DELETE_COMPLETE, filtered by CloudFormation
+STACK_STATUSES = [
+    "CREATE_IN_PROGRESS",
+    "CREATE_FAILED",
+    "CREATE_COMPLETE",
+    "ROLLBACK_IN_PROGRESS",
+    "ROLLBACK_FAILED",
+    "ROLLBACK_COMPLETE",
+    "DELETE_IN_PROGRESS",
+    "DELETE_FAILED",
+    "UPDATE_IN_PROGRESS",
+    "UPDATE_COMPLETE_CLEANUP_IN_PROGRESS",
+    "UPDATE_COMPLETE",
+    "UPDATE_FAILED",
+    "UPDATE_ROLLBACK_IN_PROGRESS",
+    "UPDATE_ROLLBACK_FAILED",
+    "UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS",
+    "UPDATE_ROLLBACK_COMPLETE",
+    "REVIEW_IN_PROGRESS",
+    "IMPORT_IN_PROGRESS",
+    "IMPORT_COMPLETE",
+    "IMPORT_ROLLBACK_IN_PROGRESS",
+    "IMPORT_ROLLBACK_FAILED",
+    "IMPORT_ROLLBACK_COMPLETE",
+]
+
+
+def list_env_buckets(s3_client, branch_id):
+    """Names of the buckets related to the branch
+    S3 can only filter on a prefix, branch buckets share a suffix
+    ListBuckets is not paginated, every bucket of the account comes in one response"""
+    return [
+        bucket["Name"]
+        for bucket in s3_client.list_buckets()["Buckets"]
+        if bucket["Name"].endswith(branch_id)
+    ]
+
+
+def delete_batch(s3_client, bucket, objects):
+    """Delete up to 1000 objects versions in a single request, return errors"""
+    response = s3_client.delete_objects(
+        Bucket=bucket, Delete={"Objects": objects, "Quiet": True}
+    )
+    return response.get("Errors", [])
+
+
+def empty_bucket(s3_client, bucket, executor):
+    """Delete every object version and delete marker of a bucket
+    Batches are deleted concurrently while next pages are listed"""
+    futures = []
+    deleted = 0
+
+    # Unversioned buckets objects are listed with the null version
+    pages = s3_client.get_paginator("list_object_versions").paginate(
+        Bucket=bucket, PaginationConfig={"PageSize": DELETE_BATCH_SIZE}
+    )
+    for page in pages:
+        objects = [
+            {"Key": version["Key"], "VersionId": version["VersionId"]}
+            for version in page.get("Versions", []) + page.get("DeleteMarkers", [])
+        ]
+        for start in range(0, len(objects), DELETE_BATCH_SIZE):
+            batch = objects[start : start + DELETE_BATCH_SIZE]
+            futures.append(executor.submit(delete_batch, s3_client, bucket, batch))
+            deleted += len(batch)
+
+    errors = [error for future in futures for error in future.result()]
+
+    return {"deleted": deleted - len(errors), "errors": errors}
+
+
+def empty_buckets(s3_client, buckets, max_workers=MAX_WORKERS):
+    """Empty buckets concurrently, return a report per bucket"""
+    with ThreadPoolExecutor(max_workers=max_workers) as batches_executor:
+        with ThreadPoolExecutor(max_workers=max_workers) as buckets_executor:
+            reports = buckets_executor.map(
+                lambda bucket: empty_bucket(s3_client, bucket, batches_executor),
+                buckets,
+            )
+            return dict(zip(buckets, reports))
+
+
+def list_env_stacks(cloudformation, branch_id):
+    """Stacks related to the branch, deleted stacks are filtered by CloudFormation
+    Nested stacks are left to their root stack"""
+    pages = cloudformation.get_paginator("list_stacks").paginate(
+        StackStatusFilter=STACK_STATUSES
+    )
+    return {
+        stack["StackName"]: stack["StackId"]
+        for page in pages
+        for stack in page["StackSummaries"]
+        if stack["StackName"].endswith(branch_id) and "ParentId" not in stack
+    }
+
+
+def get_imported_exports(template):
+    """Names of the exports a template imports with Fn::ImportValue"""
+    if isinstance(template, dict):
+        if isinstance(template.get("Fn::ImportValue"), str):
+            return {template["Fn::ImportValue"]}
+        return set().union(*map(get_imported_exports, template.values()))
+    if isinstance(template, list):
+        return set().union(*map(get_imported_exports, template))
+    return set()
+
 
+def get_stacks_dependencies(cloudformation, stacks, executor):
+    """Return the stacks each stack imports exports from"""
+    exporting_stacks = {
+        export["Name"]: export["ExportingStackId"]
+        for page in cloudformation.get_paginator("list_exports").paginate()
+        for export in page["Exports"]
+    }
+    names = {stack_id: name for name, stack_id in stacks.items()}
 
-def delete_env(branch_id):
-    """Delete Environment on target branch"""
+    templates = executor.map(
+        lambda stack_id: cloudformation.get_template(StackName=stack_id)[
+            "TemplateBody"
+        ],
+        stacks.values(),
+    )
+
+    return {
+        name: {
+            names[exporting_stacks[export]]
+            for export in get_imported_exports(template)
+            if exporting_stacks.get(export) in names
+        }
+        - {name}
+        for name, template in zip(stacks, templates)
+    }
+
+
+def get_deletion_waves(dependencies):
+    """Group stacks in waves, a stack is deleted after the stacks importing from it"""
+    waves = []
+    remaining = dict(dependencies)
+
+    while remaining:
+        imported = set().union(*remaining.values())
+        wave = sorted(name for name in remaining if name not in imported)
+        # Circular imports can't happen in CloudFormation, don't loop forever anyway
+        wave = wave or sorted(remaining)
+        waves.append(wave)
+        for name in wave:
+            remaining.pop(name)
+
+    return waves
+
+
+def delete_stack(cloudformation, stack_id, waiter_delay=10):
+    """Delete a stack and wait for it, return its final status"""
+    try:
+        cloudformation.delete_stack(StackName=stack_id)
+        cloudformation.get_waiter("stack_delete_complete").wait(
+            StackName=stack_id, WaiterConfig={"Delay": waiter_delay, "MaxAttempts": 360}
+        )
+    except WaiterError as error:
+        reason = error.last_response.get("Stacks", [{}])[0].get("StackStatusReason")
+        return f"DELETE_FAILED: {reason or error}"
+    except ClientError as error:
+        return f"DELETE_FAILED: {error}"
+
+    return "DELETE_COMPLETE"
+
+
+def delete_stacks(cloudformation, stacks, max_workers=MAX_WORKERS, waiter_delay=10):
+    """Delete stacks wave by wave, stacks of a wave and their waiters concurrently
+    Return the status of each stack, stacks after a failed wave are not deleted"""
+    report = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        dependencies = get_stacks_dependencies(cloudformation, stacks, executor)
+
+        for wave in get_deletion_waves(dependencies):
+            if any(status != "DELETE_COMPLETE" for status in report.values()):
+                report.update({name: "SKIPPED" for name in wave})
+                continue
+
+            statuses = executor.map(
+                lambda name: delete_stack(cloudformation, stacks[name], waiter_delay),
+                wave,
+            )
+            report.update(zip(wave, statuses))
+
+    return report
+
+
+def delete_env(branch_id, max_workers=MAX_WORKERS, waiter_delay=10):
+    """Delete Environment on target branch, return False when something is left"""
 
     print(f"Branch id: {branch_id}")
 
-    s3_client = boto3.resource("s3")
-    cloudformation = boto3.resource("cloudformation", region_name=AWS_DEFAULT_REGION)
+    s3_client = boto3.client("s3")
+    cloudformation = boto3.client("cloudformation", region_name=AWS_DEFAULT_REGION)
 
-    buckets_list = [
-        bucket for bucket in s3_client.buckets.all() if bucket.name.endswith(branch_id)
-    ]
-    stacks_list = [
-        stack for stack in cloudformation.stacks.all() if stack.name.endswith(branch_id)
-    ]
+    # Empty each bucket related to the branch, this will allow stack deletion
+    # To delete bucket with no error
+    buckets_report = empty_buckets(
+        s3_client, list_env_buckets(s3_client, branch_id), max_workers
+    )
+    stacks_report = delete_stacks(
+        cloudformation,
+        list_env_stacks(cloudformation, branch_id),
+        max_workers,
+        waiter_delay,
+    )
 
-    if len(buckets_list):
-        # Empty each bucket related to the branch, this will allow stack deletion
-        # To delete bucket with no error
-        for bucket in buckets_list:
-            bucket.objects.all().delete()
+    for bucket, report in buckets_report.items():
+        print(
+            f"Bucket {bucket}: {report['deleted']} objects versions deleted, "
+            f"{len(report['errors'])} errors"
+        )
+    for stack, status in stacks_report.items():
+        print(f"Stack {stack}: {status}")
 
-    if len(stacks_list):
-        for stack in stacks_list:
-            stack.delete()
+    return all(not report["errors"] for report in buckets_report.values()) and all(
+        status == "DELETE_COMPLETE" for status in stacks_report.values()
+    )
 
 
 if __name__ == "__main__":
-    delete_env(sys.argv[1])
+    if not delete_env(sys.argv[1]):
+        sys.exit(1)
@@ -1,5 +1,6 @@
 """ Front End Stack """
 
+from aws_cdk import aws_s3 as s3
 from constructs import Construct
 
 from utils_files import utils_cdk
@@ -15,11 +16,23 @@ class FrontStack(utils_cdk.CommonStacksVars):
         self.vpc = utils_cdk.get_vpc(self)
 
         # ### S3 BUCKET ### #
-        utils_cdk.create_s3_bucket(
+        # Private, only served through the distribution
+        bucket = utils_cdk.create_s3_bucket(
             self,
             bucket_name=f"front-{self.suffix}",
-            public_read_access=True,
-            website_index_document="index.html",
-            # Little hack to be able to use react-router routes with s3 hosting
-            website_error_document="index.html",
+            block_public_access=s3.BlockPublicAccess.BLOCK_ALL,
+            enforce_ssl=True,
+        )
+
+        # ### CLOUDFRONT ### #
+        index_ttl = self.node.try_get_context("FRONT_INDEX_CACHE_TTL")
+        # react-router routes are rewritten to index.html by a CloudFront function
+        utils_cdk.create_cloudfront_distribution(
+            self,
+            distribution_id=f"front-{self.suffix}",
+            bucket=bucket,
+            assets_path_patterns=self.node.try_get_context(
+                "FRONT_ASSETS_PATH_PATTERNS"
+            ),
+            index_ttl=60 if index_ttl is None else index_ttl,
         )
@@ -1,26 +1,173 @@
 """ Unit Tests for Front Stack """
-# import aws_cdk as cdk
 
-# from aws_cdk import assertions
+import json
+import os
 
-# from front.front_stack import FrontStack
+import aws_cdk as cdk
+from aws_cdk import assertions
 
-# app = cdk.App()
-# ENV = cdk.Environment(
-#     region=app.node.try_get_context("AWS_DEFAULT_REGION"),
-#     account=app.node.try_get_context("AWS_ACCOUNT"),
-# )
-# PROJECT_NAME = app.node.try_get_context("PROJECT_NAME")
-# STAGE = app.node.try_get_context("STAGE")
+from front.front_stack import FrontStack
 
-# # example tests. To run these tests, uncomment this file along with the example
-# # resource in aws_cdk_jenkins_cicd/aws_cdk_jenkins_cicd_stack.py
-def test_sqs_queue_created():
-    """Example Unit Test"""
-    return True
 
+CONF_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../conf")
 
-#     stack = FrontStack(app, f"front-{PROJECT_NAME}-{STAGE}", env=ENV)
-#     template = assertions.Template.from_stack(stack)
 
-#     template.has_resource_properties("AWS::SQS::Queue", {"VisibilityTimeout": 300})
+def synth_front_stack(conf="test", **context):
+    """Synthesize FrontStack with a stage conf, overridden by context"""
+    with open(os.path.join(CONF_PATH, f"{conf}_conf.json"), encoding="utf-8") as file:
+        app = cdk.App(context={**json.load(file), **context})
+
+    stack = FrontStack(
+        app,
+        f"front-{app.node.try_get_context('PROJECT_NAME')}-{conf}",
+        # VPC lookup needs an explicit account & region
+        env=cdk.Environment(account="123456789012", region="eu-west-3"),
+    )
+
+    return assertions.Template.from_stack(stack)
+
+
+def test_bucket_is_private_and_read_through_origin_access_control():
+    """No public website bucket, only the distribution can read objects"""
+    template = synth_front_stack()
+
+    template.has_resource_properties(
+        "AWS::S3::Bucket",
+        {
+            "PublicAccessBlockConfiguration": {
+                "BlockPublicAcls": True,
+                "BlockPublicPolicy": True,
+                "IgnorePublicAcls": True,
+                "RestrictPublicBuckets": True,
+            },
+            "WebsiteConfiguration": assertions.Match.absent(),
+        },
+    )
+    template.has_resource_properties(
+        "AWS::CloudFront::OriginAccessControl",
+        {
+            "OriginAccessControlConfig": assertions.Match.object_like(
+                {"OriginAccessControlOriginType": "s3", "SigningBehavior": "always"}
+            )
+        },
+    )
+    template.resource_count_is("AWS::CloudFront::CloudFrontOriginAccessIdentity", 0)
+    template.has_resource_properties(
+        "AWS::CloudFront::Distribution",
+        {
+            "DistributionConfig": assertions.Match.object_like(
+                {
+                    "Origins": [
+                        assertions.Match.object_like(
+                            {
+                                "OriginAccessControlId": assertions.Match.any_value(),
+                                "S3OriginConfig": {"OriginAccessIdentity": ""},
+                                "CustomOriginConfig": assertions.Match.absent(),
+                            }
+                        )
+                    ]
+                }
+            )
+        },
+    )
+    template.has_resource_properties(
+        "AWS::S3::BucketPolicy",
+        {
+            "PolicyDocument": assertions.Match.object_like(
+                {
+                    "Statement": assertions.Match.array_with(
+                        [
+                            assertions.Match.object_like(
+                                {
+                                    "Action": "s3:GetObject",
+                                    "Principal": {
+                                        "Service": "cloudfront.amazonaws.com"
+                                    },
+                                    "Condition": assertions.Match.any_value(),
+                                }
+                            )
+                        ]
+                    )
+                }
+            )
+        },
+    )
+
+
+def test_cache_policies_and_compression():
+    """Hashed assets are cached a year, index.html and SPA routes a minute"""
+    template = synth_front_stack()
+
+    template.has_resource_properties(
+        "AWS::CloudFront::CachePolicy",
+        {
+            "CachePolicyConfig": assertions.Match.object_like(
+                {"DefaultTTL": 31536000, "MinTTL": 31536000, "MaxTTL": 31536000}
+            )
+        },
+    )
+    template.has_resource_properties(
+        "AWS::CloudFront::CachePolicy",
+        {
+            "CachePolicyConfig": assertions.Match.object_like(
+                {
+                    "DefaultTTL": 60,
+                    "MinTTL": 0,
+                    "MaxTTL": 60,
+                    "ParametersInCacheKeyAndForwardedToOrigin": assertions.Match.object_like(
+                        {
+                            "EnableAcceptEncodingGzip": True,
+                            "EnableAcceptEncodingBrotli": True,
+                        }
+                    ),
+                }
+            )
+        },
+    )
+    template.has_resource_properties(
+        "AWS::CloudFront::Distribution",
+        {
+            "DistributionConfig": assertions.Match.object_like(
+                {
+                    "DefaultRootObject": "index.html",
+                    "DefaultCacheBehavior": assertions.Match.object_like(
+                        {"Compress": True, "ViewerProtocolPolicy": "redirect-to-https"}
+                    ),
+                    "CacheBehaviors": [
+                        assertions.Match.object_like(
+                            {"PathPattern": "/static/*", "Compress": True}
+                        )
+                    ],
+                }
+            )
+        },
+    )
+
+
+def test_spa_fallback_routing():
+    """Routes without a file extension are rewritten to index.html at the edge"""
+    template = synth_front_stack()
+
+    template.has_resource_properties(
+        "AWS::CloudFront::Function",
+        {"FunctionCode": assertions.Match.string_like_regexp("/index.html")},
+    )
+    template.has_resource_properties(
+        "AWS::CloudFront::Distribution",
+        {
+            "DistributionConfig": assertions.Match.object_like(
+                {
+                    "DefaultCacheBehavior": assertions.Match.object_like(
+                        {
+                            "FunctionAssociations": [
+                                assertions.Match.object_like(
+                                    {"EventType": "viewer-request"}
+                                )
+                            ]
+                        }
+                    ),
+                    "CustomErrorResponses": assertions.Match.absent(),
+                }
+            )
+        },
+    )
@@ -0,0 +1,289 @@
+""" Sync the front build with the front-{suffix} bucket after deploy
+
+    python3 utils_files/after_deploy/after_deploy.py --build-dir front/build
+
+Only files whose content changed are uploaded, concurrently: the MD5 of the bytes
+that would be uploaded is compared with the ETag of the object (single part uploads
+of a bucket without KMS encryption). Text assets are stored gzipped, with
+Content-Encoding set, and every object gets the Cache-Control of its file pattern.
+
+index.html is uploaded after every other file, and stale objects are deleted only
+once it is live, CloudFront cache included: a page loaded before the sync still
+finds the assets it references.
+"""
+
+import os
+import sys
+import gzip
+import json
+import base64
+import time
+import fnmatch
+import hashlib
+import argparse
+import mimetypes
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+
+
+# delete_objects maximum
+DELETE_BATCH_SIZE = 1000
+MAX_WORKERS = 32
+# Uploaded last, old objects are kept until they are live
+ENTRY_POINTS = ["index.html"]
+COMPRESSED_EXTENSIONS = {
+    ".html",
+    ".css",
+    ".js",
+    ".mjs",
+    ".json",
+    ".map",
+    ".svg",
+    ".txt",
+    ".xml",
+    ".webmanifest",
+}
+# Hashed assets never change and are cached forever, like their CloudFront behaviors
+ASSETS_CACHE_CONTROL = "public, max-age=31536000, immutable"
+DEFAULT_CACHE_CONTROL = "public, max-age=3600"
+
+
+def get_cache_control_rules(context):
+    """Cache-Control rules, first matching pattern wins, of the stage conf the
+    CloudFront distribution is built from: FRONT_ASSETS_PATH_PATTERNS are hashed
+    assets, index.html is kept FRONT_INDEX_CACHE_TTL seconds by edges"""
+    index_ttl = context.get("FRONT_INDEX_CACHE_TTL")
+    index_ttl = 60 if index_ttl is None else index_ttl
+
+    return (
+        [("index.html", f"public, max-age=0, s-maxage={index_ttl}, must-revalidate")]
+        # CloudFront path patterns start with a "/", object keys don't
+        + [
+            (pattern.lstrip("/"), ASSETS_CACHE_CONTROL)
+            for pattern in context.get("FRONT_ASSETS_PATH_PATTERNS") or []
+        ]
+        + [("*", DEFAULT_CACHE_CONTROL)]
+    )
+
+
+def get_cache_control(key, rules=None):
+    """Cache-Control of the first rule matching the object key"""
+    for pattern, cache_control in rules or get_cache_control_rules({}):
+        # Path patterns are case sensitive
+        if fnmatch.fnmatchcase(key, pattern):
+            return cache_control
+    return None
+
+
+def read_body(path):
+    """Bytes uploaded for a file, gzipped for text assets
+    mtime is fixed so that the same content always gives the same bytes"""
+    with open(path, "rb") as file:
+        body = file.read()
+
+    if os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS:
+        return gzip.compress(body, compresslevel=9, mtime=0), "gzip"
+    return body, None
+
+
+def prepare_file(build_dir, path, rules=None):
+    """Upload parameters and MD5 of a local file, without keeping its body"""
+    key = os.path.relpath(path, build_dir).replace(os.sep, "/")
+    body, content_encoding = read_body(path)
+
+    return {
+        "key": key,
+        "path": path,
+        "md5": hashlib.md5(body).hexdigest(),
+        "content_type": mimetypes.guess_type(key)[0] or "application/octet-stream",
+        "content_encoding": content_encoding,
+        "cache_control": get_cache_control(key, rules),
+    }
+
+
+def list_local_files(build_dir, executor, rules=None):
+    """Prepare every file of the build, concurrently"""
+    paths = [
+        os.path.join(folder, file)
+        for folder, _, files in os.walk(build_dir)
+        for file in files
+    ]
+    prepared = executor.map(lambda path: prepare_file(build_dir, path, rules), paths)
+
+    return {file["key"]: file for file in prepared}
+
+
+def list_remote_objects(s3_client, bucket):
+    """ETag of every object of the bucket"""
+    return {
+        obj["Key"]: obj["ETag"].strip('"')
+        for page in s3_client.get_paginator("list_objects_v2").paginate(Bucket=bucket)
+        for obj in page.get("Contents", [])
+    }
+
+
+def plan_sync(local, remote, entry_points=None):
+    """Return the keys to upload before the entry points, the entry points to upload
+    and the stale keys to delete afterwards"""
+    entry_points = ENTRY_POINTS if entry_points is None else entry_points
+    changed = sorted(
+        key for key, file in local.items() if remote.get(key) != file["md5"]
+    )
+
+    return (
+        [key for key in changed if key not in entry_points],
+        [key for key in changed if key in entry_points],
+        sorted(set(remote) - set(local)),
+    )
+
+
+def upload_file(s3_client, bucket, file):
+    """Upload a prepared file with its headers"""
+    body, _ = read_body(file["path"])
+    extra = {
+        "ContentType": file["content_type"],
+        "ContentEncoding": file["content_encoding"],
+        "CacheControl": file["cache_control"],
+    }
+    s3_client.put_object(
+        Bucket=bucket,
+        Key=file["key"],
+        Body=body,
+        # S3 refuses corrupted bodies
+        ContentMD5=base64.b64encode(bytes.fromhex(file["md5"])).decode(),
+        **{name: value for name, value in extra.items() if value},
+    )
+
+    return file["key"]
+
+
+def invalidate(cloudfront, distribution_id, paths, waiter_delay=10):
+    """Invalidate paths of the distribution, and wait for edges to drop them"""
+    invalidation = cloudfront.create_invalidation(
+        DistributionId=distribution_id,
+        InvalidationBatch={
+            "Paths": {"Quantity": len(paths), "Items": paths},
+            "CallerReference": str(time.time()),
+        },
+    )
+    cloudfront.get_waiter("invalidation_completed").wait(
+        DistributionId=distribution_id,
+        Id=invalidation["Invalidation"]["Id"],
+        WaiterConfig={"Delay": waiter_delay, "MaxAttempts": 60},
+    )
+
+
+def delete_objects(s3_client, bucket, keys, executor):
+    """Delete keys by batches of 1000, concurrently, return errors"""
+    batches = [
+        keys[start : start + DELETE_BATCH_SIZE]
+        for start in range(0, len(keys), DELETE_BATCH_SIZE)
+    ]
+    responses = executor.map(
+        lambda batch: s3_client.delete_objects(
+            Bucket=bucket,
+            Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True},
+        ),
+        batches,
+    )
+
+    return [error for response in responses for error in response.get("Errors", [])]
+
+
+# pylint: disable=too-many-arguments
+def sync(
+    s3_client,
+    bucket,
+    build_dir,
+    cloudfront=None,
+    distribution_id=None,
+    delete=True,
+    max_workers=MAX_WORKERS,
+    waiter_delay=10,
+    rules=None,
+):
+    """Sync the build with the bucket, return what was done
+    rules are the Cache-Control rules, see get_cache_control_rules"""
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        remote = executor.submit(list_remote_objects, s3_client, bucket)
+        local = list_local_files(build_dir, executor, rules)
+        uploads, entry_points, stale = plan_sync(local, remote.result())
+
+        def upload(keys):
+            return list(
+                executor.map(
+                    lambda key: upload_file(s3_client, bucket, local[key]), keys
+                )
+            )
+
+        # Assets first, the new index.html must not reference missing ones
+        upload(uploads)
+        upload(entry_points)
+
+        # Edges keep the previous index.html up to its TTL, it may reference stale keys
+        if (entry_points or stale) and cloudfront and distribution_id:
+            paths = ["/"] + [f"/{key}" for key in entry_points or ENTRY_POINTS]
+            invalidate(cloudfront, distribution_id, paths, waiter_delay)
+
+        stale = stale if delete else []
+        errors = delete_objects(s3_client, bucket, stale, executor) if stale else []
+
+    failed = {error["Key"] for error in errors}
+    return {
+        "uploaded": uploads + entry_points,
+        "unchanged": len(local) - len(uploads) - len(entry_points),
+        "deleted": [key for key in stale if key not in failed],
+        "errors": errors,
+    }
+
+
+def get_distribution_id(outputs_file, stack_name):
+    """Distribution id output of the front stack, from cdk deploy --outputs-file"""
+    if not os.path.isfile(outputs_file):
+        return None
+
+    with open(outputs_file, encoding="utf-8") as file:
+        outputs = json.load(file).get(stack_name, {})
+
+    return next((value for name, value in outputs.items() if name.endswith("Id")), None)
+
+
+if __name__ == "__main__":
+    with open("cdk.json", encoding="utf-8") as cdk_file:
+        context = json.load(cdk_file).get("context", {})
+    suffix = f"{context.get('PROJECT_NAME')}-{context.get('STAGE')}"
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--build-dir", default="front/build")
+    parser.add_argument("--bucket", default=f"front-{suffix}")
+    parser.add_argument("--outputs-file", default="deploy-output.json")
+    parser.add_argument("--distribution-id", help="Default: from --outputs-file")
+    parser.add_argument("--no-delete", action="store_true", help="Keep stale objects")
+    parser.add_argument("--max-workers", type=int, default=MAX_WORKERS)
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.build_dir):
+        print(f"No front build in {args.build_dir}, nothing to sync")
+        sys.exit(0)
+
+    start_time = time.perf_counter()
+    report = sync(
+        boto3.client("s3"),
+        args.bucket,
+        args.build_dir,
+        cloudfront=boto3.client("cloudfront"),
+        distribution_id=args.distribution_id
+        or get_distribution_id(args.outputs_file, f"front-{suffix}"),
+        delete=not args.no_delete,
+        max_workers=args.max_workers,
+        rules=get_cache_control_rules(context),
+    )
+    print(
+        f"Synced {args.build_dir} to {args.bucket} in "
+        f"{time.perf_counter() - start_time:.1f}s: {len(report['uploaded'])} "
+        f"uploaded, {report['unchanged']} unchanged, {len(report['deleted'])} deleted, "
+        f"{len(report['errors'])} errors"
+    )
+    if report["errors"]:
+        sys.exit(1)
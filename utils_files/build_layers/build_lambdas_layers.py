@@ -2,44 +2,359 @@
 
 import os
 import sys
+import json
+import shutil
+import hashlib
 import subprocess
 import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+
+# Already provided by the Lambda Python runtime, no need to ship them
+RUNTIME_PACKAGES = ["boto3", "botocore", "s3transfer", "jmespath"]
+# Folders never imported at runtime
+USELESS_DIRS = ["__pycache__", "tests", "test"]
+# Serializes downloads in the shared wheelhouse, set in each worker process
+DOWNLOAD_LOCK = multiprocessing.Lock()
+
+
+def get_layer_stats(layer_path):
+    """Return size in bytes and files count of a layer"""
+    size = 0
+    files = 0
+
+    for root, _, files_list in os.walk(layer_path):
+        for file in files_list:
+            size += os.path.getsize(os.path.join(root, file))
+            files += 1
+
+    return {"size": size, "files": files}
+
+
+def remove_path(path):
+    """Remove a file or a folder"""
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+def slim_layer(layer_path, keep_dist_info=False):
+    """Remove what pip leaves behind and the Lambda runtime never uses"""
+    for name in os.listdir(layer_path):
+        package = name.split("-")[0].split(".")[0].lower()
+
+        if package in RUNTIME_PACKAGES or name == "bin":
+            remove_path(os.path.join(layer_path, name))
+        elif name.endswith(".dist-info") and not keep_dist_info:
+            remove_path(os.path.join(layer_path, name))
+
+    for root, dirs, _ in os.walk(layer_path, topdown=True):
+        for directory in [d for d in dirs if d in USELESS_DIRS]:
+            shutil.rmtree(os.path.join(root, directory))
+            dirs.remove(directory)
+
+
+def compile_layer(layer_path, python_version):
+    """Byte-compile the layer with the Lambda runtime Python version
+    Bytecode is version specific, so the matching interpreter must be installed"""
+    python = shutil.which(f"python{python_version}")
+
+    # pyenv like shims can be found without the interpreter being installed
+    if not python or subprocess.call([python, "--version"]) != 0:
+        print(f"python{python_version} not found, skipping byte-compilation")
+        return
+
+    # Lambda assets don't keep files mtime, check bytecode against sources hash instead
+    # Files failing to compile are only reported, they would fail at import anyway
+    subprocess.call(
+        [
+            python,
+            "-m",
+            "compileall",
+            "-q",
+            "--invalidation-mode",
+            "unchecked-hash",
+            layer_path,
+        ]
+    )
+
+
+def pip(args, **kwargs):
+    """Run pip with the current interpreter"""
+    return subprocess.run(
+        [sys.executable, "-m", "pip"] + args, check=False, text=True, **kwargs
+    )
+
+
+def get_platform_options(target):
+    """pip options selecting wheels for the Lambda runtime, not for this host"""
+    return [
+        "--platform",
+        target["platform"],
+        "--python-version",
+        target["python_version"],
+        "--implementation",
+        "cp",
+        "--only-binary=:all:",
+    ]
+
+
+def download_wheels(req_path, wheelhouse, target):
+    """Download requirements wheels, and their dependencies, in the wheelhouse"""
+    return (
+        pip(
+            ["download", "-q", "-r", req_path, "-d", wheelhouse]
+            + get_platform_options(target)
+        ).returncode
+        == 0
+    )
+
+
+def resolve_versions(req_path, wheelhouse, target):
+    """Return the name==version list pip would install from the wheelhouse
+    None when the wheelhouse can't satisfy the requirements"""
+    result = pip(
+        [
+            "install",
+            "-q",
+            "--dry-run",
+            "--ignore-installed",
+            "--report",
+            "-",
+            "--no-index",
+            "--find-links",
+            wheelhouse,
+            "-r",
+            req_path,
+            # Platform options need a target, nothing is written with --dry-run
+            "--target",
+            os.path.join(wheelhouse, "dry-run"),
+        ]
+        + get_platform_options(target),
+        capture_output=True,
+    )
+    if result.returncode != 0:
+        return None
+
+    return sorted(
+        f"{package['metadata']['name'].lower()}=={package['metadata']['version']}"
+        for package in json.loads(result.stdout)["install"]
+    )
+
+
+def get_fingerprint(req_path, versions, target):
+    """Hash of everything a layer content depends on"""
+    with open(req_path, encoding="utf-8") as file:
+        requirements = file.read()
+
+    return hashlib.sha256(
+        json.dumps(
+            {"requirements": requirements, "versions": versions, "target": target},
+            sort_keys=True,
+        ).encode()
+    ).hexdigest()
+
+
+def get_fingerprint_path(path, layer):
+    """Fingerprints are kept out of the layer folder, shipped as is"""
+    return os.path.join(path, f"{layer}.fingerprint")
+
+
+def is_up_to_date(path, layer, fingerprint):
+    """True when the layer folder was built with this fingerprint"""
+    fingerprint_path = get_fingerprint_path(path, layer)
+
+    if not os.path.isdir(os.path.join(path, layer, "python")):
+        return False
+    if not os.path.isfile(fingerprint_path):
+        return False
+
+    with open(fingerprint_path, encoding="utf-8") as file:
+        return file.read().strip() == fingerprint
+
+
+def install_layer(req_path, layer_path, wheelhouse, target):
+    """pip install a requirements file from the wheelhouse, in an empty layer folder"""
+    if os.path.isdir(layer_path):
+        shutil.rmtree(layer_path)
+
+    # Host bytecode is useless, layers are compiled for the runtime
+    result = pip(
+        [
+            "install",
+            "-q",
+            "--no-compile",
+            "--no-index",
+            "--find-links",
+            wheelhouse,
+            "-r",
+            req_path,
+            "-t",
+            layer_path,
+        ]
+        + get_platform_options(target)
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"pip install of {req_path} failed")
+
+
+def build_layer(path, req, wheelhouse, target, upgrade=False):
+    """Build a requirements file layer unless its fingerprint didn't change
+    Return the layer name and its report, None when skipped"""
+    layer = req.split(".")[0]
+    req_path = os.path.join(path, req)
+    layer_path = os.path.join(path, layer, "python")
+
+    # Only reach the index when asked to, or when the wheelhouse lacks wheels
+    versions = None if upgrade else resolve_versions(req_path, wheelhouse, target)
+    if versions is None:
+        with DOWNLOAD_LOCK:
+            download_wheels(req_path, wheelhouse, target)
+        versions = resolve_versions(req_path, wheelhouse, target)
+    if versions is None:
+        raise RuntimeError(f"Can't resolve {req_path} from {wheelhouse}")
+
+    fingerprint = get_fingerprint(req_path, versions, target)
+    if is_up_to_date(path, layer, fingerprint):
+        return layer, None
+
+    print(f"Building layer {layer}: {', '.join(versions)}")
+    install_layer(req_path, layer_path, wheelhouse, target)
+    layer_report = {"versions": versions, "installed": get_layer_stats(layer_path)}
+
+    if target["optimize"]:
+        slim_layer(layer_path, keep_dist_info=target["keep_dist_info"])
+        compile_layer(layer_path, target["python_version"])
+        layer_report["optimized"] = get_layer_stats(layer_path)
+
+    with open(get_fingerprint_path(path, layer), "w", encoding="utf-8") as file:
+        file.write(fingerprint)
+
+    return layer, layer_report
+
+
+def init_worker(download_lock):
+    """Share the wheelhouse download lock with worker processes"""
+    global DOWNLOAD_LOCK  # pylint: disable=global-statement
+    DOWNLOAD_LOCK = download_lock
+
+
+def build_layers(
+    path, requirements_files_list, wheelhouse, target, upgrade=False, jobs=None
+):
+    """Build layers in parallel worker processes, return reports of built layers"""
+    os.makedirs(wheelhouse, exist_ok=True)
+    download_lock = multiprocessing.Lock()
+
+    with ProcessPoolExecutor(
+        max_workers=jobs or len(requirements_files_list) or 1,
+        initializer=init_worker,
+        initargs=(download_lock,),
+    ) as executor:
+        futures = [
+            executor.submit(
+                build_layer,
+                path,
+                req,
+                wheelhouse,
+                target,
+                upgrade=upgrade,
+            )
+            for req in requirements_files_list
+        ]
+
+        return dict(future.result() for future in futures)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--path", help="Path to librairy folder", required=True)
-    path = parser.parse_args().path
+    parser.add_argument(
+        "--python-version",
+        help="Lambda runtime Python version, used to select wheels and byte-compile",
+        default="3.8",
+    )
+    parser.add_argument(
+        "--platform",
+        help="Lambda runtime platform, used to select wheels",
+        default="manylinux2014_x86_64",
+    )
+    parser.add_argument(
+        "--no-optimize", help="Ship layers as pip leaves them", action="store_true"
+    )
+    parser.add_argument(
+        "--keep-dist-info",
+        help="Keep packages metadata, for packages reading their own version",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--wheelhouse",
+        help="Local wheels cache, layers are installed from it only",
+        default=None,
+    )
+    parser.add_argument(
+        "--upgrade",
+        help="Download the latest wheels matching requirements before building",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--jobs", help="Parallel builds, default one per layer", type=int
+    )
+    args = parser.parse_args()
 
     # Don't hardcode path to give flexibility with layers building
-    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../", path)
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../", args.path)
 
     print(f"Creating layers in {path}")
-    dirs_list = os.listdir(path)
-
     requirements_files_list = [
-        req for req in dirs_list if ".".join(req.split(".")[1:]) == "requirements.txt"
+        req
+        for req in sorted(os.listdir(path))
+        if ".".join(req.split(".")[1:]) == "requirements.txt"
     ]
 
-    for req in requirements_files_list:
-        layer = req.split(".")[0]
-        req_path = os.path.join(path, req)
-        layer_path = os.path.join(path, layer, "python")
-
-        if layer not in dirs_list:
-            print(f"Creating layer {layer}")
-            os.mkdir(os.path.join(path, layer))
-
-        subprocess.call(
-            [
-                sys.executable,
-                "-m",
-                "pip",
-                "install",
-                "--upgrade",
-                "-r",
-                req_path,
-                "-t",
-                layer_path,
-            ]
+    # Every option changing the layers content is part of their fingerprint
+    report = build_layers(
+        path,
+        requirements_files_list,
+        args.wheelhouse or os.path.join(path, ".wheelhouse"),
+        {
+            "platform": args.platform,
+            "python_version": args.python_version,
+            "optimize": not args.no_optimize,
+            "keep_dist_info": args.keep_dist_info,
+        },
+        upgrade=args.upgrade,
+        jobs=args.jobs,
+    )
+
+    for layer, layer_report in report.items():
+        if layer_report is None:
+            print(f"Layer {layer}: up to date")
+            continue
+        print(
+            f"Layer {layer}: "
+            + ", ".join(
+                f"{stage} {stats['size'] / 1024:.0f} KiB in {stats['files']} files"
+                for stage, stats in layer_report.items()
+                if stage != "versions"
+            )
+        )
+
+    # Keep reports of layers not rebuilt this time
+    report_path = os.path.join(path, "layers_report.json")
+    previous_report = {}
+    if os.path.isfile(report_path):
+        with open(report_path, encoding="utf-8") as file:
+            previous_report = json.load(file)
+
+    with open(report_path, "w", encoding="utf-8") as file:
+        json.dump(
+            {
+                layer: layer_report or previous_report.get(layer)
+                for layer, layer_report in report.items()
+            },
+            file,
+            indent=2,
         )
@@ -0,0 +1,251 @@
+""" Unit Tests for the front sync script """
+
+import gzip
+import json
+import os
+import threading
+
+import boto3
+import pytest
+from botocore.config import Config
+from moto import mock_cloudfront, mock_s3
+from moto.s3.models import S3Backend
+
+from utils_files.after_deploy import after_deploy
+
+
+REGION = "eu-west-3"
+CONF_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "..", "conf", "test_conf.json"
+)
+with open(CONF_PATH, encoding="utf-8") as conf_file:
+    CONF = json.load(conf_file)
+BUCKET = "front-project-name-test"
+DISTRIBUTION_CONFIG = {
+    "CallerReference": "front",
+    "Comment": "",
+    "Enabled": True,
+    "Origins": {
+        "Quantity": 1,
+        "Items": [
+            {
+                "Id": "origin",
+                "DomainName": f"{BUCKET}.s3.{REGION}.amazonaws.com",
+                "S3OriginConfig": {"OriginAccessIdentity": ""},
+            }
+        ],
+    },
+    "DefaultCacheBehavior": {
+        "TargetOriginId": "origin",
+        "ViewerProtocolPolicy": "redirect-to-https",
+        "MinTTL": 0,
+        "ForwardedValues": {"QueryString": False, "Cookies": {"Forward": "none"}},
+        "TrustedSigners": {"Enabled": False, "Quantity": 0},
+    },
+}
+
+
+def serialized(lock, method):
+    """Wrap a method so that calls don't overlap"""
+
+    def wrapper(*args, **kwargs):
+        with lock:
+            return method(*args, **kwargs)
+
+    return wrapper
+
+
+@pytest.fixture(name="aws")
+def fixture_aws(monkeypatch):
+    """Mocked S3 & CloudFront clients, with the front bucket and distribution"""
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", REGION)
+
+    # Objects are written while the bucket is listed, moto can't
+    lock = threading.Lock()
+    for method in ["put_object", "list_objects", "delete_objects"]:
+        monkeypatch.setattr(
+            S3Backend, method, serialized(lock, getattr(S3Backend, method))
+        )
+
+    with mock_s3(), mock_cloudfront():
+        # moto keeps the aws-chunked encoding of checksummed uploads, S3 drops it
+        s3_client = boto3.client(
+            "s3", config=Config(request_checksum_calculation="when_required")
+        )
+        s3_client.create_bucket(
+            Bucket=BUCKET, CreateBucketConfiguration={"LocationConstraint": REGION}
+        )
+        cloudfront = boto3.client("cloudfront")
+        distribution_id = cloudfront.create_distribution(
+            DistributionConfig=DISTRIBUTION_CONFIG
+        )["Distribution"]["Id"]
+
+        yield s3_client, cloudfront, distribution_id
+
+
+def write_build(root, files):
+    """Write build files, content by path"""
+    for path, content in files.items():
+        os.makedirs(os.path.join(root, os.path.dirname(path)), exist_ok=True)
+        with open(os.path.join(root, path), "w", encoding="utf-8") as file:
+            file.write(content)
+
+
+class InvalidationWaiter:
+    """moto has no GetInvalidation, its invalidations are created completed"""
+
+    def __init__(self, calls):
+        self.calls = calls
+
+    def wait(self, **kwargs):
+        """Record the wait"""
+        self.calls.append(("WaitInvalidation", kwargs["Id"]))
+
+
+def record_calls(client, operations, calls):
+    """Append (operation, key or paths) to calls on each request of client"""
+    for operation in operations:
+        client.meta.events.register(
+            f"before-parameter-build.{client.meta.service_model.service_name}."
+            f"{operation}",
+            lambda params, operation=operation, **_: calls.append(
+                (operation, params.get("Key") or params.get("InvalidationBatch"))
+            ),
+        )
+
+
+def test_headers_and_compression(aws, tmp_path):
+    """Text assets are gzipped, every object gets its pattern Cache-Control"""
+    s3_client, _, _ = aws
+    write_build(
+        tmp_path,
+        {
+            "index.html": "<html>" + "app " * 1000 + "</html>",
+            "static/js/main.1a2b3c.js": "console.log('app');" * 100,
+            "static/media/logo.5d6e7f.png": "PNG",
+            "favicon.ico": "ICO",
+        },
+    )
+
+    report = after_deploy.sync(
+        s3_client,
+        BUCKET,
+        str(tmp_path),
+        rules=after_deploy.get_cache_control_rules(CONF),
+    )
+
+    assert sorted(report["uploaded"]) == [
+        "favicon.ico",
+        "index.html",
+        "static/js/main.1a2b3c.js",
+        "static/media/logo.5d6e7f.png",
+    ]
+    index = s3_client.get_object(Bucket=BUCKET, Key="index.html")
+    assert index["ContentEncoding"] == "gzip"
+    assert index["ContentType"] == "text/html"
+    assert index["CacheControl"].startswith("public, max-age=0")
+    assert gzip.decompress(index["Body"].read()).decode().startswith("<html>app")
+
+    script = s3_client.head_object(Bucket=BUCKET, Key="static/js/main.1a2b3c.js")
+    assert script["ContentEncoding"] == "gzip"
+    assert script["CacheControl"] == "public, max-age=31536000, immutable"
+
+    logo = s3_client.head_object(Bucket=BUCKET, Key="static/media/logo.5d6e7f.png")
+    assert "ContentEncoding" not in logo
+    assert logo["CacheControl"] == "public, max-age=31536000, immutable"
+    assert (
+        s3_client.head_object(Bucket=BUCKET, Key="favicon.ico")["CacheControl"]
+        == "public, max-age=3600"
+    )
+
+
+def test_cache_control_rules_follow_cloudfront_behaviors():
+    """Objects get the TTL of the CloudFront behavior serving them, from the conf"""
+    rules = after_deploy.get_cache_control_rules(
+        {
+            "FRONT_ASSETS_PATH_PATTERNS": ["/assets/*", "*.woff2"],
+            "FRONT_INDEX_CACHE_TTL": 0,
+        }
+    )
+
+    def get_cache_control(key):
+        return after_deploy.get_cache_control(key, rules)
+
+    assert get_cache_control("index.html") == (
+        "public, max-age=0, s-maxage=0, must-revalidate"
+    )
+    assert (
+        get_cache_control("assets/main.1a2b3c.js") == after_deploy.ASSETS_CACHE_CONTROL
+    )
+    assert get_cache_control("fonts/inter.woff2") == after_deploy.ASSETS_CACHE_CONTROL
+    assert get_cache_control("static/js/main.js") == after_deploy.DEFAULT_CACHE_CONTROL
+    assert get_cache_control("Assets/main.js") == after_deploy.DEFAULT_CACHE_CONTROL
+
+
+def test_only_changed_files_are_uploaded(aws, tmp_path):
+    """Unchanged files are recognized from their ETag, even gzipped ones"""
+    s3_client, _, _ = aws
+    files = {f"static/js/chunk-{i}.js": f"chunk {i}" for i in range(300)}
+    write_build(tmp_path, {**files, "index.html": "<html>v1</html>"})
+    after_deploy.sync(s3_client, BUCKET, str(tmp_path))
+
+    write_build(tmp_path, {"static/js/chunk-7.js": "chunk 7 changed"})
+    report = after_deploy.sync(s3_client, BUCKET, str(tmp_path))
+
+    assert report["uploaded"] == ["static/js/chunk-7.js"]
+    assert report["unchanged"] == 300
+    assert report["deleted"] == []
+
+
+def test_stale_objects_deleted_once_index_is_live(aws, tmp_path, monkeypatch):
+    """Old assets stay until the new index.html is uploaded and invalidated"""
+    s3_client, cloudfront, distribution_id = aws
+    write_build(
+        tmp_path,
+        {"index.html": "main.v1.js", "static/js/main.v1.js": "v1", "robots.txt": ""},
+    )
+    after_deploy.sync(s3_client, BUCKET, str(tmp_path))
+
+    os.remove(os.path.join(tmp_path, "static/js/main.v1.js"))
+    write_build(tmp_path, {"index.html": "main.v2.js", "static/js/main.v2.js": "v2"})
+    calls = []
+    record_calls(s3_client, ["PutObject", "DeleteObjects"], calls)
+    record_calls(cloudfront, ["CreateInvalidation"], calls)
+    monkeypatch.setattr(cloudfront, "get_waiter", lambda _: InvalidationWaiter(calls))
+
+    report = after_deploy.sync(
+        s3_client,
+        BUCKET,
+        str(tmp_path),
+        cloudfront=cloudfront,
+        distribution_id=distribution_id,
+        waiter_delay=0,
+    )
+
+    assert [operation for operation, _ in calls] == [
+        "PutObject",
+        "PutObject",
+        "CreateInvalidation",
+        "WaitInvalidation",
+        "DeleteObjects",
+    ]
+    assert [key for _, key in calls[:2]] == ["static/js/main.v2.js", "index.html"]
+    assert calls[2][1]["Paths"]["Items"] == ["/", "/index.html"]
+    assert report["deleted"] == ["static/js/main.v1.js"]
+    assert sorted(
+        obj["Key"] for obj in s3_client.list_objects_v2(Bucket=BUCKET)["Contents"]
+    ) == ["index.html", "robots.txt", "static/js/main.v2.js"]
+
+
+def test_stale_objects_kept_on_demand(aws, tmp_path):
+    """delete=False only uploads"""
+    s3_client, _, _ = aws
+    s3_client.put_object(Bucket=BUCKET, Key="static/js/old.js", Body=b"old")
+    write_build(tmp_path, {"index.html": "new"})
+
+    report = after_deploy.sync(s3_client, BUCKET, str(tmp_path), delete=False)
+
+    assert report["deleted"] == []
+    assert s3_client.head_object(Bucket=BUCKET, Key="static/js/old.js")
@@ -0,0 +1,100 @@
+""" Unit Tests for the layers build script """
+
+import os
+
+from utils_files.build_layers import build_lambdas_layers
+
+
+def create_files(root, paths):
+    """Create empty files, and their folders"""
+    for path in paths:
+        os.makedirs(os.path.join(root, os.path.dirname(path)), exist_ok=True)
+        with open(os.path.join(root, path), "w", encoding="utf-8"):
+            pass
+
+
+def list_files(root):
+    """Return every file path relative to root"""
+    return sorted(
+        os.path.relpath(os.path.join(folder, file), root)
+        for folder, _, files in os.walk(root)
+        for file in files
+    )
+
+
+def test_slim_layer(tmp_path):
+    """Runtime packages, metadata, bytecode and tests are removed"""
+    create_files(
+        tmp_path,
+        [
+            "requests/__init__.py",
+            "requests/__pycache__/__init__.cpython-311.pyc",
+            "requests-2.27.1.dist-info/METADATA",
+            "boto3/__init__.py",
+            "botocore-1.24.28.dist-info/RECORD",
+            "urllib3/__init__.py",
+            "urllib3/tests/test_urllib3.py",
+            "bin/normalizer",
+        ],
+    )
+
+    build_lambdas_layers.slim_layer(str(tmp_path))
+
+    assert list_files(tmp_path) == ["requests/__init__.py", "urllib3/__init__.py"]
+    assert build_lambdas_layers.get_layer_stats(str(tmp_path)) == {
+        "size": 0,
+        "files": 2,
+    }
+
+
+def test_layer_fingerprint(tmp_path):
+    """Fingerprint changes with requirements, resolved versions and target"""
+    req_path = str(tmp_path / "requests.requirements.txt")
+    with open(req_path, "w", encoding="utf-8") as file:
+        file.write("requests\n")
+    target = {"platform": "manylinux2014_x86_64", "python_version": "3.8"}
+    versions = ["requests==2.27.1", "urllib3==1.26.9"]
+
+    fingerprint = build_lambdas_layers.get_fingerprint(req_path, versions, target)
+
+    assert fingerprint == build_lambdas_layers.get_fingerprint(
+        req_path, list(versions), dict(target)
+    )
+    assert fingerprint != build_lambdas_layers.get_fingerprint(
+        req_path, ["requests==2.27.1", "urllib3==1.26.10"], target
+    )
+    assert fingerprint != build_lambdas_layers.get_fingerprint(
+        req_path, versions, {**target, "python_version": "3.9"}
+    )
+
+
+def test_build_layer_skips_up_to_date_layer(tmp_path, monkeypatch):
+    """Only layers whose fingerprint changed are installed again"""
+    create_files(tmp_path, ["requests.requirements.txt"])
+    versions = {"requests": ["requests==2.27.1"]}
+    installs = []
+    monkeypatch.setattr(
+        build_lambdas_layers,
+        "resolve_versions",
+        lambda req_path, wheelhouse, target: versions["requests"],
+    )
+    monkeypatch.setattr(
+        build_lambdas_layers,
+        "install_layer",
+        lambda req_path, layer_path, wheelhouse, target: installs.append(
+            create_files(layer_path, ["requests/__init__.py"])
+        ),
+    )
+    target = {"platform": "manylinux2014_x86_64", "python_version": "3.8"}
+    target.update({"optimize": False, "keep_dist_info": False})
+
+    def build():
+        return build_lambdas_layers.build_layer(
+            str(tmp_path), "requests.requirements.txt", str(tmp_path), target
+        )
+
+    assert build()[1]["versions"] == ["requests==2.27.1"]
+    assert build() == ("requests", None)
+    versions["requests"] = ["requests==2.28.0"]
+    assert build()[1]["versions"] == ["requests==2.28.0"]
+    assert len(installs) == 2
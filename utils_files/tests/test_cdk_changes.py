@@ -0,0 +1,103 @@
+""" Unit Tests for the changed stacks detection """
+
+import json
+import os
+
+import cdk_changes
+
+
+def write_cdk_out(root, stacks):
+    """Write a minimal cloud assembly: templates, asset manifests and assets"""
+    artifacts = {}
+
+    for name, stack in stacks.items():
+        with open(
+            os.path.join(root, f"{name}.template.json"), "w", encoding="utf-8"
+        ) as file:
+            json.dump(stack["template"], file)
+
+        files = {}
+        for asset, content in stack.get("assets", {}).items():
+            os.makedirs(os.path.join(root, asset), exist_ok=True)
+            with open(
+                os.path.join(root, asset, "index.py"), "w", encoding="utf-8"
+            ) as file:
+                file.write(content)
+            files[asset] = {"source": {"path": asset, "packaging": "zip"}}
+
+        with open(
+            os.path.join(root, f"{name}.assets.json"), "w", encoding="utf-8"
+        ) as file:
+            json.dump({"version": "16.0.0", "files": files}, file)
+
+        artifacts[f"{name}.assets"] = {
+            "type": "cdk:asset-manifest",
+            "properties": {"file": f"{name}.assets.json"},
+        }
+        artifacts[name] = {
+            "type": "aws:cloudformation:stack",
+            "properties": {"templateFile": f"{name}.template.json"},
+            "dependencies": [f"{name}.assets"] + stack.get("dependencies", []),
+        }
+
+    with open(os.path.join(root, "manifest.json"), "w", encoding="utf-8") as file:
+        json.dump({"version": "16.0.0", "artifacts": artifacts}, file)
+
+    return str(root)
+
+
+def get_snapshots(tmp_path, **changes):
+    """Deployed and new cdk.out snapshots, with a stack depending on another one"""
+    stacks = {
+        "back": {"template": {"Resources": {"Table": {}}}, "assets": {"asset.1": "v1"}},
+        "front": {"template": {"Resources": {"Bucket": {}}}},
+        "monitoring": {"template": {"Resources": {}}, "dependencies": ["back"]},
+    }
+    os.mkdir(tmp_path / "deployed")
+    os.mkdir(tmp_path / "new")
+    deployed = cdk_changes.load_stacks(write_cdk_out(tmp_path / "deployed", stacks))
+
+    for name, stack_changes in changes.items():
+        stacks[name] = {**stacks[name], **stack_changes}
+
+    return deployed, cdk_changes.load_stacks(write_cdk_out(tmp_path / "new", stacks))
+
+
+def test_nothing_to_deploy(tmp_path):
+    """Same synthesis, no stack to deploy"""
+    deployed, stacks = get_snapshots(tmp_path)
+
+    assert cdk_changes.plan_deploy(stacks, deployed) == []
+    assert cdk_changes.plan_deploy(stacks, {}) == [["back", "front"], ["monitoring"]]
+
+
+def test_asset_change_deploys_its_stack_only(tmp_path):
+    """A lambda code change only deploys the stack using it"""
+    deployed, stacks = get_snapshots(tmp_path, back={"assets": {"asset.1": "v2"}})
+
+    assert cdk_changes.plan_deploy(stacks, deployed) == [["back"]]
+
+
+def test_dependent_stacks_deploy_after_their_dependencies(tmp_path):
+    """Independent stacks share a wave, dependent ones wait for the next one"""
+    deployed, stacks = get_snapshots(
+        tmp_path,
+        back={"template": {"Resources": {"Table": {"Ttl": 1}}}},
+        front={"template": {"Resources": {"Bucket": {"Cors": 1}}}},
+        monitoring={"template": {"Resources": {"Alarm": {}}}},
+    )
+
+    assert cdk_changes.plan_deploy(stacks, deployed) == [
+        ["back", "front"],
+        ["monitoring"],
+    ]
+
+
+def test_deployed_manifest_round_trip(tmp_path):
+    """Deployed stacks are read back as saved, missing manifest means no stack"""
+    location = str(tmp_path / "deployed.json")
+    deployed = {"back": {"fingerprint": "abc", "outputs": {"ApiUrl": "https://api"}}}
+
+    assert cdk_changes.load_deployed(location) == {}
+    cdk_changes.save_deployed(location, deployed)
+    assert cdk_changes.load_deployed(location) == deployed
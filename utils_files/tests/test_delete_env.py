@@ -0,0 +1,159 @@
+""" Unit Tests for the environment deletion script """
+
+import importlib.util
+import json
+import os
+import threading
+
+import boto3
+import pytest
+from moto import mock_cloudformation, mock_s3
+from moto.s3.models import S3Backend
+
+
+DELETE_ENV_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "../../delete-env/delete_env.py"
+)
+REGION = "eu-west-3"
+# Stacks resources don't matter, moto warns it doesn't create them
+pytestmark = pytest.mark.filterwarnings("ignore:Tried to parse")
+
+
+def load_delete_env():
+    """delete-env isn't a package, load the script from its path"""
+    spec = importlib.util.spec_from_file_location("delete_env", DELETE_ENV_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def serialized(lock, method):
+    """Wrap a method so that calls don't overlap"""
+
+    def wrapper(*args, **kwargs):
+        with lock:
+            return method(*args, **kwargs)
+
+    return wrapper
+
+
+@pytest.fixture(name="aws")
+def fixture_aws(monkeypatch):
+    """Mocked S3 & CloudFormation clients"""
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", REGION)
+
+    # S3 lists a bucket while it's being deleted from, moto can't
+    lock = threading.Lock()
+    for method in ["list_object_versions", "delete_objects"]:
+        monkeypatch.setattr(
+            S3Backend, method, serialized(lock, getattr(S3Backend, method))
+        )
+
+    with mock_s3(), mock_cloudformation():
+        yield boto3.client("s3"), boto3.client("cloudformation")
+
+
+def create_bucket(s3_client, bucket, keys, versioned=False):
+    """Create a bucket, objects are written twice then deleted when versioned"""
+    s3_client.create_bucket(
+        Bucket=bucket, CreateBucketConfiguration={"LocationConstraint": REGION}
+    )
+    if versioned:
+        s3_client.put_bucket_versioning(
+            Bucket=bucket, VersioningConfiguration={"Status": "Enabled"}
+        )
+
+    for key in keys:
+        s3_client.put_object(Bucket=bucket, Key=key, Body=b"v1")
+        if versioned:
+            s3_client.put_object(Bucket=bucket, Key=key, Body=b"v2")
+            s3_client.delete_object(Bucket=bucket, Key=key)
+
+
+def create_stack(cloudformation, name, exports=(), imports=()):
+    """Create a stack exporting and importing values"""
+    template = {
+        "Resources": {
+            "Handle": {
+                "Type": "AWS::CloudFormation::WaitConditionHandle",
+                "Metadata": {"Imports": [{"Fn::ImportValue": i} for i in imports]},
+            }
+        },
+        "Outputs": {
+            export: {"Value": export, "Export": {"Name": export}} for export in exports
+        },
+    }
+    cloudformation.create_stack(StackName=name, TemplateBody=json.dumps(template))
+
+
+def test_empty_buckets_deletes_versions_and_delete_markers(aws):
+    """Versioned or not, branch buckets are emptied in 1000 keys batches"""
+    s3_client, _ = aws
+    delete_env = load_delete_env()
+    create_bucket(s3_client, "front-feat1", [f"file-{i}" for i in range(1500)])
+    create_bucket(s3_client, "logs-feat1", ["a", "b"], versioned=True)
+    create_bucket(s3_client, "front-feat12", ["a"])
+    batches = []
+    s3_client.meta.events.register(
+        "before-parameter-build.s3.DeleteObjects",
+        lambda params, **_: batches.append(len(params["Delete"]["Objects"])),
+    )
+
+    buckets = delete_env.list_env_buckets(s3_client, "feat1")
+    report = delete_env.empty_buckets(s3_client, buckets, max_workers=4)
+
+    assert sorted(buckets) == ["front-feat1", "logs-feat1"]
+    assert report == {
+        "front-feat1": {"deleted": 1500, "errors": []},
+        "logs-feat1": {"deleted": 6, "errors": []},
+    }
+    assert len(batches) == 3
+    for bucket in buckets:
+        versions = s3_client.list_object_versions(Bucket=bucket)
+        assert "Versions" not in versions and "DeleteMarkers" not in versions
+    assert s3_client.list_objects_v2(Bucket="front-feat12")["KeyCount"] == 1
+
+
+def test_delete_stacks_in_dependency_order(aws):
+    """Stacks importing an export are deleted before the exporting stack"""
+    _, cloudformation = aws
+    delete_env = load_delete_env()
+    create_stack(cloudformation, "network-feat1", exports=["vpc-feat1"])
+    create_stack(
+        cloudformation, "back-feat1", exports=["api-feat1"], imports=["vpc-feat1"]
+    )
+    create_stack(cloudformation, "front-feat1", imports=["api-feat1"])
+    create_stack(cloudformation, "alone-feat1")
+    create_stack(cloudformation, "back-feat2")
+    deleted = []
+    cloudformation.meta.events.register(
+        "before-parameter-build.cloudformation.DeleteStack",
+        lambda params, **_: deleted.append(params["StackName"].split("/")[1]),
+    )
+
+    stacks = delete_env.list_env_stacks(cloudformation, "feat1")
+    report = delete_env.delete_stacks(cloudformation, stacks, waiter_delay=1)
+
+    assert report == {
+        name: "DELETE_COMPLETE"
+        for name in ["alone-feat1", "front-feat1", "back-feat1", "network-feat1"]
+    }
+    assert set(deleted[:2]) == {"alone-feat1", "front-feat1"}
+    assert deleted[2:] == ["back-feat1", "network-feat1"]
+    assert list(delete_env.list_env_stacks(cloudformation, "feat2")) == ["back-feat2"]
+
+
+def test_delete_env_report(aws, capsys):
+    """Buckets are emptied and stacks deleted, a report is printed"""
+    s3_client, cloudformation = aws
+    delete_env = load_delete_env()
+    create_bucket(s3_client, "front-feat1", ["index.html"])
+    create_stack(cloudformation, "front-feat1")
+
+    assert delete_env.delete_env("feat1", waiter_delay=1)
+
+    output = capsys.readouterr().out
+    assert "Bucket front-feat1: 1 objects versions deleted, 0 errors" in output
+    assert "Stack front-feat1: DELETE_COMPLETE" in output
@@ -6,8 +6,12 @@ from aws_cdk import (
     aws_dynamodb as ddb,
     aws_iam as iam,
     aws_apigateway as apigw,
+    aws_apigatewayv2 as apigwv2,
+    aws_cloudfront as cloudfront,
+    aws_cloudfront_origins as origins,
     aws_s3 as s3,
     aws_ec2 as ec2,
+    aws_sqs as sqs,
 )
 from constructs import Construct
 
@@ -23,10 +27,18 @@ class CommonStacksVars(cdk.Stack):
         self.suffix = f"{self.project_name}-{self.stage}"
 
 
+# pylint: disable=too-many-arguments
 def create_authorizer(
-    self, auth_id=None, header_token=None, validation_regex=None, authorizer=None
+    self,
+    auth_id=None,
+    header_token=None,
+    validation_regex=None,
+    authorizer=None,
+    results_cache_ttl=0,
 ):
-    """Standard function to create an authorizer"""
+    """Standard function to create an authorizer
+    results_cache_ttl, in seconds, lets API Gateway reuse the policy of a token
+    instead of invoking the authorizer on every request, 0 disables it"""
     return apigw.TokenAuthorizer(
         self,
         id=f"AUTHORIZER-{auth_id}",
@@ -34,14 +46,26 @@ def create_authorizer(
         validation_regex=validation_regex,
         handler=authorizer,
         authorizer_name=f"{auth_id}-{self.suffix}",
-        results_cache_ttl=cdk.Duration.minutes(0),
+        results_cache_ttl=cdk.Duration.seconds(results_cache_ttl),
     )
 
 
+# pylint: disable=too-many-arguments
 def create_api_gateway(
-    self, apigw_id, authorizer=None, default_cors_preflight_options=None
+    self,
+    apigw_id,
+    authorizer=None,
+    default_cors_preflight_options=None,
+    cache_cluster_size=None,
+    method_cache_ttls=None,
+    endpoint_type="EDGE",
+    minimum_compression_size=None,
 ):
-    """Standard function to create an API Gateway"""
+    """Standard function to create an API Gateway
+    Stage caching is enabled when cache_cluster_size is set (ex: "0.5"), only for methods
+    in method_cache_ttls, ex: {"/get-url-counter/GET": 30}
+    endpoint_type is EDGE or REGIONAL, responses larger than minimum_compression_size
+    bytes are compressed for clients accepting it, None disables compression"""
     api_policy = iam.PolicyDocument(
         statements=[
             iam.PolicyStatement(
@@ -58,11 +82,22 @@ def create_api_gateway(
         id=f"APIGW-{apigw_id}",
         rest_api_name=f"APIGW-{apigw_id}",
         endpoint_configuration=apigw.EndpointConfiguration(
-            types=[apigw.EndpointType.EDGE]
+            types=[apigw.EndpointType[endpoint_type]]
         ),
         policy=api_policy,
+        minimum_compression_size=minimum_compression_size,
         deploy_options=apigw.StageOptions(
             stage_name=self.node.try_get_context("STAGE"),
+            cache_cluster_enabled=bool(cache_cluster_size),
+            cache_cluster_size=cache_cluster_size,
+            method_options={
+                method_path: apigw.MethodDeploymentOptions(
+                    caching_enabled=True, cache_ttl=cdk.Duration.seconds(ttl)
+                )
+                for method_path, ttl in (method_cache_ttls or {}).items()
+            }
+            if cache_cluster_size
+            else None,
         ),
         default_method_options=apigw.MethodOptions(authorizer=authorizer)
         if authorizer
@@ -80,8 +115,13 @@ def add_apigw_lambda_route(
     authorizer=None,
     integration_response_parameters=None,
     method_response_parameters=None,
+    cache_key_parameters=None,
+    proxy=False,
 ):
-    """Standard function to add a route to APIGW with lambda usage"""
+    """Standard function to add a route to APIGW with lambda usage
+    cache_key_parameters are querystring names used as keys when stage caching is on
+    proxy sends the request as is instead of rendering default_request_template, the
+    lambda then returns the status code & headers, see lambdas_shared.events"""
     # pylint: disable=line-too-long
     # See http://docs.aws.amazon.com/apigateway/latest/developerguide/api-gateway-mapping-template-reference.html
     # This template will pass through all parameters including path, querystring, header,
@@ -133,13 +173,31 @@ def add_apigw_lambda_route(
         """
     }
 
-    route.add_method(
-        method,
-        integration=apigw.LambdaIntegration(
+    # Cache keys must be declared on the method and forwarded to the integration
+    cache_key_parameters = [
+        f"method.request.querystring.{name}" for name in cache_key_parameters or []
+    ]
+
+    integration_request_parameters = {
+        parameter.replace("method.", "integration.", 1): parameter
+        for parameter in cache_key_parameters
+    }
+
+    if proxy:
+        integration = apigw.LambdaIntegration(
+            handler=handler_lambda,
+            proxy=True,
+            cache_key_parameters=cache_key_parameters or None,
+            request_parameters=integration_request_parameters or None,
+        )
+    else:
+        integration = apigw.LambdaIntegration(
             handler=handler_lambda,
             passthrough_behavior=apigw.PassthroughBehavior.WHEN_NO_TEMPLATES,
             request_templates=default_request_template,
             proxy=False,
+            cache_key_parameters=cache_key_parameters or None,
+            request_parameters=integration_request_parameters or None,
             # request_parameters={"Access-Control-Allow-Origin": "*"},
             integration_responses=[
                 apigw.IntegrationResponse(
@@ -148,10 +206,16 @@ def add_apigw_lambda_route(
                     # response_parameters=["Access-Control-Allow-Origin"],
                 )
             ],
-        ),
+        )
+
+    route.add_method(
+        method,
+        integration=integration,
         authorization_type=apigw.AuthorizationType.CUSTOM if authorizer else None,
         authorizer=authorizer,
         # request_parameters={"AccessControlAllowOrigin": True},
+        request_parameters={parameter: False for parameter in cache_key_parameters}
+        or None,
         method_responses=[
             apigw.MethodResponse(
                 status_code=str(status_code),
@@ -161,28 +225,190 @@ def add_apigw_lambda_route(
     )
 
 
+def get_instrumentation_environment(self):
+    """lambdas_shared.instrumentation settings of the stage INSTRUMENTATION conf"""
+    instrumentation = self.node.try_get_context("INSTRUMENTATION") or {}
+
+    return {
+        "METRICS_NAMESPACE": self.project_name,
+        **{
+            name: str(value).lower() if isinstance(value, bool) else str(value)
+            for name, value in instrumentation.items()
+            if value is not None
+        },
+    }
+
+
+def get_lambda_profile(self, name):
+    """LAMBDA_PROFILES conf entry of a lambda, ex: {"MEMORY_SIZE": 512, "IN_VPC": false}"""
+    return (self.node.try_get_context("LAMBDA_PROFILES") or {}).get(name) or {}
+
+
+def create_http_api(self, apigw_id, cors_allow_headers=None, cors_allow_methods=None):
+    """Standard function to create an API Gateway v2 HTTP API, auto deployed on a STAGE
+    stage. Cheaper and lower latency than REST APIs, but no stage cache nor compression"""
+    http_api = apigwv2.CfnApi(
+        self,
+        id=f"HTTPAPI-{apigw_id}",
+        name=f"HTTPAPI-{apigw_id}",
+        protocol_type="HTTP",
+        cors_configuration=apigwv2.CfnApi.CorsProperty(
+            allow_origins=["*"],
+            allow_headers=cors_allow_headers,
+            allow_methods=cors_allow_methods,
+        ),
+    )
+
+    apigwv2.CfnStage(
+        self,
+        id=f"HTTPAPI-STAGE-{apigw_id}",
+        api_id=http_api.ref,
+        stage_name=self.node.try_get_context("STAGE"),
+        auto_deploy=True,
+    )
+
+    # Same output as the one RestApi creates for its URL
+    cdk.CfnOutput(
+        self,
+        id=f"HTTPAPI-{apigw_id}-Endpoint",
+        value=f"{http_api.attr_api_endpoint}/{self.node.try_get_context('STAGE')}/",
+    )
+
+    return http_api
+
+
+def get_http_api_source_arn(http_api):
+    """execute-api ARN of every route of an HTTP API"""
+    return (
+        f"arn:{cdk.Aws.PARTITION}:execute-api:{cdk.Aws.REGION}:{cdk.Aws.ACCOUNT_ID}:"
+        f"{http_api.ref}/*"
+    )
+
+
+# pylint: disable=too-many-arguments
+def create_http_api_authorizer(
+    self,
+    http_api,
+    auth_id=None,
+    header_token=None,
+    authorizer=None,
+    results_cache_ttl=0,
+):
+    """Standard function to create a lambda authorizer of an HTTP API
+    The 1.0 payload and IAM policy responses let it share the REST authorizer lambda,
+    which gets the header_token value in event["identitySource"]"""
+    authorizer.add_permission(
+        f"HTTPAPI-AUTHORIZER-{auth_id}-permission",
+        principal=iam.ServicePrincipal("apigateway.amazonaws.com"),
+        source_arn=get_http_api_source_arn(http_api),
+    )
+
+    return apigwv2.CfnAuthorizer(
+        self,
+        id=f"HTTPAPI-AUTHORIZER-{auth_id}",
+        api_id=http_api.ref,
+        name=f"{auth_id}-{self.suffix}",
+        authorizer_type="REQUEST",
+        authorizer_uri=(
+            f"arn:{cdk.Aws.PARTITION}:apigateway:{cdk.Aws.REGION}:lambda:path/"
+            f"2015-03-31/functions/{authorizer.function_arn}/invocations"
+        ),
+        authorizer_payload_format_version="1.0",
+        enable_simple_responses=False,
+        identity_source=[f"$request.header.{header_token}"],
+        authorizer_result_ttl_in_seconds=results_cache_ttl,
+    )
+
+
+# pylint: disable=too-many-arguments
+def add_http_api_lambda_route(
+    self, http_api, route_path, method, handler_lambda, authorizer=None
+):
+    """Standard function to add a lambda proxy route to an HTTP API
+    The 1.0 payload is the REST proxy event, see lambdas_shared.events"""
+    route_id = f"{method}-{route_path.strip('/').replace('/', '-')}"
+
+    handler_lambda.add_permission(
+        f"HTTPAPI-{route_id}-permission",
+        principal=iam.ServicePrincipal("apigateway.amazonaws.com"),
+        source_arn=get_http_api_source_arn(http_api),
+    )
+
+    integration = apigwv2.CfnIntegration(
+        self,
+        id=f"HTTPAPI-INTEGRATION-{route_id}",
+        api_id=http_api.ref,
+        integration_type="AWS_PROXY",
+        integration_uri=handler_lambda.function_arn,
+        payload_format_version="1.0",
+    )
+
+    return apigwv2.CfnRoute(
+        self,
+        id=f"HTTPAPI-ROUTE-{route_id}",
+        api_id=http_api.ref,
+        route_key=f"{method} {route_path}",
+        target=f"integrations/{integration.ref}",
+        authorization_type="CUSTOM" if authorizer else None,
+        authorizer_id=authorizer.ref if authorizer else None,
+    )
+
+
 # pylint: disable=too-many-arguments
 def create_lambda(
-    self, name, layers=None, environment=None, role=None, timeout=10, memory_size=128
+    self,
+    name,
+    layers=None,
+    environment=None,
+    role=None,
+    timeout=10,
+    memory_size=128,
+    code_name=None,
+    handler="lambda_handler",
 ):
-    """Standard function to create a lambda"""
+    """Standard function to create a lambda
+    code_name allows to deploy another handler of an existing lambda code folder
+    The LAMBDA_PROFILES conf entry of name overrides timeout & memory_size and sets
+    reserved & provisioned concurrency. With provisioned concurrency the "live" alias
+    carrying it is returned instead of the function, invoke it to benefit from it.
+    Lambdas are attached to self.vpc private subnets unless their profile IN_VPC is false.
+    A VPC without private subnets (e.g. the default one) gets them in its public subnets:
+    no internet access there, AWS services are only reached through the VPC endpoints
+    The INSTRUMENTATION conf entry is added to every lambda environment"""
+    code_name = code_name or name
+    profile = get_lambda_profile(self, name)
+    in_vpc = profile.get("IN_VPC", True)
 
     # Note: AWS is not allowing underscore in lambda's ID & Name
     normalized_name = f"{name.replace('_', '-')}-{self.suffix}"
 
-    return lambda_.Function(
+    function = lambda_.Function(
         self,
         id=f"LAMBDA-{normalized_name}",
         function_name=f"{normalized_name}",
-        code=lambda_.AssetCode(f"back/lambdas/lambda_{name}"),
-        handler=f"lambda_{name}.lambda_handler",
+        code=lambda_.AssetCode(f"back/lambdas/lambda_{code_name}"),
+        handler=f"lambda_{code_name}.{handler}",
         runtime=lambda_.Runtime.PYTHON_3_8,
         layers=layers,
-        environment=environment,
+        environment={**get_instrumentation_environment(self), **(environment or {})},
         role=role,
-        timeout=cdk.Duration.seconds(timeout),
-        memory_size=memory_size,
-        security_groups=[self.lambda_security_group],
+        timeout=cdk.Duration.seconds(profile.get("TIMEOUT") or timeout),
+        memory_size=profile.get("MEMORY_SIZE") or memory_size,
+        reserved_concurrent_executions=profile.get("RESERVED_CONCURRENCY"),
+        vpc=self.vpc if in_vpc else None,
+        security_groups=[self.lambda_security_group] if in_vpc else None,
+        allow_public_subnet=in_vpc and not has_private_subnets(self.vpc),
+    )
+
+    if not profile.get("PROVISIONED_CONCURRENCY"):
+        return function
+
+    return lambda_.Alias(
+        self,
+        id=f"ALIAS-{normalized_name}",
+        alias_name="live",
+        version=function.current_version,
+        provisioned_concurrent_executions=profile["PROVISIONED_CONCURRENCY"],
     )
 
 
@@ -227,6 +453,32 @@ def create_dynamodb(
     )
 
 
+def create_dead_letter_queue(self, queue_id):
+    """Standard function to create a SQS queue keeping failed messages 14 days"""
+    return sqs.Queue(
+        self,
+        id=f"SQS-{queue_id}-dlq",
+        retention_period=cdk.Duration.days(14),
+        removal_policy=cdk.RemovalPolicy.DESTROY,
+    )
+
+
+def create_sqs_queue(self, queue_id, visibility_timeout=60, max_receive_count=3):
+    """Standard function to create a SQS queue along with its dead letter queue"""
+    dead_letter_queue = create_dead_letter_queue(self, queue_id)
+
+    # Visibility timeout must be greater than the timeout of the consuming lambda
+    return sqs.Queue(
+        self,
+        id=f"SQS-{queue_id}",
+        visibility_timeout=cdk.Duration.seconds(visibility_timeout),
+        removal_policy=cdk.RemovalPolicy.DESTROY,
+        dead_letter_queue=sqs.DeadLetterQueue(
+            max_receive_count=max_receive_count, queue=dead_letter_queue
+        ),
+    )
+
+
 def create_role(
     self,
     role_id,
@@ -301,6 +553,151 @@ def create_s3_bucket(
     return s3_bucket
 
 
+# Routes of the SPA have no file extension, they are all served by index.html
+SPA_ROUTING_FUNCTION = """function handler(event) {
+    var request = event.request;
+    if (request.uri.split("/").pop().indexOf(".") === -1) {
+        request.uri = "/index.html";
+    }
+    return request;
+}"""
+
+
+def create_origin_access_control(self, oac_id):
+    """Standard function to create a CloudFront origin access control for S3
+    No L1 construct in this CDK version, the resource is declared as is"""
+    return cdk.CfnResource(
+        self,
+        id=f"OAC-{oac_id}",
+        type="AWS::CloudFront::OriginAccessControl",
+        properties={
+            "OriginAccessControlConfig": {
+                "Name": f"OAC-{oac_id}",
+                "OriginAccessControlOriginType": "s3",
+                "SigningBehavior": "always",
+                "SigningProtocol": "sigv4",
+            }
+        },
+    )
+
+
+# pylint: disable=too-many-arguments
+def create_cloudfront_distribution(
+    self,
+    distribution_id,
+    bucket,
+    assets_path_patterns=None,
+    assets_ttl=365 * 24 * 3600,
+    index_ttl=60,
+):
+    """Standard function to serve a private S3 bucket SPA with CloudFront
+    Hashed static assets (assets_path_patterns) are cached assets_ttl seconds, every
+    other path, index.html and SPA routes, index_ttl seconds. The bucket is only
+    readable by the distribution, through an origin access control"""
+    oac = create_origin_access_control(self, distribution_id)
+
+    def create_cache_policy(name, default_ttl, min_ttl, max_ttl):
+        return cloudfront.CachePolicy(
+            self,
+            id=f"CACHE-POLICY-{name}-{distribution_id}",
+            cache_policy_name=f"{name}-{distribution_id}",
+            default_ttl=cdk.Duration.seconds(default_ttl),
+            min_ttl=cdk.Duration.seconds(min_ttl),
+            max_ttl=cdk.Duration.seconds(max_ttl),
+            cookie_behavior=cloudfront.CacheCookieBehavior.none(),
+            header_behavior=cloudfront.CacheHeaderBehavior.none(),
+            query_string_behavior=cloudfront.CacheQueryStringBehavior.none(),
+            # Compressed and uncompressed versions are cached apart
+            enable_accept_encoding_gzip=True,
+            enable_accept_encoding_brotli=True,
+        )
+
+    # Assets names change with their content, they never need to be refreshed
+    assets_cache_policy = create_cache_policy(
+        "assets", assets_ttl, assets_ttl, assets_ttl
+    )
+    index_cache_policy = create_cache_policy("index", index_ttl, 0, index_ttl)
+
+    # Origin rendered with a custom origin config, replaced by the OAC one below
+    origin = origins.HttpOrigin(bucket.bucket_regional_domain_name)
+    spa_routing = cloudfront.Function(
+        self,
+        id=f"CF-FUNCTION-spa-routing-{distribution_id}",
+        code=cloudfront.FunctionCode.from_inline(SPA_ROUTING_FUNCTION),
+    )
+
+    distribution = cloudfront.Distribution(
+        self,
+        id=f"CF-{distribution_id}",
+        default_root_object="index.html",
+        default_behavior=cloudfront.BehaviorOptions(
+            origin=origin,
+            viewer_protocol_policy=cloudfront.ViewerProtocolPolicy.REDIRECT_TO_HTTPS,
+            cache_policy=index_cache_policy,
+            compress=True,
+            function_associations=[
+                cloudfront.FunctionAssociation(
+                    function=spa_routing,
+                    event_type=cloudfront.FunctionEventType.VIEWER_REQUEST,
+                )
+            ],
+        ),
+        additional_behaviors={
+            path_pattern: cloudfront.BehaviorOptions(
+                origin=origin,
+                viewer_protocol_policy=cloudfront.ViewerProtocolPolicy.REDIRECT_TO_HTTPS,
+                cache_policy=assets_cache_policy,
+                compress=True,
+            )
+            for path_pattern in assets_path_patterns or []
+        },
+    )
+
+    cfn_distribution = distribution.node.default_child
+    cfn_distribution.add_property_deletion_override(
+        "DistributionConfig.Origins.0.CustomOriginConfig"
+    )
+    cfn_distribution.add_property_override(
+        "DistributionConfig.Origins.0.S3OriginConfig.OriginAccessIdentity", ""
+    )
+    cfn_distribution.add_property_override(
+        "DistributionConfig.Origins.0.OriginAccessControlId", oac.get_att("Id")
+    )
+
+    bucket.add_to_resource_policy(
+        iam.PolicyStatement(
+            effect=iam.Effect.ALLOW,
+            principals=[iam.ServicePrincipal("cloudfront.amazonaws.com")],
+            actions=["s3:GetObject"],
+            resources=[bucket.arn_for_objects("*")],
+            conditions={
+                "StringEquals": {
+                    "AWS:SourceArn": (
+                        f"arn:{cdk.Aws.PARTITION}:cloudfront::{cdk.Aws.ACCOUNT_ID}:"
+                        f"distribution/{distribution.distribution_id}"
+                    )
+                }
+            },
+        )
+    )
+
+    cdk.CfnOutput(
+        self, id=f"CF-{distribution_id}-Id", value=distribution.distribution_id
+    )
+    cdk.CfnOutput(
+        self,
+        id=f"CF-{distribution_id}-DomainName",
+        value=distribution.distribution_domain_name,
+    )
+
+    return distribution
+
+
+def has_private_subnets(vpc):
+    """Standard function to check if a VPC has private or isolated subnets"""
+    return bool(vpc.private_subnets or vpc.isolated_subnets)
+
+
 def get_vpc(self):
     """Standard function to get VPC"""
     return ec2.Vpc.from_lookup(